@@ -28,10 +28,27 @@
   consider comparing it piece-by-piece with pycdgAux.py, since there
   is a one-to-one correspondence between the methods and classes
   defined there, and those defined here.
+
+  The methods that do the real work (DoPackets(), CatchUp(),
+  GetDirtyRects(), GetDirtyTiles(), FillTile() and FillRect()) release
+  the Python interpreter lock while they run, since they touch only
+  the reader's own tables and the SDL surface they are given.  Other
+  Python threads may run meanwhile, so a CdgPacketReader may be driven
+  from a background thread without stalling the rest of the program.
+  The rules are that only one thread may use a particular reader at a
+  time (a second thread that tries gets a RuntimeError rather than
+  scrambled state), and that nothing else may draw on a surface while
+  FillTile() or FillRect() is filling it.
 */
 
 #include <Python.h>
 #include <stdio.h>
+#ifdef _WIN32
+#include <windows.h>
+#else
+#include <time.h>
+#include <sys/time.h>
+#endif
 #include "structmember.h"
 #include "SDL.h"
 #include "pygame/pygame.h"
@@ -71,8 +88,25 @@
 #define TILE_WIDTH       (CDG_DISPLAY_WIDTH / TILES_PER_ROW)
 #define TILE_HEIGHT      (CDG_DISPLAY_HEIGHT / TILES_PER_COL)
 
+/* Changes to the screen are tracked at the granularity of the CDG's
+   own 6x12 blocks, of which there are 50x18 across the full area. */
+#define BLOCK_WIDTH      6
+#define BLOCK_HEIGHT     12
+#define CDG_BLOCKS_WIDE  (CDG_FULL_WIDTH / BLOCK_WIDTH)
+#define CDG_BLOCKS_HIGH  (CDG_FULL_HEIGHT / BLOCK_HEIGHT)
+#define CDG_NUM_BLOCKS   (CDG_BLOCKS_WIDE * CDG_BLOCKS_HIGH)
+
 #define COLOUR_TABLE_SIZE           16
 
+/* A compiled CDG stream, as made by pycdg.compileCdg(), begins with a
+   24-byte header: this magic string, and then the number of packets in
+   the original stream as a little-endian 32-bit integer.  It is
+   followed by just those packets that do something, with the last
+   four bytes of each (the parity field) replaced by its position in
+   the original stream, also as a little-endian 32-bit integer. */
+#define COMPILED_MAGIC              "PYKCDGC1"
+#define COMPILED_MAGIC_LEN          8
+
 /* In case we are building on a pre-2.4 version of Python. */
 #ifndef Py_RETURN_TRUE
   #define Py_RETURN_TRUE return Py_INCREF(Py_True), Py_True
@@ -90,6 +124,23 @@ typedef struct {
   unsigned char parity[4];
 } CdgPacket;
 
+/* This struct holds a snapshot of the decoder state, as returned by
+   GetState() and passed to SetState().  It is handed to Python as an
+   opaque string. */
+typedef struct {
+  int cdgDataPos;
+  int cdgCommandIndex;
+  int cdgColourTable[COLOUR_TABLE_SIZE];
+  Uint8 cdgPalette[COLOUR_TABLE_SIZE][3];
+  int justClearedColourIndex;
+  int cdgPresetColourIndex;
+  int cdgBorderColourIndex;
+  int cdgTransparentColour;
+  int hOffset, vOffset;
+  int hOrigin, vOrigin;
+  unsigned char cdgPixelColours[CDG_FULL_WIDTH][CDG_FULL_HEIGHT];
+} CdgState;
+
 /* This struct holds the data used by the CdgPacketReader class.  It
    is exported as a Python class. */
 typedef struct {
@@ -98,11 +149,49 @@ typedef struct {
   char *__cdgData;
   int __cdgDataLen;
   int __cdgDataPos;
+
+  /* If this is true, __cdgData is a compiled stream.  Then
+     __cdgDataPos is still the position within the original stream,
+     which was __cdgNumPackets packets long, and __cdgCommandIndex is
+     the index of the next of its __cdgNumCommands packets. */
+  int __cdgCompiled;
+  int __cdgNumPackets;
+  int __cdgNumCommands;
+  int __cdgCommandIndex;
   
   /* This is just for the purpose of mapping colors. */
   SDL_Surface *__mapperSurface;
 
+  /* If this is true, we are drawing onto 8-bit surfaces whose
+     palette is the CDG colour table.  In this mode we keep only the
+     array of colour indices up to date; the colour table maps each
+     index to itself, and the caller fetches the actual colours with
+     GetPalette(). */
+  int __usePalette;
+
+  /* This is set during CatchUp().  The commands then update only the
+     colour indices; __dirtyBlocks is left alone, and the whole screen
+     is marked dirty at the end. */
+  int __catchingUp;
+
+  /* This is set while one of the methods is running without the
+     interpreter lock, so that another thread cannot use the reader at
+     the same time. */
+  int __busy;
+
+  /* If __keepStats is true, __cdgPacketProcess() keeps the statistics
+     returned by GetStats(), indexed by instruction code: how many of
+     each instruction there have been, the total time spent on them
+     in seconds, and how many 6x12 blocks they have marked dirty.
+     __blocksDirtied counts all of the blocks marked dirty so far. */
+  int __keepStats;
+  int __statCount[CDG_MASK + 1];
+  double __statTime[CDG_MASK + 1];
+  long __statDirtied[CDG_MASK + 1];
+  long __blocksDirtied;
+
   int __cdgColourTable[COLOUR_TABLE_SIZE];
+  Uint8 __cdgPalette[COLOUR_TABLE_SIZE][3];
   int __justClearedColourIndex;
   int __cdgPresetColourIndex;
   int __cdgBorderColourIndex;
@@ -116,23 +205,52 @@ typedef struct {
      integer blocks of 6x12 pixels) to perform
      one-pixel-at-a-time scrolls. */
   int __hOffset, __vOffset;
+
+  /* These values implement scrolling.  Rather than moving every
+     pixel on each scroll command, we treat the pixel arrays as
+     circular, and keep track of where the top-left corner of the CDG
+     screen currently lies within them.  A copy scroll then just moves
+     this origin, and a preset scroll moves it and fills in one strip.
+     The origin is always a multiple of 6 pixels horizontally and 12
+     pixels vertically, so each 6x12 block of the screen is also a
+     contiguous block of the arrays. */
+  int __hOrigin, __vOrigin;
   
-  /* This is an array of the pixel indices, including border area. */
+  /* This is an array of the pixel indices, including border area.
+     No array of the actual RGB values is kept: FillRect() looks each
+     pixel up in the colour table as it writes it to the caller's
+     surface, which is then the only copy of them. */
   unsigned char __cdgPixelColours[CDG_FULL_WIDTH][CDG_FULL_HEIGHT];
 
-  /* This is an array of the actual RGB values.  This will
-     be changed by the various commands, and blitted to the
-     screen now and again. But the border area will not be
-     blitted, only the central 288x192 area. */
-  Uint32 __cdgSurfarray[CDG_FULL_WIDTH][CDG_FULL_HEIGHT];
-
-  unsigned int __updatedTiles;
+  /* One flag for each 6x12 block of the CDG screen, which is set
+     when that block has changed.  These are screen positions, not
+     positions within the circular pixel arrays. */
+  unsigned char __dirtyBlocks[CDG_BLOCKS_HIGH][CDG_BLOCKS_WIDE];
+
+  /* The colour index at each screen position, and the colour table,
+     as they were at the last call to GetDirtyRects().  Streams often
+     paint a block with what is already there (or XOR it and XOR it
+     back again), so a dirty block isn't reported unless its colours
+     are now different from these.  __redrawAll is set when the whole
+     screen must be reported regardless. */
+  unsigned char __shownColours[CDG_FULL_WIDTH][CDG_FULL_HEIGHT];
+  Uint8 __shownPalette[COLOUR_TABLE_SIZE][3];
+  int __redrawAll;
 
 } CdgPacketReader;
 
 /* Forward prototypes for private methods defined within this module. */
+static int __checkNotBusy(CdgPacketReader *self);
+static double __statClock(void);
+static const char *__instructionName(int inst_code, char *buffer);
 static void do_rewind(CdgPacketReader *self);
+static int do_packets(CdgPacketReader *self, int numPackets);
+static int __getDirtyRects(CdgPacketReader *self, SDL_Rect *rects);
+static void __findChangedBlocks(CdgPacketReader *self);
+static void __fillArea(CdgPacketReader *self, SDL_Surface *surface,
+                       int x, int y, int w, int h, int dx, int dy);
 static int __getNextPacket(CdgPacketReader *self, CdgPacket *packd);
+static int __getNextCommand(CdgPacketReader *self, int endPos, CdgPacket *packd);
 static void __cdgPacketProcess(CdgPacketReader *self, CdgPacket *packd);
 static void __cdgMemoryPreset(CdgPacketReader *self, CdgPacket *packd);
 static void __cdgBorderPreset(CdgPacketReader *self, CdgPacket *packd);
@@ -163,6 +281,7 @@ CdgPacketReader_new(PyTypeObject *type, PyObject *args, PyObject *kwds) {
   if (self != NULL) {
     self->__cdgData = NULL;
     self->__mapperSurface = NULL;
+    self->__busy = 0;
   }
 
   return (PyObject *)self;
@@ -174,25 +293,46 @@ static int
 CdgPacketReader_init(CdgPacketReader *self, PyObject *args, PyObject *kwds) {
   /* Boilerplate code to extract the Python arguments passed in. */
 
-  static char *keyword_list[] = { "fileName", "mapperSurface", NULL };
+  static char *keyword_list[] = { "fileName", "mapperSurface", "usePalette",
+                                  "keepStats", NULL };
   char *data;
   int len;
   PyObject *mapperSurface;
+  int usePalette = 0;
+  int keepStats = 0;
   if (!PyArg_ParseTupleAndKeywords(args, kwds, 
-                                   "s#O:CdgPacketReader.__init__", 
+                                   "s#O|ii:CdgPacketReader.__init__", 
                                    keyword_list, &data, &len,
-                                   &mapperSurface)) {
+                                   &mapperSurface, &usePalette, &keepStats)) {
     return -1;
   }
 
   /* The actual function body begins here. */
 
+  if (!__checkNotBusy(self)) {
+    return -1;
+  }
   assert(self->__cdgData == NULL);
   self->__cdgData = (char *)malloc(len);
   memcpy(self->__cdgData, data, len);
   self->__cdgDataLen = len;
   self->__mapperSurface = PySurface_AsSurface(mapperSurface);
 
+  self->__cdgCompiled = (len >= 24 && memcmp(data, COMPILED_MAGIC, COMPILED_MAGIC_LEN) == 0);
+  if (self->__cdgCompiled) {
+    self->__cdgNumPackets = ((unsigned char)data[8] | ((unsigned char)data[9] << 8) |
+                             ((unsigned char)data[10] << 16) | ((unsigned char)data[11] << 24));
+    self->__cdgNumCommands = len / 24 - 1;
+  }
+  self->__usePalette = usePalette;
+  self->__catchingUp = 0;
+
+  self->__keepStats = keepStats;
+  memset(self->__statCount, 0, sizeof(self->__statCount));
+  memset(self->__statTime, 0, sizeof(self->__statTime));
+  memset(self->__statDirtied, 0, sizeof(self->__statDirtied));
+  self->__blocksDirtied = 0;
+
   do_rewind(self);
 
   return 0;
@@ -203,6 +343,10 @@ CdgPacketReader_init(CdgPacketReader *self, PyObject *args, PyObject *kwds) {
    again. */
 static PyObject *
 CdgPacketReader_Rewind(CdgPacketReader *self) {
+  if (!__checkNotBusy(self)) {
+    return NULL;
+  }
+
   do_rewind(self);
   Py_RETURN_NONE;
 }
@@ -211,48 +355,166 @@ CdgPacketReader_Rewind(CdgPacketReader *self) {
 static void
 do_rewind(CdgPacketReader *self) {
   int defaultColour;
+  int i;
 
   self->__cdgDataPos = 0;
+  self->__cdgCommandIndex = 0;
 
   defaultColour = 0;
   memset(self->__cdgColourTable, defaultColour, sizeof(int) * COLOUR_TABLE_SIZE);
+  memset(self->__cdgPalette, 0, sizeof(self->__cdgPalette));
+  if (self->__usePalette) {
+    /* Each colour index maps to itself on a palettized surface. */
+    for (i = 0; i < COLOUR_TABLE_SIZE; ++i) {
+      self->__cdgColourTable[i] = i;
+    }
+  }
   self->__justClearedColourIndex = -1;
   self->__cdgPresetColourIndex = -1;
   self->__cdgBorderColourIndex = -1;
 
   /* Support only one transparent colour */
   self->__cdgTransparentColour = -1;
+
+  self->__hOffset = 0;
+  self->__vOffset = 0;
+  self->__hOrigin = 0;
+  self->__vOrigin = 0;
     
   memset(self->__cdgPixelColours, 0, CDG_FULL_WIDTH * CDG_FULL_HEIGHT);
 
-  memset(self->__cdgSurfarray, 0, sizeof(Uint32) * CDG_FULL_WIDTH * CDG_FULL_HEIGHT);
-
   /* Start with all tiles requiring update */
-  self->__updatedTiles = 0xFFFFFFFF;
+  memset(self->__dirtyBlocks, 1, sizeof(self->__dirtyBlocks));
+  self->__redrawAll = 1;
+}
+
+/* The internal implementation of CdgPacketReader_DoPackets() and
+   CdgPacketReader_CatchUp().  Returns 1 on success, or 0 at the end
+   of the stream. */
+static int
+do_packets(CdgPacketReader *self, int numPackets) {
+  int i;
+  int endPos;
+  CdgPacket packd;
+
+  if (self->__cdgCompiled && numPackets > 0) {
+    /* A compiled stream holds only the packets that do something, so
+       we can go straight from each of those to the next. */
+    if (self->__cdgDataPos >= self->__cdgNumPackets * 24) {
+      /* No more packets. */
+      return 0;
+    }
+    endPos = self->__cdgDataPos + numPackets * 24;
+    if (endPos > self->__cdgNumPackets * 24) {
+      endPos = self->__cdgNumPackets * 24;
+    }
+    while (__getNextCommand(self, endPos, &packd)) {
+      __cdgPacketProcess(self, &packd);
+    }
+    self->__cdgDataPos = endPos;
+    return 1;
+  }
+
+  for (i = 0; i < numPackets; ++i) {
+    /* Extract the next packet */
+    if (!__getNextPacket(self, &packd)) {
+      /* No more packets.  Return False, but only if we
+         reached this condition on the first packet. */
+      return (i != 0);
+    }
+
+    __cdgPacketProcess(self, &packd);
+  }
+
+  return 1;
 }
 
-/* Marks all the tiles dirty, so that the next call to
-   GetDirtyTiles() will return the complete list of tiles. */
+/* Marks the whole screen dirty, so that the next call to
+   GetDirtyRects() or GetDirtyTiles() will return all of it. */
 static PyObject *
 CdgPacketReader_MarkTilesDirty(CdgPacketReader *self) {
-  self->__updatedTiles = 0xFFFFFFFF;
+  if (!__checkNotBusy(self)) {
+    return NULL;
+  }
+
+  self->__redrawAll = 1;
   Py_RETURN_NONE;
 }
 
+/* Returns a list of (x, y, w, h) tuples, in pixels within the
+   visible CDG_DISPLAY_WIDTH x CDG_DISPLAY_HEIGHT area, covering all
+   of the parts of the screen that have changed.  Then resets the
+   dirty area to empty. */
+static PyObject *
+CdgPacketReader_GetDirtyRects(CdgPacketReader *self) {
+  SDL_Rect rects[CDG_BLOCKS_WIDE * CDG_BLOCKS_HIGH];
+  int numRects;
+  int i;
+  PyObject *list;
+
+  if (!__checkNotBusy(self)) {
+    return NULL;
+  }
+
+  self->__busy = 1;
+  Py_BEGIN_ALLOW_THREADS
+  numRects = __getDirtyRects(self, rects);
+  Py_END_ALLOW_THREADS
+  self->__busy = 0;
+
+  list = PyList_New(numRects);
+  if (list == NULL) {
+    return NULL;
+  }
+
+  for (i = 0; i < numRects; ++i) {
+    PyList_SET_ITEM(list, i,
+                    Py_BuildValue("(iiii)", rects[i].x, rects[i].y,
+                                  rects[i].w, rects[i].h));
+  }
+
+  return list;
+}
+
 /* Returns a list of (row, col) tuples, corresponding to all
    of the currently-dirty tiles.  Then resets the list of dirty
    tiles to empty. */
 static PyObject *
 CdgPacketReader_GetDirtyTiles(CdgPacketReader *self) {
+  SDL_Rect rects[CDG_BLOCKS_WIDE * CDG_BLOCKS_HIGH];
+  int numRects;
+  int i;
+  unsigned int updatedTiles;
   int row, col;
   PyObject *tiles;
 
+  if (!__checkNotBusy(self)) {
+    return NULL;
+  }
+
+  self->__busy = 1;
+  Py_BEGIN_ALLOW_THREADS
+  numRects = __getDirtyRects(self, rects);
+  Py_END_ALLOW_THREADS
+  self->__busy = 0;
+
+  updatedTiles = 0;
+  for (i = 0; i < numRects; ++i) {
+    for (col = rects[i].y / TILE_HEIGHT;
+         col <= (rects[i].y + rects[i].h - 1) / TILE_HEIGHT; ++col) {
+      for (row = rects[i].x / TILE_WIDTH;
+           row <= (rects[i].x + rects[i].w - 1) / TILE_WIDTH; ++row) {
+        updatedTiles |= ((1 << row) << (col * 8));
+      }
+    }
+  }
+
   tiles = PyList_New(0);
 
-  if (self->__updatedTiles != 0) {
+  if (updatedTiles != 0) {
     for (col = 0; col < TILES_PER_COL; ++col) {
       for (row = 0; row < TILES_PER_ROW; ++row) {
-        if (self->__updatedTiles & ((1 << row) << (col * 8))) {
+        if (updatedTiles & ((1 << row) << (col * 8))) {
           PyObject *tuple = PyTuple_New(2);
           PyTuple_SET_ITEM(tuple, 0, PyInt_FromLong(row));
           PyTuple_SET_ITEM(tuple, 1, PyInt_FromLong(col));
@@ -263,16 +525,19 @@ CdgPacketReader_GetDirtyTiles(CdgPacketReader *self) {
     }
   }
 
-  self->__updatedTiles = 0;
-
   return tiles;
 }
 
 /* Returns the current border colour, as a mapped integer
-   ready to apply to the surface.  Returns None if the border
-   colour has not yet been specified by the CDG stream. */
+   ready to apply to the surface (or, in palette mode, as a colour
+   index).  Returns None if the border colour has not yet been
+   specified by the CDG stream. */
 static PyObject *
 CdgPacketReader_GetBorderColour(CdgPacketReader *self) {
+  if (!__checkNotBusy(self)) {
+    return NULL;
+  }
+
   if (self->__cdgBorderColourIndex == -1) {
     Py_RETURN_NONE;
   }
@@ -280,6 +545,108 @@ CdgPacketReader_GetBorderColour(CdgPacketReader *self) {
   return PyInt_FromLong(self->__cdgColourTable[self->__cdgBorderColourIndex]);
 }
 
+/* Returns the current colour table, as a list of 16 (r, g, b)
+   tuples suitable for passing to Surface.set_palette(). */
+static PyObject *
+CdgPacketReader_GetPalette(CdgPacketReader *self) {
+  int i;
+  PyObject *palette;
+
+  if (!__checkNotBusy(self)) {
+    return NULL;
+  }
+
+  palette = PyList_New(COLOUR_TABLE_SIZE);
+  if (palette == NULL) {
+    return NULL;
+  }
+
+  for (i = 0; i < COLOUR_TABLE_SIZE; ++i) {
+    PyList_SET_ITEM(palette, i,
+                    Py_BuildValue("(iii)", self->__cdgPalette[i][0],
+                                  self->__cdgPalette[i][1],
+                                  self->__cdgPalette[i][2]));
+  }
+
+  return palette;
+}
+
+/* Returns a snapshot of the decoder's current state, which may later
+   be passed to SetState() to return to this point in the stream.
+   Only the colour indices are saved; the RGB values are recomputed
+   from them when the snapshot is restored. */
+static PyObject *
+CdgPacketReader_GetState(CdgPacketReader *self) {
+  CdgState state;
+
+  if (!__checkNotBusy(self)) {
+    return NULL;
+  }
+
+  state.cdgDataPos = self->__cdgDataPos;
+  state.cdgCommandIndex = self->__cdgCommandIndex;
+  memcpy(state.cdgColourTable, self->__cdgColourTable, sizeof(state.cdgColourTable));
+  memcpy(state.cdgPalette, self->__cdgPalette, sizeof(state.cdgPalette));
+  state.justClearedColourIndex = self->__justClearedColourIndex;
+  state.cdgPresetColourIndex = self->__cdgPresetColourIndex;
+  state.cdgBorderColourIndex = self->__cdgBorderColourIndex;
+  state.cdgTransparentColour = self->__cdgTransparentColour;
+  state.hOffset = self->__hOffset;
+  state.vOffset = self->__vOffset;
+  state.hOrigin = self->__hOrigin;
+  state.vOrigin = self->__vOrigin;
+  memcpy(state.cdgPixelColours, self->__cdgPixelColours, sizeof(state.cdgPixelColours));
+
+  return PyString_FromStringAndSize((char *)&state, sizeof(state));
+}
+
+/* Restores the decoder to a state previously returned by GetState(),
+   and marks all the tiles dirty. */
+static PyObject *
+CdgPacketReader_SetState(CdgPacketReader *self, PyObject *args, PyObject *kwds) {
+  static char *keyword_list[] = { "state", NULL };
+  char *data;
+  int len;
+  CdgState state;
+
+  /* Boilerplate code to extract the Python arguments passed in. */
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, 
+                                   "s#:CdgPacketReader.SetState", 
+                                   keyword_list, &data, &len)) {
+    return NULL;
+  }
+
+  /* The actual function body begins here. */
+
+  if (!__checkNotBusy(self)) {
+    return NULL;
+  }
+  if (len != sizeof(state)) {
+    PyErr_SetString(PyExc_ValueError, "Not a CdgPacketReader state.");
+    return NULL;
+  }
+  memcpy(&state, data, sizeof(state));
+
+  self->__cdgDataPos = state.cdgDataPos;
+  self->__cdgCommandIndex = state.cdgCommandIndex;
+  memcpy(self->__cdgColourTable, state.cdgColourTable, sizeof(state.cdgColourTable));
+  memcpy(self->__cdgPalette, state.cdgPalette, sizeof(state.cdgPalette));
+  self->__justClearedColourIndex = state.justClearedColourIndex;
+  self->__cdgPresetColourIndex = state.cdgPresetColourIndex;
+  self->__cdgBorderColourIndex = state.cdgBorderColourIndex;
+  self->__cdgTransparentColour = state.cdgTransparentColour;
+  self->__hOffset = state.hOffset;
+  self->__vOffset = state.vOffset;
+  self->__hOrigin = state.hOrigin;
+  self->__vOrigin = state.vOrigin;
+  memcpy(self->__cdgPixelColours, state.cdgPixelColours, sizeof(state.cdgPixelColours));
+
+  self->__redrawAll = 1;
+
+  Py_RETURN_NONE;
+}
+
 /* Reads numPackets 24-byte packets from the CDG stream, and
    processes their instructions on the internal tables stored
    within this object.  Returns True on success, or False when
@@ -289,8 +656,7 @@ static PyObject *
 CdgPacketReader_DoPackets(CdgPacketReader *self, PyObject *args, PyObject *kwds) {
   static char *keyword_list[] = { "numPackets", NULL };
   int numPackets;
-  int i;
-  CdgPacket packd;
+  int result;
 
   /* Boilerplate code to extract the Python arguments passed in. */
 
@@ -302,22 +668,133 @@ CdgPacketReader_DoPackets(CdgPacketReader *self, PyObject *args, PyObject *kwds)
 
   /* The actual function body begins here. */
 
-  for (i = 0; i < numPackets; ++i) {
-    /* Extract the next packet */
-    if (!__getNextPacket(self, &packd)) {
-      /* No more packets.  Return False, but only if we
-         reached this condition on the first packet. */
-      if (i != 0) {
-        Py_RETURN_TRUE;
-      } else {
-        Py_RETURN_FALSE;
-      }
+  if (!__checkNotBusy(self)) {
+    return NULL;
+  }
+
+  self->__busy = 1;
+  Py_BEGIN_ALLOW_THREADS
+  result = do_packets(self, numPackets);
+  Py_END_ALLOW_THREADS
+  self->__busy = 0;
+
+  if (result) {
+    Py_RETURN_TRUE;
+  }
+  Py_RETURN_FALSE;
+}
+
+/* Does the same as DoPackets(), more quickly, for a long run of
+   packets with no screen update in between.  The dirty area is not
+   kept up to date as each command is processed; instead, the whole
+   screen is marked dirty at the end. */
+static PyObject *
+CdgPacketReader_CatchUp(CdgPacketReader *self, PyObject *args, PyObject *kwds) {
+  static char *keyword_list[] = { "numPackets", NULL };
+  int numPackets;
+  int result;
+
+  /* Boilerplate code to extract the Python arguments passed in. */
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, 
+                                   "i:CdgPacketReader.CatchUp", 
+                                   keyword_list, &numPackets)) {
+    return NULL;
+  }
+
+  /* The actual function body begins here. */
+
+  if (!__checkNotBusy(self)) {
+    return NULL;
+  }
+
+  self->__busy = 1;
+  Py_BEGIN_ALLOW_THREADS
+  self->__catchingUp = 1;
+  result = do_packets(self, numPackets);
+  self->__catchingUp = 0;
+  self->__redrawAll = 1;
+  Py_END_ALLOW_THREADS
+  self->__busy = 0;
+
+  if (result) {
+    Py_RETURN_TRUE;
+  }
+  Py_RETURN_FALSE;
+}
+
+/* Returns the position in the stream (in packets) of the next CDG
+   command that DoPackets() will process, or None if there are no
+   more. */
+static PyObject *
+CdgPacketReader_GetNextCommandPos(CdgPacketReader *self) {
+  unsigned char *record;
+  int pos;
+
+  if (!__checkNotBusy(self)) {
+    return NULL;
+  }
+
+  if (self->__cdgCompiled) {
+    if (self->__cdgCommandIndex >= self->__cdgNumCommands) {
+      Py_RETURN_NONE;
     }
+    record = (unsigned char *)self->__cdgData + 24 * (self->__cdgCommandIndex + 1);
+    pos = record[20] | (record[21] << 8) | (record[22] << 16) | (record[23] << 24);
+    return PyInt_FromLong(pos);
+  }
 
-    __cdgPacketProcess(self, &packd);
+  for (pos = self->__cdgDataPos; self->__cdgDataLen - pos >= 24; pos += 24) {
+    if ((self->__cdgData[pos] & CDG_MASK) == CDG_COMMAND) {
+      return PyInt_FromLong(pos / 24);
+    }
+  }
+  Py_RETURN_NONE;
+}
+
+/* If the reader was made with keepStats true, returns a dictionary
+   with an entry for each type of CDG instruction processed so far,
+   mapping its name to a tuple of (count, total seconds, re-maps of
+   the whole screen, 6x12 blocks marked dirty).  This module never
+   re-maps the whole screen (see FillRect()), so there is nothing to
+   count, and the re-maps are given as None.  Otherwise, returns
+   None. */
+static PyObject *
+CdgPacketReader_GetStats(CdgPacketReader *self) {
+  PyObject *stats;
+  PyObject *value;
+  char buffer[32];
+  int i;
+
+  if (!__checkNotBusy(self)) {
+    return NULL;
+  }
+
+  if (!self->__keepStats) {
+    Py_RETURN_NONE;
   }
 
-  Py_RETURN_TRUE;
+  stats = PyDict_New();
+  if (stats == NULL) {
+    return NULL;
+  }
+
+  for (i = 0; i <= CDG_MASK; ++i) {
+    if (self->__statCount[i] == 0) {
+      continue;
+    }
+    value = Py_BuildValue("(idOl)", self->__statCount[i], self->__statTime[i],
+                          Py_None, self->__statDirtied[i]);
+    if (value == NULL ||
+        PyDict_SetItemString(stats, __instructionName(i, buffer), value) < 0) {
+      Py_XDECREF(value);
+      Py_DECREF(stats);
+      return NULL;
+    }
+    Py_DECREF(value);
+  }
+
+  return stats;
 }
 
 /* Fills in the pixels on the indicated one-tile surface
@@ -329,13 +806,6 @@ CdgPacketReader_FillTile(CdgPacketReader *self, PyObject *args, PyObject *kwds)
   PyObject *py_surface;
   int row, col;
   SDL_Surface *surface;
-  int row_start, row_end, col_start, col_end;
-  int ri, ci;
-  int pitch;
-  Uint8 *start;
-  Uint8 *pixels8;
-  Uint16 *pixels16;
-  Uint32 *pixels32;
 
   /* Boilerplate code to extract the Python arguments passed in. */
 
@@ -350,14 +820,314 @@ CdgPacketReader_FillTile(CdgPacketReader *self, PyObject *args, PyObject *kwds)
 
   /* The actual function body begins here. */
 
+  if (!__checkNotBusy(self)) {
+    return NULL;
+  }
+
+  self->__busy = 1;
+  Py_BEGIN_ALLOW_THREADS
+  __fillArea(self, surface, row * TILE_WIDTH, col * TILE_HEIGHT,
+             TILE_WIDTH, TILE_HEIGHT, 0, 0);
+  Py_END_ALLOW_THREADS
+  self->__busy = 0;
+
+  Py_RETURN_NONE;
+}
+
+/* Fills in the pixels within the indicated (x, y, w, h) rectangle of
+   the visible area, as returned by GetDirtyRects(), onto the
+   indicated surface, with its top-left corner at pos.  If pos is
+   omitted, the pixels go at the same position on the surface (which
+   then must be a CDG_DISPLAY_WIDTH x CDG_DISPLAY_HEIGHT sized
+   surface). */
+static PyObject *
+CdgPacketReader_FillRect(CdgPacketReader *self, PyObject *args, PyObject *kwds) {
+  static char *keyword_list[] = { "surface", "rect", "pos", NULL };
+  PyObject *py_surface;
+  PyObject *pos = Py_None;
+  int x, y, w, h;
+  int dx, dy;
+  SDL_Surface *surface;
+
+  /* Boilerplate code to extract the Python arguments passed in. */
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, 
+                                   "O(iiii)|O:CdgPacketReader.FillRect", 
+                                   keyword_list, &py_surface,
+                                   &x, &y, &w, &h, &pos)) {
+    return NULL;
+  }
+  dx = x;
+  dy = y;
+  if (pos != Py_None &&
+      !PyArg_Parse(pos, "(ii);pos must be an (x, y) pair", &dx, &dy)) {
+    return NULL;
+  }
+
+  surface = PySurface_AsSurface(py_surface);
+
+  /* The actual function body begins here. */
+
+  if (!__checkNotBusy(self)) {
+    return NULL;
+  }
+
+  self->__busy = 1;
+  Py_BEGIN_ALLOW_THREADS
+  __fillArea(self, surface, x, y, w, h, dx, dy);
+  Py_END_ALLOW_THREADS
+  self->__busy = 0;
+
+  Py_RETURN_NONE;
+}
+
+
+/*  The remaining methods are all private; they are not part of the
+    public interface.  As such, there's no need to wrap any of these
+    with the klunky Python calling interface. */
+
+/* Returns true if the reader is free to use.  If another thread is
+   using it (see the comment at the top of this module), sets a
+   RuntimeError and returns false.  This is only ever called with the
+   interpreter lock held, so there's no race on __busy itself. */
+static int
+__checkNotBusy(CdgPacketReader *self) {
+  if (self->__busy) {
+    PyErr_SetString(PyExc_RuntimeError,
+                    "CdgPacketReader is in use by another thread.");
+    return 0;
+  }
+  return 1;
+}
+
+/* Returns the time now in seconds, from the most precise clock
+   available, for the statistics kept by __cdgPacketProcess(). */
+static double
+__statClock(void) {
+#if defined(_WIN32)
+  LARGE_INTEGER count, frequency;
+  QueryPerformanceCounter(&count);
+  QueryPerformanceFrequency(&frequency);
+  return (double)count.QuadPart / (double)frequency.QuadPart;
+#elif defined(CLOCK_MONOTONIC)
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec + ts.tv_nsec * 1e-9;
+#else
+  struct timeval tv;
+  gettimeofday(&tv, NULL);
+  return tv.tv_sec + tv.tv_usec * 1e-6;
+#endif
+}
+
+/* Returns the name of the indicated CDG instruction, as used by
+   GetStats().  buffer is used for the name of an unknown
+   instruction. */
+static const char *
+__instructionName(int inst_code, char *buffer) {
+  switch (inst_code) {
+  case CDG_INST_MEMORY_PRESET:
+    return "MEMORY_PRESET";
+  case CDG_INST_BORDER_PRESET:
+    return "BORDER_PRESET";
+  case CDG_INST_TILE_BLOCK:
+    return "TILE_BLOCK";
+  case CDG_INST_SCROLL_PRESET:
+    return "SCROLL_PRESET";
+  case CDG_INST_SCROLL_COPY:
+    return "SCROLL_COPY";
+  case CDG_INST_DEF_TRANSP_COL:
+    return "DEF_TRANSP_COL";
+  case CDG_INST_LOAD_COL_TBL_0_7:
+    return "LOAD_COL_TBL_0_7";
+  case CDG_INST_LOAD_COL_TBL_8_15:
+    return "LOAD_COL_TBL_8_15";
+  case CDG_INST_TILE_BLOCK_XOR:
+    return "TILE_BLOCK_XOR";
+  }
+  sprintf(buffer, "UNKNOWN_%d", inst_code);
+  return buffer;
+}
+
+/* Fills rects with the rectangles of the visible area that have
+   changed, and resets the dirty area to empty.  Returns the number of
+   rectangles. */
+static int
+__getDirtyRects(CdgPacketReader *self, SDL_Rect *rects) {
+  /* For each rectangle, the range of blocks it covers. */
+  int x0[CDG_BLOCKS_WIDE * CDG_BLOCKS_HIGH], x1[CDG_BLOCKS_WIDE * CDG_BLOCKS_HIGH];
+  int y0[CDG_BLOCKS_WIDE * CDG_BLOCKS_HIGH], y1[CDG_BLOCKS_WIDE * CDG_BLOCKS_HIGH];
+  int numRects;
+  /* The rectangles that reached the previous row, and the ones that
+     reach this row. */
+  int prevOpen[CDG_BLOCKS_WIDE], thisOpen[CDG_BLOCKS_WIDE];
+  int numPrevOpen, numThisOpen;
+  int firstX, lastX, firstY, lastY;
+  int bx, by, runStart;
+  int i, j;
+
+  /* The range of blocks that are at least partly visible. */
+  firstX = (6 + self->__hOffset) / BLOCK_WIDTH;
+  lastX = (6 + self->__hOffset + CDG_DISPLAY_WIDTH - 1) / BLOCK_WIDTH;
+  firstY = (12 + self->__vOffset) / BLOCK_HEIGHT;
+  lastY = (12 + self->__vOffset + CDG_DISPLAY_HEIGHT - 1) / BLOCK_HEIGHT;
+
+  __findChangedBlocks(self);
+
+  /* Find the runs of dirty blocks along each row, and merge each run
+     with the same run on the row above, if there is one. */
+  numRects = 0;
+  numPrevOpen = 0;
+  for (by = firstY; by <= lastY; ++by) {
+    numThisOpen = 0;
+    bx = firstX;
+    while (bx <= lastX) {
+      if (!self->__dirtyBlocks[by][bx]) {
+        ++bx;
+        continue;
+      }
+      runStart = bx;
+      while (bx <= lastX && self->__dirtyBlocks[by][bx]) {
+        ++bx;
+      }
+
+      for (j = 0; j < numPrevOpen; ++j) {
+        i = prevOpen[j];
+        if (x0[i] == runStart && x1[i] == bx) {
+          break;
+        }
+      }
+      if (j < numPrevOpen) {
+        /* Extend the rectangle from the row above. */
+        y1[i] = by + 1;
+      } else {
+        i = numRects++;
+        x0[i] = runStart;
+        x1[i] = bx;
+        y0[i] = by;
+        y1[i] = by + 1;
+      }
+      thisOpen[numThisOpen++] = i;
+    }
+
+    memcpy(prevOpen, thisOpen, sizeof(int) * numThisOpen);
+    numPrevOpen = numThisOpen;
+  }
+
+  memset(self->__dirtyBlocks, 0, sizeof(self->__dirtyBlocks));
+
+  /* Convert the blocks to pixels on the visible area. */
+  for (i = 0; i < numRects; ++i) {
+    x0[i] = x0[i] * BLOCK_WIDTH - 6 - self->__hOffset;
+    x1[i] = x1[i] * BLOCK_WIDTH - 6 - self->__hOffset;
+    y0[i] = y0[i] * BLOCK_HEIGHT - 12 - self->__vOffset;
+    y1[i] = y1[i] * BLOCK_HEIGHT - 12 - self->__vOffset;
+    if (x0[i] < 0) x0[i] = 0;
+    if (x1[i] > CDG_DISPLAY_WIDTH) x1[i] = CDG_DISPLAY_WIDTH;
+    if (y0[i] < 0) y0[i] = 0;
+    if (y1[i] > CDG_DISPLAY_HEIGHT) y1[i] = CDG_DISPLAY_HEIGHT;
+
+    rects[i].x = x0[i];
+    rects[i].y = y0[i];
+    rects[i].w = x1[i] - x0[i];
+    rects[i].h = y1[i] - y0[i];
+  }
+
+  return numRects;
+}
+
+/* Clears the flags in __dirtyBlocks for the blocks whose colours are
+   the same as when they were last shown (or sets all of them, if
+   __redrawAll is set).  Then brings __shownColours and
+   __shownPalette up to date. */
+static void
+__findChangedBlocks(CdgPacketReader *self) {
+  unsigned char changedColours[COLOUR_TABLE_SIZE];
+  unsigned char colour;
+  int changed;
+  int bx, by, x, y, sx, sy;
+  int ri, ci;
+  int i;
+
+  for (i = 0; i < COLOUR_TABLE_SIZE; ++i) {
+    changedColours[i] = (memcmp(self->__cdgPalette[i], self->__shownPalette[i], 3) != 0);
+  }
+
+  for (by = 0; by < CDG_BLOCKS_HIGH; ++by) {
+    for (bx = 0; bx < CDG_BLOCKS_WIDE; ++bx) {
+      if (!self->__redrawAll && !self->__dirtyBlocks[by][bx]) {
+        continue;
+      }
+
+      /* The block's position on the screen, and within the circular
+         pixel array. */
+      sx = bx * BLOCK_WIDTH;
+      sy = by * BLOCK_HEIGHT;
+      x = (sx + self->__hOrigin) % CDG_FULL_WIDTH;
+      y = (sy + self->__vOrigin) % CDG_FULL_HEIGHT;
+
+      changed = self->__redrawAll;
+      for (ri = 0; ri < BLOCK_WIDTH; ++ri) {
+        for (ci = 0; ci < BLOCK_HEIGHT; ++ci) {
+          colour = self->__cdgPixelColours[x + ri][y + ci];
+          if (colour != self->__shownColours[sx + ri][sy + ci] || changedColours[colour]) {
+            self->__shownColours[sx + ri][sy + ci] = colour;
+            changed = 1;
+          }
+        }
+      }
+      self->__dirtyBlocks[by][bx] = changed;
+    }
+  }
+
+  memcpy(self->__shownPalette, self->__cdgPalette, sizeof(self->__shownPalette));
+  self->__redrawAll = 0;
+}
+
+/* Copies the pixels within the indicated (x, y, w, h) rectangle of
+   the visible area to (dx, dy) on the indicated surface. */
+static void
+__fillArea(CdgPacketReader *self, SDL_Surface *surface,
+           int x, int y, int w, int h, int dx, int dy) {
+  int row_start, row_end, col_start, col_end;
+  int ri, ci;
+  int xs[CDG_DISPLAY_WIDTH];
+  int *table;
+  int pitch;
+  Uint8 *start;
+  Uint8 *pixels8;
+  Uint16 *pixels16;
+  Uint32 *pixels32;
+
+  /* Don't write outside the visible area, or off the surface. */
+  if (x < 0 || y < 0 || dx < 0 || dy < 0) {
+    return;
+  }
+  if (w > CDG_DISPLAY_WIDTH - x) w = CDG_DISPLAY_WIDTH - x;
+  if (h > CDG_DISPLAY_HEIGHT - y) h = CDG_DISPLAY_HEIGHT - y;
+  if (w > surface->w - dx) w = surface->w - dx;
+  if (h > surface->h - dy) h = surface->h - dy;
+  if (w <= 0 || h <= 0) {
+    return;
+  }
+
   /* Calculate the row & column starts/ends */
-  row_start = 6 + self->__hOffset + (row * TILE_WIDTH);
-  row_end = 6 + self->__hOffset + ((row + 1) * TILE_WIDTH);
-  col_start = 12 + self->__vOffset + (col * TILE_HEIGHT);
-  col_end = 12 + self->__vOffset + ((col + 1) * TILE_HEIGHT);
+  row_start = 6 + self->__hOffset + x;
+  row_end = row_start + w;
+  col_start = 12 + self->__vOffset + y;
+  col_end = col_start + h;
+
+  /* Find the area's pixel columns within the circular pixel arrays,
+     allowing for the area to wrap around the edge. */
+  x = (row_start + self->__hOrigin) % CDG_FULL_WIDTH;
+  for (ri = row_start; ri < row_end; ++ri) {
+    xs[ri - row_start] = x;
+    if (++x == CDG_FULL_WIDTH) {
+      x = 0;
+    }
+  }
 
   SDL_LockSurface(surface);
-  start = (Uint8 *)surface->pixels;
 
   /* Very important to cast surface->pitch to a Uint16: only the
      low-order 16 bits are significant, and the high-order bits might
@@ -366,14 +1136,22 @@ CdgPacketReader_FillTile(CdgPacketReader *self, PyObject *args, PyObject *kwds)
      wrong SDL version can cause a serious, hard-to-detect problem
      here, so don't take chances.) */
   pitch = (Uint16)surface->pitch;
+  start = (Uint8 *)surface->pixels + dy * pitch +
+    dx * surface->format->BytesPerPixel;
+
+  /* Each pixel's value is looked up in the colour table as it is
+     written.  (In palette mode, the table maps each colour index to
+     itself.) */
+  table = self->__cdgColourTable;
 
   switch (surface->format->BytesPerPixel) {
   case 1:
     for (ci = col_start; ci < col_end; ++ci) {
       pixels8 = start;
       start += pitch;
-      for (ri = row_start; ri < row_end; ++ri) {
-        (*pixels8++) = self->__cdgSurfarray[ri][ci];
+      y = (ci + self->__vOrigin) % CDG_FULL_HEIGHT;
+      for (ri = 0; ri < w; ++ri) {
+        (*pixels8++) = table[self->__cdgPixelColours[xs[ri]][y]];
       }
     }
     break;
@@ -382,8 +1160,9 @@ CdgPacketReader_FillTile(CdgPacketReader *self, PyObject *args, PyObject *kwds)
     for (ci = col_start; ci < col_end; ++ci) {
       pixels16 = (Uint16 *)start;
       start += pitch;
-      for (ri = row_start; ri < row_end; ++ri) {
-        (*pixels16++) = self->__cdgSurfarray[ri][ci];
+      y = (ci + self->__vOrigin) % CDG_FULL_HEIGHT;
+      for (ri = 0; ri < w; ++ri) {
+        (*pixels16++) = table[self->__cdgPixelColours[xs[ri]][y]];
       }
     }
     break;
@@ -392,8 +1171,9 @@ CdgPacketReader_FillTile(CdgPacketReader *self, PyObject *args, PyObject *kwds)
     for (ci = col_start; ci < col_end; ++ci) {
       pixels32 = (Uint32 *)start;
       start += pitch;
-      for (ri = row_start; ri < row_end; ++ri) {
-        (*pixels32++) = self->__cdgSurfarray[ri][ci];
+      y = (ci + self->__vOrigin) % CDG_FULL_HEIGHT;
+      for (ri = 0; ri < w; ++ri) {
+        (*pixels32++) = table[self->__cdgPixelColours[xs[ri]][y]];
       }
     }
     break;
@@ -402,16 +1182,9 @@ CdgPacketReader_FillTile(CdgPacketReader *self, PyObject *args, PyObject *kwds)
     fprintf(stderr, "No code to fill %d-byte pixels.\n", surface->format->BytesPerPixel);
   }
   SDL_UnlockSurface(surface);
-
-  Py_RETURN_NONE;
 }
 
 
-/*  The remaining methods are all private; they are not part of the
-    public interface.  As such, there's no need to wrap any of these
-    with the klunky Python calling interface. */
-
-
 /* Read the next CDG command from the file (24 bytes each) */
 static int
 __getNextPacket(CdgPacketReader *self, CdgPacket *packd) {
@@ -428,13 +1201,44 @@ __getNextPacket(CdgPacketReader *self, CdgPacket *packd) {
   return 1;
 }
 
+/* Reads the next packet from a compiled stream, if it comes before
+   endPos (in bytes) in the original stream.  Returns 1 on success, or
+   0 if there is no such packet. */
+static int
+__getNextCommand(CdgPacketReader *self, int endPos, CdgPacket *packd) {
+  unsigned char *record;
+  int pos;
+
+  if (self->__cdgCommandIndex >= self->__cdgNumCommands) {
+    return 0;
+  }
+
+  record = (unsigned char *)self->__cdgData + 24 * (self->__cdgCommandIndex + 1);
+  pos = record[20] | (record[21] << 8) | (record[22] << 16) | (record[23] << 24);
+  if (pos * 24 >= endPos) {
+    return 0;
+  }
+
+  memcpy(packd, record, 24);
+  ++self->__cdgCommandIndex;
+
+  return 1;
+}
+
 /* Decode and perform the CDG commands in the indicated packet. */
 static void
 __cdgPacketProcess(CdgPacketReader *self, CdgPacket *packd) {
   int inst_code;
+  double start = 0.0;
+  long dirtied = 0;
 
   if ((packd->command & CDG_MASK) == CDG_COMMAND) {
     inst_code = (packd->instruction & CDG_MASK);
+    if (self->__keepStats) {
+      start = __statClock();
+      dirtied = self->__blocksDirtied;
+    }
+
     switch (inst_code) {
     case CDG_INST_MEMORY_PRESET:
       __cdgMemoryPreset(self, packd);
@@ -476,6 +1280,12 @@ __cdgPacketProcess(CdgPacketReader *self, CdgPacket *packd) {
       /* Don't use the error popup, ignore the unsupported command */
       fprintf(stderr, "CDG file may be corrupt, cmd: %d\n", inst_code);
     }
+
+    if (self->__keepStats) {
+      self->__statCount[inst_code]++;
+      self->__statTime[inst_code] += __statClock() - start;
+      self->__statDirtied[inst_code] += self->__blocksDirtied - dirtied;
+    }
   }
 }
 
@@ -483,8 +1293,6 @@ __cdgPacketProcess(CdgPacketReader *self, CdgPacket *packd) {
 static void
 __cdgMemoryPreset(CdgPacketReader *self, CdgPacket *packd) {
   int colour;
-  int ri, ci;
-  Uint32 presetColour;
 
   colour = packd->data[0] & 0x0F;
   /* repeat = packd->data[1] & 0x0F; */
@@ -512,28 +1320,21 @@ __cdgMemoryPreset(CdgPacketReader *self, CdgPacket *packd) {
   self->__cdgPresetColourIndex = colour;
   self->__cdgBorderColourIndex = self->__cdgPresetColourIndex;
 
-  /* Note that this may be done before any load colour table
-     commands by some CDGs. So the load colour table itself
-     actual recalculates the RGB values for all pixels when
-     the colour table changes. */
-
-  presetColour = self->__cdgColourTable[colour];
+  /* Since every pixel is being set, this is a good time to put the
+     scroll origin back where it started. */
+  self->__hOrigin = 0;
+  self->__vOrigin = 0;
 
-  /* Set the preset colour for every pixel. Must be stored in 
-     the pixel colour table indeces array, as well as
-     the screen RGB surfarray. */
+  /* Set the preset colour for every pixel.  Only the colour indices
+     are stored; note that this may be done before any load colour
+     table commands by some CDGs, so the RGB values are not looked up
+     until FillRect() draws the pixels. */
 
-  /* Also set the border and preset colour in our local surfarray.
-     This will be blitted next time there is a screen update. */
-
-  for (ri = 0; ri < CDG_FULL_WIDTH; ++ri) {
-    for (ci = 0; ci < CDG_FULL_HEIGHT; ++ci) {
-      self->__cdgPixelColours[ri][ci] = colour;
-      self->__cdgSurfarray[ri][ci] = presetColour;
-    }
+  memset(self->__cdgPixelColours, colour, sizeof(self->__cdgPixelColours));
+  if (!self->__catchingUp) {
+    memset(self->__dirtyBlocks, 1, sizeof(self->__dirtyBlocks));
+    self->__blocksDirtied += CDG_NUM_BLOCKS;
   }
-
-  self->__updatedTiles = 0xFFFFFFFF;
 }
 
 /* Set the border colour */
@@ -541,7 +1342,7 @@ static void
 __cdgBorderPreset(CdgPacketReader *self, CdgPacket *packd) {
   int colour;
   int ri, ci;
-  Uint32 borderColour;
+  int top, bottom, left, right;
 
   colour = packd->data[0] & 0x0F;
   if (colour == self->__cdgBorderColourIndex) {
@@ -553,31 +1354,42 @@ __cdgBorderPreset(CdgPacketReader *self, CdgPacket *packd) {
   /* See __cdgMemoryPreset() for a description of what's going on.
      In this case we are only clearing the border area. */
 
-  borderColour = self->__cdgColourTable[colour];
-
   /* NOTE: The border area is everything left and above (6,12), and
-     everything right and below the bottom (6,12). */
+     everything right and below the bottom (6,12).  These strips are
+     found relative to the scroll origin; the left and right strips
+     are set for the full height, which includes the corners already
+     covered by the top and bottom strips. */
+
+  top = self->__vOrigin;
+  bottom = (self->__vOrigin + CDG_FULL_HEIGHT - 12) % CDG_FULL_HEIGHT;
+  left = self->__hOrigin;
+  right = (self->__hOrigin + CDG_FULL_WIDTH - 6) % CDG_FULL_WIDTH;
 
   for (ri = 0; ri < CDG_FULL_WIDTH; ++ri) {
-    for (ci = 0; ci < 12; ++ci) {
+    for (ci = top; ci < top + 12; ++ci) {
       self->__cdgPixelColours[ri][ci] = colour;
-      self->__cdgSurfarray[ri][ci] = borderColour;
     }
-    for (ci = CDG_FULL_HEIGHT - 12; ci < CDG_FULL_HEIGHT; ++ci) {
+    for (ci = bottom; ci < bottom + 12; ++ci) {
       self->__cdgPixelColours[ri][ci] = colour;
-      self->__cdgSurfarray[ri][ci] = borderColour;
     }
   }
-  for (ci = 12; ci < CDG_FULL_HEIGHT - 12; ++ci) {
-    for (ri = 0; ri < 6; ++ri) {
+  for (ci = 0; ci < CDG_FULL_HEIGHT; ++ci) {
+    for (ri = left; ri < left + 6; ++ri) {
       self->__cdgPixelColours[ri][ci] = colour;
-      self->__cdgSurfarray[ri][ci] = borderColour;
     }
-    for (ri = CDG_FULL_WIDTH - 6; ri < CDG_FULL_WIDTH; ++ri) {
+    for (ri = right; ri < right + 6; ++ri) {
       self->__cdgPixelColours[ri][ci] = colour;
-      self->__cdgSurfarray[ri][ci] = borderColour;
     }
   }
+
+  /* The strips are the outermost blocks of the screen. */
+  memset(self->__dirtyBlocks[0], 1, CDG_BLOCKS_WIDE);
+  memset(self->__dirtyBlocks[CDG_BLOCKS_HIGH - 1], 1, CDG_BLOCKS_WIDE);
+  for (ri = 0; ri < CDG_BLOCKS_HIGH; ++ri) {
+    self->__dirtyBlocks[ri][0] = 1;
+    self->__dirtyBlocks[ri][CDG_BLOCKS_WIDE - 1] = 1;
+  }
+  self->__blocksDirtied += 2 * CDG_BLOCKS_WIDE + 2 * (CDG_BLOCKS_HIGH - 2);
 }
 
 /* CDG Scroll Command - Set the scrolled in area with a fresh colour */
@@ -597,9 +1409,8 @@ static void
 __cdgScrollCommon(CdgPacketReader *self, CdgPacket *packd, int copy) {
   int colour, hScroll, vScroll, hSCmd, hOffset, vSCmd, vOffset;
   int vScrollPixels, hScrollPixels;
-  int vInc, hInc;
   int ri, ci;
-  unsigned char temp[CDG_FULL_WIDTH][CDG_FULL_HEIGHT];
+  int x, y;
 
   /* Decode the scroll command parameters */
   colour = packd->data[0] & 0x0F;
@@ -630,7 +1441,7 @@ __cdgScrollCommon(CdgPacketReader *self, CdgPacket *packd, int copy) {
     /* Changing the screen shift. */
     self->__hOffset = hOffset < 5 ? hOffset : 5;
     self->__vOffset = vOffset < 11 ? vOffset : 11;
-    self->__updatedTiles = 0xFFFFFFFFL;
+    self->__redrawAll = 1;
   }
 
   if (hScrollPixels == 0 && vScrollPixels == 0) {
@@ -638,66 +1449,51 @@ __cdgScrollCommon(CdgPacketReader *self, CdgPacket *packd, int copy) {
     return;
   }
 
-  /* Perform the actual scroll. */
-
-  /* For the circular add, we add hScrollPixels and then modulo
-     CDG_FULL_WIDTH.  We also add CDG_FULL_WIDTH before the modulo to
-     avoid a negative increment (which doesn't work properly with the
-     C modulo operator).  A similar story in the vertical direction. */
-  hInc = hScrollPixels + CDG_FULL_WIDTH;
-  vInc = vScrollPixels + CDG_FULL_HEIGHT;
-  for (ri = 0; ri < CDG_FULL_WIDTH; ++ri) {
-    for (ci = 0; ci < CDG_FULL_HEIGHT; ++ci) {
-      temp[(ri + hInc) % CDG_FULL_WIDTH][(ci + vInc) % CDG_FULL_HEIGHT] = 
-        self->__cdgPixelColours[ri][ci];
-    }
-  }
+  /* Perform the actual scroll.  The pixel arrays are circular, so
+     this is just a move of the scroll origin.  We add CDG_FULL_WIDTH
+     before the modulo to avoid a negative result (which the C modulo
+     operator doesn't handle the way we want).  A similar story in the
+     vertical direction. */
+  self->__hOrigin = (self->__hOrigin - hScrollPixels + CDG_FULL_WIDTH) % CDG_FULL_WIDTH;
+  self->__vOrigin = (self->__vOrigin - vScrollPixels + CDG_FULL_HEIGHT) % CDG_FULL_HEIGHT;
 
   /* We just performed a circular scroll: the pixels that scrolled off
-     the side were copied back in on the opposite side.  But if copy
-     is false, we were supposed to fill in the new pixels with a new
-     colour.  Go back and do that now. */
+     the side are now back in on the opposite side.  But if copy is
+     false, we were supposed to fill in the new pixels with a new
+     colour.  Go back and do that now.  Since the origin moves in
+     whole 6x12 blocks, each of these strips is contiguous within the
+     pixel arrays. */
   if (!copy) {
-    if (vScrollPixels > 0) {
-      for (ri = 0; ri < CDG_FULL_WIDTH; ++ri) {
-        for (ci = 0; ci < vScrollPixels; ++ci) {
-          temp[ri][ci] = colour;
-        }
+    if (vScrollPixels != 0) {
+      if (vScrollPixels > 0) {
+        y = self->__vOrigin;
+      } else {
+        y = (self->__vOrigin + CDG_FULL_HEIGHT + vScrollPixels) % CDG_FULL_HEIGHT;
       }
-    } else if (vScrollPixels < 0) {
       for (ri = 0; ri < CDG_FULL_WIDTH; ++ri) {
-        for (ci = CDG_FULL_HEIGHT + vScrollPixels; ci < CDG_FULL_HEIGHT; ++ci) {
-          temp[ri][ci] = colour;
+        for (ci = y; ci < y + 12; ++ci) {
+          self->__cdgPixelColours[ri][ci] = colour;
         }
       }
     }
-    if (hScrollPixels > 0) {
-      for (ri = 0; ri < hScrollPixels; ++ri) {
-        for (ci = 0; ci < CDG_FULL_HEIGHT; ++ci) {
-          temp[ri][ci] = colour;
-        }
+    if (hScrollPixels != 0) {
+      if (hScrollPixels > 0) {
+        x = self->__hOrigin;
+      } else {
+        x = (self->__hOrigin + CDG_FULL_WIDTH + hScrollPixels) % CDG_FULL_WIDTH;
       }
-    } else if (hScrollPixels < 0) {
-      for (ri = CDG_FULL_WIDTH + hScrollPixels; ri < CDG_FULL_WIDTH; ++ri) {
+      for (ri = x; ri < x + 6; ++ri) {
         for (ci = 0; ci < CDG_FULL_HEIGHT; ++ci) {
-          temp[ri][ci] = colour;
+          self->__cdgPixelColours[ri][ci] = colour;
         }
       }
     }
   }
 
-  /* Now copy the temporary buffer back to our array, and also apply
-     that to cdgSurfarray by reapplying the colour indices. */
-  for (ri = 0; ri < CDG_FULL_WIDTH; ++ri) {
-    for (ci = 0; ci < CDG_FULL_HEIGHT; ++ci) {
-      self->__cdgPixelColours[ri][ci] = temp[ri][ci];
-      self->__cdgSurfarray[ri][ci] = self->__cdgColourTable[temp[ri][ci]];
-    }
-  }
-
-  /* We have modified our local cdgSurfarray. This will be blitted to
-     the screen by cdgDisplayUpdate(). */
-  self->__updatedTiles = 0xFFFFFFFF;
+  /* The whole screen has moved.  It will be drawn again by the next
+     FillRect() calls. */
+  memset(self->__dirtyBlocks, 1, sizeof(self->__dirtyBlocks));
+  self->__blocksDirtied += CDG_NUM_BLOCKS;
 }
 
 /* Set one of the colour indeces as transparent. Don't actually do
@@ -715,7 +1511,7 @@ __cdgLoadColourTableCommon(CdgPacketReader *self, CdgPacket *packd, int table) {
   int i;
   int colourEntry;
   int red, green, blue;
-  int ri, ci;
+  Uint8 colours[8][3];
 
   if (table == 0) {
     colourTableStart = 0;
@@ -732,30 +1528,46 @@ __cdgLoadColourTableCommon(CdgPacketReader *self, CdgPacket *packd, int table) {
     green = ((colourEntry & 0x00F0) >> 4) * 17;
     blue = ((colourEntry & 0x000F)) * 17;
 
-    self->__cdgColourTable[i + colourTableStart] = SDL_MapRGB(self->__mapperSurface->format, red, green, blue);
+    colours[i][0] = red;
+    colours[i][1] = green;
+    colours[i][2] = blue;
   }
 
-  /* Redraw the entire screen using the new colour table. We still use the 
-     same colour indeces (0 to 15) at each pixel but these may translate to
-     new RGB colours. This handles CDGs that preset the screen before actually
-     loading the colour table. It is done in our local RGB surfarray. */
+  /* Streams typically load the same colours again and again.  If none
+     of them is actually changing, there is nothing to do. */
+  if (memcmp(colours, self->__cdgPalette[colourTableStart], sizeof(colours)) == 0) {
+    return;
+  }
 
-  for (ri = 6; ri < CDG_FULL_WIDTH; ++ri) {
-    for (ci = 12; ci < CDG_FULL_HEIGHT; ++ci) {
-      self->__cdgSurfarray[ri][ci] = self->__cdgColourTable[self->__cdgPixelColours[ri][ci]];
+  memcpy(self->__cdgPalette[colourTableStart], colours, sizeof(colours));
+  if (!self->__usePalette) {
+    for (i = 0; i < 8; ++i) {
+      self->__cdgColourTable[i + colourTableStart] =
+        SDL_MapRGB(self->__mapperSurface->format,
+                   colours[i][0], colours[i][1], colours[i][2]);
     }
   }
 
-  /* Update the screen for any colour changes */
-  self->__updatedTiles = 0xFFFFFFFF;
+  if (self->__catchingUp) {
+    /* CatchUp() will redraw the whole screen at the end anyway. */
+    return;
+  }
+
+  /* Redraw the entire screen using the new colour table.  We still
+     use the same colour indeces (0 to 15) at each pixel but these may
+     translate to new RGB colours, which FillRect() will look up.  (In
+     palette mode, the pixels themselves are unchanged, and the caller
+     will pick up the new colours from GetPalette().)  GetDirtyRects()
+     reports only the blocks whose colours really changed. */
+  memset(self->__dirtyBlocks, 1, sizeof(self->__dirtyBlocks));
+  self->__blocksDirtied += CDG_NUM_BLOCKS;
 }
 
 static void
 __cdgTileBlockCommon(CdgPacketReader *self, CdgPacket *packd, int xor) {
   int colour0, colour1;
   int column_index, row_index;
-  int firstRow, lastRow, firstCol, lastCol;
-  int col, row;
+  int x, y;
   int i, j, byte, pixel, xor_col, currentColourIndex, new_col;
 
   if (packd->data[1] & 0x20) {
@@ -776,20 +1588,17 @@ __cdgTileBlockCommon(CdgPacketReader *self, CdgPacket *packd, int xor) {
   if (row_index > (CDG_FULL_WIDTH - 6))
     row_index = (CDG_FULL_WIDTH - 6);
 
-  firstRow = (row_index - 6 - self->__hOffset) / TILE_WIDTH;
-  firstRow = (firstRow >= 0) ? firstRow : 0;
-  lastRow = (row_index - 1 - self->__hOffset) / TILE_WIDTH;
-
-  firstCol = (column_index - 12 - self->__vOffset) / TILE_HEIGHT;
-  firstCol = (firstCol >= 0) ? firstCol : 0;
-  lastCol = (column_index - 1 - self->__vOffset) / TILE_HEIGHT;
-
-  for (col = firstCol; col <= lastCol; ++col) {
-    for (row = firstRow; row <= lastRow; ++row) {
-      self->__updatedTiles |= ((1 << row) << (col * 8));
-    }
+  /* Mark just this block dirty.  GetDirtyRects() works out which
+     part of it (if any) is visible. */
+  if (!self->__catchingUp) {
+    self->__dirtyBlocks[column_index / BLOCK_HEIGHT][row_index / BLOCK_WIDTH] = 1;
+    self->__blocksDirtied++;
   }
 
+  /* Find the block within the circular pixel arrays. */
+  x = (row_index + self->__hOrigin) % CDG_FULL_WIDTH;
+  y = (column_index + self->__vOrigin) % CDG_FULL_HEIGHT;
+
   /*
     Set the pixel array for each of the pixels in the 12x6 tile.
     Normal = Set the colour to either colour0 or colour1 depending
@@ -808,7 +1617,7 @@ __cdgTileBlockCommon(CdgPacketReader *self, CdgPacket *packd, int xor) {
           xor_col = colour1;
         }
         /* Get the colour index currently at this location, and xor with it */
-        currentColourIndex = self->__cdgPixelColours[row_index + j][column_index + i];
+        currentColourIndex = self->__cdgPixelColours[x + j][y + i];
         new_col = currentColourIndex ^ xor_col;
 
       } else {
@@ -819,11 +1628,8 @@ __cdgTileBlockCommon(CdgPacketReader *self, CdgPacket *packd, int xor) {
         }
       }
 
-      /* Set the pixel with the new colour. We set both the surfarray
-         containing actual RGB values, as well as our array containing
-         the colour indeces into our colour table. */
-      self->__cdgSurfarray[row_index + j][column_index + i] = self->__cdgColourTable[new_col];
-      self->__cdgPixelColours[row_index + j][column_index + i] = new_col;      
+      /* Set the pixel with the new colour index. */
+      self->__cdgPixelColours[x + j][y + i] = new_col;      
     }
   }
 
@@ -839,10 +1645,18 @@ __cdgTileBlockCommon(CdgPacketReader *self, CdgPacket *packd, int xor) {
 static PyMethodDef CdgPacketReader_methods[] = {
   {"Rewind", (PyCFunction)CdgPacketReader_Rewind, METH_NOARGS },
   {"MarkTilesDirty", (PyCFunction)CdgPacketReader_MarkTilesDirty, METH_NOARGS },
+  {"GetDirtyRects", (PyCFunction)CdgPacketReader_GetDirtyRects, METH_NOARGS },
   {"GetDirtyTiles", (PyCFunction)CdgPacketReader_GetDirtyTiles, METH_NOARGS },
   {"GetBorderColour", (PyCFunction)CdgPacketReader_GetBorderColour, METH_NOARGS },
+  {"GetPalette", (PyCFunction)CdgPacketReader_GetPalette, METH_NOARGS },
+  {"GetState", (PyCFunction)CdgPacketReader_GetState, METH_NOARGS },
+  {"SetState", (PyCFunction)CdgPacketReader_SetState, METH_VARARGS | METH_KEYWORDS },
   {"DoPackets", (PyCFunction)CdgPacketReader_DoPackets, METH_VARARGS | METH_KEYWORDS },
+  {"CatchUp", (PyCFunction)CdgPacketReader_CatchUp, METH_VARARGS | METH_KEYWORDS },
+  {"GetNextCommandPos", (PyCFunction)CdgPacketReader_GetNextCommandPos, METH_NOARGS },
+  {"GetStats", (PyCFunction)CdgPacketReader_GetStats, METH_NOARGS },
   {"FillTile", (PyCFunction)CdgPacketReader_FillTile, METH_VARARGS | METH_KEYWORDS },
+  {"FillRect", (PyCFunction)CdgPacketReader_FillRect, METH_VARARGS | METH_KEYWORDS },
   {NULL}  /* Sentinel */
 };
 
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+
+# cdgbench - CDG decoder benchmarks
+
+# Copyright (C) 2010 Kelvin Lawson (kelvinl@users.sourceforge.net)
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+# OVERVIEW
+#
+# cdgbench measures how quickly the C (_pycdgAux), NumPy
+# (pycdgAuxNumpy) and Python (pycdgAux) implementations of
+# CdgPacketReader decode CDG streams on this machine.  It needs no
+# display and no song files: it makes up synthetic streams with
+# different mixes of CDG instructions, and decodes each of them with
+# each implementation.
+#
+# For each stream and implementation it reports:
+#
+#   packets/s   - the rate at which DoPackets() gets through the
+#                 stream, 10 packets at a time, as during playback.
+#   FillTile/s  - the rate at which FillTile() copies out tiles of
+#                 the finished screen.
+#   peak MB     - the peak memory use of the process that ran it.
+#                 Each stream is run in a fresh process, so this
+#                 includes Python and pygame themselves.
+#
+# The mixes are:
+#
+#   tile        - mostly tile blocks, as when lyrics are drawn.
+#   xor         - mostly XOR tile blocks, as when lyrics are
+#                 highlighted.
+#   scroll      - tile blocks with frequent scrolls.
+#   palette     - tile blocks with frequent colour table changes.
+#
+# USAGE
+#
+#   python cdgbench.py [options]
+#
+# The results may be saved with --save-baseline, and later runs
+# compared against them with --baseline; any result that has fallen
+# by more than --tolerance percent is reported as a regression, and
+# the exit status is then nonzero.  So is a case that fails, or that
+# has a result in the baseline but can no longer be run.
+# cdgbench_baseline.txt, next to this file, is used as the baseline by
+# default if it exists.  Its numbers are only meaningful on the
+# machine that made them, so save a new one before comparing on a
+# different machine.  A baseline records whether it was made with
+# --compiled, and is only compared with runs made the same way.
+
+import sys, os, time, random, struct, subprocess
+try:
+    import optparse
+except ImportError:
+    import Optik as optparse
+
+# The mixes of instructions in each synthetic stream.  Each is a list
+# of (weight, kind) pairs; kind None is a packet that isn't a CDG
+# command at all, which is common in real files.
+MIXES = {
+    'tile' :    [(6, 'tile'), (4, None)],
+    'xor' :     [(6, 'xor'), (4, None)],
+    'scroll' :  [(1, 'scroll'), (5, 'tile'), (4, None)],
+    'palette' : [(2, 'colours'), (4, 'tile'), (4, None)],
+    }
+MIX_ORDER = ['tile', 'xor', 'scroll', 'palette']
+
+BACKENDS = ['c', 'numpy', 'python']
+
+# The number of packets in a second of CDG stream.
+PACKETS_PER_SECOND = 300
+
+# The minimum time to spend timing FillTile().
+FILLTILE_SECONDS = 0.5
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'cdgbench_baseline.txt')
+
+# The exit status of a --case child process whose backend can't be
+# imported.  Any other nonzero status means the case failed.
+CASE_UNAVAILABLE = 3
+
+class CaseFailed(Exception):
+    """ Raised by runCaseInChild() when a case fails, other than by
+    its backend not being available. """
+    pass
+
+def getMode(compiled):
+    """ Returns the name of the kind of stream decoded, as recorded in
+    a baseline file. """
+    if compiled:
+        return 'compiled'
+    return 'plain'
+
+def makePacket(instruction, data):
+    """ Returns a 24-byte CDG command packet with the indicated
+    instruction and list of 16 data bytes. """
+    return struct.pack('BB2x16B4x', 0x09, instruction, *data)
+
+def makeStream(mix, seconds, seed = 1):
+    """ Returns a synthetic CDG stream of the indicated mix (one of the
+    keys of MIXES), the indicated number of seconds long. """
+
+    rand = random.Random(seed)
+    choices = []
+    for weight, kind in MIXES[mix]:
+        choices += [kind] * weight
+
+    # Start with a colour table and a clear screen, as a real file
+    # does.
+    packets = [makePacket(30, [rand.randint(0, 63) for i in range(16)]),
+               makePacket(31, [rand.randint(0, 63) for i in range(16)]),
+               makePacket(1, [0] * 16)]
+
+    numPackets = seconds * PACKETS_PER_SECOND
+    while len(packets) < numPackets:
+        kind = rand.choice(choices)
+        if kind == 'tile' or kind == 'xor':
+            data = [rand.randint(0, 15), rand.randint(0, 15),
+                    rand.randint(0, 17), rand.randint(0, 49)]
+            data += [rand.randint(0, 63) for i in range(12)]
+            packets.append(makePacket({'tile' : 6, 'xor' : 38}[kind], data))
+        elif kind == 'scroll':
+            # Scroll one block in a random direction, with a random
+            # offset.
+            data = [rand.randint(0, 15),
+                    (rand.randint(0, 2) << 4) | rand.randint(0, 5),
+                    (rand.randint(0, 2) << 4) | rand.randint(0, 11)]
+            packets.append(makePacket(rand.choice([20, 24]), data + [0] * 13))
+        elif kind == 'colours':
+            data = [rand.randint(0, 63) for i in range(16)]
+            packets.append(makePacket(rand.choice([30, 31]), data))
+        else:
+            packets.append('\0' * 24)
+
+    return ''.join(packets)
+
+def runCase(backend, mix, seconds, repeat, compiled):
+    """ Runs the benchmark for one backend and mix in this process,
+    and returns (packets/s, FillTile/s, peak MB). """
+
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    import pygame
+    if backend == 'c':
+        import _pycdgAux as aux
+    elif backend == 'numpy':
+        import pycdgAuxNumpy as aux
+    else:
+        import pycdgAux as aux
+
+    cdgData = makeStream(mix, seconds)
+    numPackets = len(cdgData) / 24
+    if compiled:
+        import pycdg
+        cdgData = pycdg.compileCdg(cdgData)
+
+    # A surface the size of one tile, for FillTile(), which also
+    # serves to map the colours.
+    tile = pygame.Surface((48, 48), 0, 32)
+    reader = aux.CdgPacketReader(cdgData, tile)
+
+    # Decode the whole stream, as the player would, 10 packets at a
+    # time.  Take the best of several runs.
+    best = None
+    for i in range(repeat):
+        reader.Rewind()
+        start = time.time()
+        while reader.DoPackets(10):
+            pass
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    packetsPerSecond = numPackets / max(best, 1e-9)
+
+    # Now copy out tiles of the finished screen, for a while.
+    count = 0
+    start = time.time()
+    while True:
+        for col in range(4):
+            for row in range(6):
+                reader.FillTile(tile, row, col)
+        count += 24
+        elapsed = time.time() - start
+        if elapsed >= FILLTILE_SECONDS:
+            break
+    fillTilesPerSecond = count / elapsed
+
+    return packetsPerSecond, fillTilesPerSecond, getPeakMemory()
+
+def getPeakMemory():
+    """ Returns the peak memory use of this process, in megabytes, or
+    None if it can't be determined on this platform. """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Reported in bytes, rather than kilobytes.
+        peak /= 1024
+    return peak / 1024.0
+
+def runCaseInChild(backend, mix, options):
+    """ Runs the benchmark for one backend and mix in a new process, so
+    that its peak memory use is its own.  Returns (packets/s,
+    FillTile/s, peak MB), or None if the backend isn't available.
+    Raises CaseFailed if the case fails for any other reason. """
+
+    args = [sys.executable, os.path.abspath(__file__), '--case',
+            '%s,%s' % (backend, mix),
+            '--seconds', str(options.seconds), '--repeat', str(options.repeat)]
+    if options.compiled:
+        args.append('--compiled')
+    child = subprocess.Popen(args, stdout = subprocess.PIPE)
+    output = child.communicate()[0]
+    if child.returncode == CASE_UNAVAILABLE:
+        return None
+    if child.returncode != 0:
+        raise CaseFailed('exit status %s' % (child.returncode))
+    try:
+        packets, tiles, peak = output.split()[-3:]
+    except ValueError:
+        raise CaseFailed('no result')
+    if peak == 'None':
+        peak = None
+    else:
+        peak = float(peak)
+    return float(packets), float(tiles), peak
+
+def readBaseline(filename):
+    """ Reads a baseline file written by writeBaseline(), and returns
+    (mode, baseline), where mode is as returned by getMode() and
+    baseline is a dictionary mapping (backend, mix) to (packets/s,
+    FillTile/s, peak MB).  A baseline written before the mode was
+    recorded was made with plain streams. """
+    mode = getMode(False)
+    baseline = {}
+    for line in open(filename, 'r'):
+        line = line.strip()
+        if line.startswith('# mode:'):
+            mode = line.split(':', 1)[1].strip()
+            continue
+        if not line or line.startswith('#'):
+            continue
+        backend, mix, packets, tiles, peak = line.split()
+        if peak == 'None':
+            peak = None
+        else:
+            peak = float(peak)
+        baseline[(backend, mix)] = (float(packets), float(tiles), peak)
+    return mode, baseline
+
+def writeBaseline(filename, mode, results):
+    """ Writes the list of results, as returned by main(), to the
+    indicated baseline file, recording the mode they were made in. """
+    file = open(filename, 'w')
+    file.write('# cdgbench baseline: backend mix packets/s FillTile/s peak-MB\n')
+    file.write('# mode: %s\n' % (mode))
+    for backend, mix, (packets, tiles, peak) in results:
+        file.write('%s %s %.0f %.0f %s\n' % (backend, mix, packets, tiles, peak))
+    file.close()
+
+def compare(value, base, tolerance, higherIsBetter):
+    """ Returns a short description of value relative to base, and
+    whether it has regressed by more than tolerance percent. """
+    if value is None or not base:
+        return '', False
+    change = 100.0 * (value - base) / base
+    if higherIsBetter:
+        regressed = change < -tolerance
+    else:
+        regressed = change > tolerance
+    return '%+.0f%%' % (change), regressed
+
+def SetupOptions():
+    """ Initialise and return optparse OptionParser object,
+    suitable for parsing the command line options to this
+    application. """
+
+    parser = optparse.OptionParser(usage = '%prog [options]')
+    parser.add_option('', '--backend', dest = 'backends', action = 'append',
+                      choices = BACKENDS,
+                      help = 'benchmark only this CdgPacketReader implementation: c, numpy or python (may be repeated)')
+    parser.add_option('', '--mix', dest = 'mixes', action = 'append',
+                      choices = MIX_ORDER,
+                      help = 'benchmark only this stream: %s (may be repeated)' % (', '.join(MIX_ORDER)))
+    parser.add_option('', '--seconds', dest = 'seconds', type = 'int', default = 60,
+                      help = 'length of each synthetic stream, in seconds (default %default)')
+    parser.add_option('', '--repeat', dest = 'repeat', type = 'int', default = 3,
+                      help = 'decode each stream this many times, and report the fastest (default %default)')
+    parser.add_option('', '--compiled', dest = 'compiled', action = 'store_true', default = False,
+                      help = 'decode the compiled form of each stream, as played from the cache')
+    parser.add_option('', '--baseline', dest = 'baseline', default = DEFAULT_BASELINE,
+                      help = 'compare the results against this baseline file (default %default)')
+    parser.add_option('', '--save-baseline', dest = 'save_baseline', metavar = 'FILE',
+                      help = 'save the results as a new baseline file')
+    parser.add_option('', '--tolerance', dest = 'tolerance', type = 'float', default = 20,
+                      help = 'report a regression when a result is this many percent worse than the baseline (default %default)')
+    parser.add_option('', '--case', dest = 'case', help = optparse.SUPPRESS_HELP)
+    return parser
+
+def main():
+    parser = SetupOptions()
+    (options, args) = parser.parse_args()
+
+    if options.case:
+        # We are a child process, running just one case.
+        backend, mix = options.case.split(',')
+        try:
+            result = runCase(backend, mix, options.seconds,
+                             options.repeat, options.compiled)
+        except ImportError, e:
+            print >> sys.stderr, str(e)
+            return CASE_UNAVAILABLE
+        print '%s %s %s' % result
+        return 0
+
+    backends = options.backends or BACKENDS
+    mixes = options.mixes or MIX_ORDER
+
+    mode = getMode(options.compiled)
+    baseline = {}
+    if options.baseline and os.path.exists(options.baseline) and not options.save_baseline:
+        baselineMode, baseline = readBaseline(options.baseline)
+        if baselineMode != mode:
+            print >> sys.stderr, "%s was made with %s streams; can't compare it with %s streams." % (
+                options.baseline, baselineMode, mode)
+            return 1
+        print 'Comparing with %s' % (options.baseline)
+
+    print '%-8s %-8s %12s %6s %12s %6s %8s %6s' % (
+        'backend', 'mix', 'packets/s', '', 'FillTile/s', '', 'peak MB', '')
+
+    results = []
+    regressions = 0
+    for backend in backends:
+        for mix in mixes:
+            try:
+                result = runCaseInChild(backend, mix, options)
+            except CaseFailed, e:
+                print '%-8s %-8s failed (%s)  REGRESSION' % (backend, mix, e)
+                regressions += 1
+                continue
+            if result is None:
+                if (backend, mix) in baseline:
+                    print '%-8s %-8s not available  REGRESSION' % (backend, mix)
+                    regressions += 1
+                else:
+                    print '%-8s %-8s not available' % (backend, mix)
+                continue
+            results.append((backend, mix, result))
+
+            packets, tiles, peak = result
+            base = baseline.get((backend, mix), (None, None, None))
+            packetsChange, packetsRegressed = compare(packets, base[0], options.tolerance, True)
+            tilesChange, tilesRegressed = compare(tiles, base[1], options.tolerance, True)
+            peakChange, peakRegressed = compare(peak, base[2], options.tolerance, False)
+            line = '%-8s %-8s %12.0f %6s %12.0f %6s %8s %6s' % (
+                backend, mix, packets, packetsChange, tiles, tilesChange,
+                peak is None and '-' or '%.1f' % (peak), peakChange)
+            if packetsRegressed or tilesRegressed or peakRegressed:
+                line += '  REGRESSION'
+                regressions += 1
+            print line
+
+    if options.save_baseline:
+        writeBaseline(options.save_baseline, mode, results)
+        print 'Saved baseline to %s' % (options.save_baseline)
+
+    if regressions:
+        print '%s regression(s) beyond %s%%' % (regressions, options.tolerance)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
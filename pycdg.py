@@ -62,7 +62,16 @@
 # from time to time, at least every 100 milliseconds or so, to allow
 # the player to do its work.
 #
-# The class also exports Close(), Pause(), Rewind(), GetPos().
+# The class also exports Close(), Pause(), Rewind(), GetPos(), and
+# SetPos(), which jumps to a given time (in milliseconds) in the song.
+# Jumping is quick, since the player keeps snapshots of the decoded
+# screen as it goes.
+#
+# To render frames of a CDG stream without playing it (for previews,
+# say, or batch processing), call renderFrames() or renderFrame()
+# instead; these need no display, and no call to Poll():
+#   cdgData = open("/songs/theboxer.cdg", "rb").read()
+#   frames = pycdg.renderFrames(cdgData, [10000, 20000, 30000])
 #
 # There are two optional parameters to the initialiser, errorNotifyCallback
 # and doneCallback:
@@ -114,6 +123,15 @@
 # least every 100 milliseconds or so to guarantee good video and audio
 # response time.
 #
+# Optionally (settings.CdgDecodeAhead), the decoding and scaling can
+# be done in a thread of its own, which keeps a few screen updates
+# ahead of the music; each call to Poll() then only has to copy the
+# ones that are due to the display.  This keeps the graphics smooth
+# when the main thread is held up for a moment by something else,
+# such as the PyKaraoke GUI.  The C decoder (_pycdgAux) lets go of
+# the interpreter lock while it decodes and draws, so with it the
+# decoding thread and the main thread really do run side by side.
+#
 # At each call to Poll(), the player checks the current time in the
 # song. It reads the CDG file at the correct location for the current
 # position of the song, and decodes the CDG commands stored there. If
@@ -123,11 +141,13 @@
 # output to the screen a certain number of times per second
 # (configurable). Performing the scaling and blitting required for
 # screen updates might consume a lot of CPU horsepower, so we reduce
-# the load further by dividing the screen into 24 segments. Only those
-# segments that have changed are scaled and blitted. If the user
-# resizes the window or we get a full-screen modification, the entire
-# screen is updated, but during normal CD+G operation only a small
-# number of segments are likely to be changed at update time.
+# the load further by keeping track of which of the CDG's own 6x12
+# pixel blocks have changed. At update time, GetDirtyRects() merges
+# the changed blocks into a handful of rectangles, and only those
+# rectangles are scaled and blitted. If the user resizes the window or
+# we get a full-screen modification, the entire screen is updated, but
+# during normal CD+G operation only a few blocks are likely to have
+# changed at update time.
 #
 # Here follows a description of the important data stored by
 # the class:
@@ -141,7 +161,9 @@
 # The border area is not actually displayed on the screen, however we
 # need to store the pixel colours there as they are set when Scroll
 # commands are used. This stores the actual pygame colour value, not
-# indeces into our colour table.
+# indeces into our colour table.  (The C module doesn't keep this
+# array: it looks up each pixel's colour as FillRect() writes it to
+# the surface, so the surface holds the only copy of the RGB values.)
 #
 # CdgPacketReader.__cdgPixelColours[300][216]
 # Store the colour index for every single pixel. The values stored
@@ -160,29 +182,43 @@
 # CdgPacketReader.__cdgPresetColourIndex
 # Preset Colour (index into colour table)
 #
-# CdgPacketReader.__cdgPresetColourIndex
+# CdgPacketReader.__cdgBorderColourIndex
 # Border Colour (index into colour table)
 #
-# CdgPacketReader.__updatedTiles
-# Bitmask to mark which screen segments have been updated.
-# This is used to reduce the amount of effort required in
-# scaling the output video. This is an expensive operation
-# which must be done for every screen update so we divide
-# the screen into 24 segments and only update those segments
-# which have actually been updated.
+# CdgPacketReader.__dirtyBlocks[18][50]
+# A flag for each 6x12 block of the full 300x216 screen, set when
+# any pixel in that block changes. This is used to reduce the amount
+# of effort required in scaling the output video, which is an
+# expensive operation that must be done for every screen update.
+# GetDirtyRects() finds the runs of dirty blocks along each row of
+# blocks, merges each run with the same run on the rows below it
+# into a rectangle, returns those rectangles (clipped to the visible
+# area and shifted by the scroll offsets), and clears the flags.
 
 from pykconstants import *
 from pykplayer import pykPlayer
 from pykenv import env
 from pykmanager import manager
-import sys, pygame, os, string, math
+import sys, pygame, os, string, math, struct, threading, Queue
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 
-# Import the optimised C version if available, or fall back to Python
+# Import the optimised C version if available, or fall back to Python.
+# There are two Python versions: pycdgAuxNumpy, written for current
+# versions of NumPy, and pycdgAux, which needs Numeric or
+# numpy.oldnumeric.
 try:
     import _pycdgAux as aux_c
 except ImportError:
     aux_c = None
 
+try:
+    import pycdgAuxNumpy as aux_numpy
+except ImportError:
+    aux_numpy = None
+
 try:
     import pycdgAux as aux_python
 except ImportError:
@@ -192,17 +228,887 @@ CDG_DISPLAY_WIDTH   = 288
 CDG_DISPLAY_HEIGHT  = 192
 
 # Screen tile positions
-# The viewable area of the screen (294x204) is divided into 24 tiles
-# (6x4 of 49x51 each). This is used to only update those tiles which
-# have changed on every screen update, thus reducing the CPU load of
-# screen updates. A bitmask of tiles requiring update is held in
-# cdgPlayer.UpdatedTiles.  This stores each of the 4 columns in
-# separate bytes, with 6 bits used to represent the 6 rows.
+# The viewable area of the screen (288x192) is divided into 24 tiles
+# (6x4 of 48x48 each).  Changes to the screen are now tracked in
+# finer rectangles, but the tiles still define the grid onto which
+# the scaled graphics are laid out.
 TILES_PER_ROW           = 6
 TILES_PER_COL           = 4
 TILE_WIDTH              = CDG_DISPLAY_WIDTH / TILES_PER_ROW
 TILE_HEIGHT             = CDG_DISPLAY_HEIGHT / TILES_PER_COL
 
+# Snapshots of the decoder state are saved every CDG_SNAPSHOT_PACKETS
+# packets (10 seconds, at 300 packets per second) the first time that
+# part of the song is decoded.  SetPos() can then jump anywhere in
+# the song by restoring the nearest snapshot, and replaying only the
+# packets since then.
+CDG_SNAPSHOT_PACKETS    = 3000
+
+# When at least this many packets (a second's worth) are due at once,
+# because the player has been held up, or has jumped to a new
+# position, they are decoded with CdgPacketReader.CatchUp() rather
+# than DoPackets().  This skips the work of keeping the RGB pixels
+# and the dirty area up to date as it goes, and does it just once at
+# the end instead.
+CDG_CATCH_UP_PACKETS    = 300
+
+# The distance to jump (in milliseconds) when the left or right arrow
+# key is pressed.
+CDG_SEEK_STEP_MS        = 10000
+
+# In the 'quick', 'int' and 'full' zoom modes, when at least this
+# fraction of the CDG screen has changed since the last update, the
+# whole screen is scaled at once rather than each changed rectangle in
+# turn.  (This is the default for settings.CdgWholeFrameFraction.)
+# Scaling the whole screen costs the same however little of it has
+# changed, while scaling the rectangles costs in proportion to their
+# area, plus a fixed cost for each one, which we count as
+# CDG_RECT_OVERHEAD more pixels.  Measured at 1920x1080 with the C
+# interpreter, a rectangle costs about as much as 200 pixels, and the
+# crossover falls between 0.7 (for 'full' zoom) and 1.0 (for 'int').
+CDG_WHOLE_FRAME_FRACTION = 0.8
+CDG_RECT_OVERHEAD       = 216
+
+# With --dump-jobs, the frames for --dump are handed out to the
+# worker processes in segments of this many consecutive frames.
+CDG_DUMP_SEGMENT_FRAMES = 60
+
+# With settings.CdgDecodeAhead, a thread decodes and draws the CDG
+# stream up to this many screen updates ahead of the music, so that
+# the main loop only has to put them on the display.
+CDG_DECODE_AHEAD_FRAMES = 4
+
+# A CDG stream may be compiled, with compileCdg(), into a shorter
+# stream that holds only the packets that actually do something.  The
+# compiled form is kept in a cache directory, in a file named for the
+# MD5 hash of the original stream with this extension.  See
+# pycdgAux.py for the format.
+CDG_COMPILED_MAGIC      = 'PYKCDGC1'
+CDG_COMPILED_HEADER     = '<8sI12x'
+CDG_COMPILED_EXT        = '.cdgc'
+
+# Preview thumbnails of CDG files (see makeCdgThumbnail()) are this
+# size.  They show the first screen with something substantial on it:
+# the screen is looked at every CDG_THUMBNAIL_STEP_MS milliseconds, up
+# to CDG_THUMBNAIL_MAX_MS into the song, until at least
+# CDG_THUMBNAIL_MIN_FILL of it differs from the background colour, and
+# then for as long as more of it is being drawn.  Thumbnails are kept
+# in a cache directory, in files named for the MD5 hash of the CDG
+# stream, as PNG files if pygame can write them, or else as BMP.
+CDG_THUMBNAIL_SIZE      = (96, 64)
+CDG_THUMBNAIL_STEP_MS   = 1000
+CDG_THUMBNAIL_MAX_MS    = 90000
+CDG_THUMBNAIL_MIN_FILL  = 0.03
+CDG_THUMBNAIL_EXTS      = ['.png', '.bmp']
+
+# Returns the greatest common divisor of a and b.
+def gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+def compileCdg(cdgData):
+    """ Returns the compiled form of the indicated CDG stream, which
+    may be passed to CdgPacketReader in place of the stream itself,
+    and draws exactly the same thing.  It leaves out the packets that
+    aren't CDG commands, or that are marked to be ignored, and also
+    the ones that would find the decoder already in the state they
+    ask for: repeated presets and colour tables, and tile blocks that
+    paint exactly what the last one at that position painted. """
+
+    numPackets = len(cdgData) / 24
+    records = []
+
+    # Enough of the decoder's state to know which packets won't
+    # change it.  tiles maps the (row, column) of each block on the
+    # screen to the last tile block drawn there, as long as it hasn't
+    # been disturbed since.
+    justClearedColour = -1
+    borderColour = -1
+    transparentColour = -1
+    hOffset = vOffset = 0
+    colourTable = [0] * 16
+    tiles = {}
+
+    for pos in xrange(numPackets):
+        packet = cdgData[pos * 24 : pos * 24 + 24]
+        if ord(packet[0]) & 0x3F != 0x09:
+            continue
+        inst = ord(packet[1]) & 0x3F
+        data = map(ord, packet[4:20])
+        colour = data[0] & 0x0F
+
+        if inst == 1:
+            # Memory preset.
+            if colour == justClearedColour:
+                continue
+            justClearedColour = borderColour = colour
+            tiles = {}
+
+        elif inst == 2:
+            # Border preset.  This repaints the blocks around the edge.
+            if colour == borderColour:
+                continue
+            borderColour = colour
+            for row, col in tiles.keys():
+                if row in (0, 17) or col in (0, 49):
+                    del tiles[(row, col)]
+
+        elif inst == 6 or inst == 38:
+            # Tile block, or tile block XOR.
+            if data[1] & 0x20:
+                continue
+            key = (min(data[2] & 0x1F, 17), min(data[3] & 0x3F, 49))
+            if inst == 38:
+                if key in tiles:
+                    del tiles[key]
+            else:
+                tile = [data[0] & 0x0F, data[1] & 0x0F] + [b & 0x3F for b in data[4:16]]
+                if tiles.get(key) == tile:
+                    continue
+                tiles[key] = tile
+            justClearedColour = -1
+
+        elif inst == 20 or inst == 24:
+            # Scroll preset, or scroll copy.
+            h = data[1] & 0x07
+            v = data[2] & 0x0F
+            moves = (data[1] & 0x30) in (0x10, 0x20) or \
+                    (data[2] & 0x30) in (0x10, 0x20)
+            if h == hOffset and v == vOffset and not moves:
+                continue
+            if h != hOffset or v != vOffset:
+                hOffset = min(h, 5)
+                vOffset = min(v, 11)
+            if moves:
+                tiles = {}
+
+        elif inst == 28:
+            # Define transparent colour.
+            if colour == transparentColour:
+                continue
+            transparentColour = colour
+
+        elif inst == 30 or inst == 31:
+            # Load colour table.
+            start = (inst - 30) * 8
+            colours = [((data[2 * i] & 0x3F) << 6) | (data[2 * i + 1] & 0x3F)
+                       for i in range(8)]
+            if colours == colourTable[start : start + 8]:
+                continue
+            colourTable[start : start + 8] = colours
+
+        else:
+            # Not a valid instruction.
+            continue
+
+        records.append(packet[:20] + struct.pack('<I', pos))
+
+    header = struct.pack(CDG_COMPILED_HEADER, CDG_COMPILED_MAGIC, numPackets)
+    return header + ''.join(records)
+
+def getCompiledCdg(cdgData, cacheDir):
+    """ Returns the compiled form of the indicated CDG stream, from
+    the cache in cacheDir if it is there.  Otherwise, compiles it and
+    saves it in the cache for next time. """
+
+    filename = os.path.join(cacheDir, md5(cdgData).hexdigest() + CDG_COMPILED_EXT)
+    if os.path.exists(filename):
+        try:
+            compiled = open(filename, 'rb').read()
+            if compiled[:len(CDG_COMPILED_MAGIC)] == CDG_COMPILED_MAGIC and \
+               len(compiled) % 24 == 0:
+                return compiled
+        except IOError:
+            pass
+
+    compiled = compileCdg(cdgData)
+
+    # Write the file under a temporary name first, so that another
+    # process can't read it half-written.
+    tempFilename = '%s.%s.tmp' % (filename, os.getpid())
+    try:
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        open(tempFilename, 'wb').write(compiled)
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tempFilename, filename)
+    except (IOError, OSError):
+        print "Couldn't write %s" % (filename)
+
+    return compiled
+
+# cdgRenderer Class
+class cdgRenderer:
+    """ This class decodes a CDG stream and draws it, scaled to fit,
+    onto a pygame surface.  cdgPlayer uses it to draw onto the display,
+    but it doesn't need a display of its own, so it may also be used to
+    render frames offscreen. """
+
+    def __init__(self, cdgData, surface, zoom, useC = True, usePalette = False,
+                 wholeFrameFraction = CDG_WHOLE_FRAME_FRACTION,
+                 useNumpy = True, keepStats = False):
+        """ surface is the surface that will be drawn onto (or any
+        surface of the same size and pixel format), and zoom is one of
+        the modes in settings.Zoom.  If useC is false, or the C
+        implementation is not available, one of the Python
+        implementations of the CDG interpreter is used: the NumPy one
+        if useNumpy is true (or the other is not available), or else
+        the one that uses Numeric.  wholeFrameFraction is the
+        fraction of the screen that must change before Draw() scales
+        the whole frame at once, rather than each changed part in
+        turn.  If keepStats is true, the CdgPacketReader counts and
+        times each type of CDG instruction; see printCdgStats(). """
+
+        self.zoom = zoom
+        self.wholeFrameFraction = wholeFrameFraction
+
+        # If usePalette is true, the working surfaces are
+        # 8-bit palettized surfaces, and the CdgPacketReader writes
+        # colour indices into them directly.  A change to the CDG
+        # colour table then becomes a change to the 16-entry palette,
+        # instead of a remap of every pixel.
+        self.usePalette = usePalette
+
+        # A surface that contains the CDG graphics as they are to be
+        # assembled onscreen.  This surface is kept at the original
+        # scale; the parts of it that have changed are filled in by
+        # the CdgPacketReader, then zoomed to display size.  (When no
+        # zooming is needed, see fillDirect in Resize(), it isn't
+        # used at all.)
+        if self.usePalette:
+            self.workingSurface = pygame.Surface((CDG_DISPLAY_WIDTH, CDG_DISPLAY_HEIGHT),
+                                                 0, 8)
+        else:
+            self.workingSurface = pygame.Surface((CDG_DISPLAY_WIDTH, CDG_DISPLAY_HEIGHT),
+                                                 pygame.HWSURFACE,
+                                                 surface)
+
+        aux = aux_c
+        if not aux or not useC:
+            aux = aux_numpy
+            if not aux or (not useNumpy and aux_python):
+                aux = aux_python
+        self.useC = (aux == aux_c)
+        self.useNumpy = (aux == aux_numpy)
+        self.packetReader = aux.CdgPacketReader(cdgData, self.workingSurface,
+                                                self.usePalette, keepStats)
+
+        self.Resize(surface.get_size())
+
+    def Reset(self):
+        """ Forces the next call to Draw() to redraw everything. """
+
+        self.borderColour = None
+        self.palette = None
+        self.packetReader.MarkTilesDirty()
+
+    def Resize(self, size):
+        """ Figures out what scale and placement to use for blitting
+        tiles to a surface of the indicated size.  This must be called
+        whenever the size of the surface changes. """
+
+        winWidth, winHeight = size
+
+        # Compute an appropriate uniform scale to letterbox the image
+        # within the window
+        scale = min(float(winWidth) / CDG_DISPLAY_WIDTH,
+                    float(winHeight) / CDG_DISPLAY_HEIGHT)
+        if self.zoom == 'none':
+            scale = 1
+        elif self.zoom == 'int':
+            if scale < 1:
+                scale = 1.0/math.ceil(1.0/scale)
+            else:
+                scale = int(scale)
+        self.displayScale = scale
+
+        scaledWidth = int(scale * CDG_DISPLAY_WIDTH)
+        scaledHeight = int(scale * CDG_DISPLAY_HEIGHT)
+
+        if self.zoom == 'full':
+            # If we are allowing non-proportional scaling, allow
+            # scaledWidth and scaledHeight to be independent.
+            scaledWidth = winWidth
+            scaledHeight = winHeight
+
+        # And the center of the display after letterboxing.
+        self.displayRowOffset = (winWidth - scaledWidth) / 2
+        self.displayColOffset = (winHeight - scaledHeight) / 2
+
+        # Calculate the scaled width and height for each tile
+        if self.zoom == 'soft':
+            self.displayTileWidth = CDG_DISPLAY_WIDTH / TILES_PER_ROW
+            self.displayTileHeight = CDG_DISPLAY_HEIGHT / TILES_PER_COL
+        else:
+            self.displayTileWidth = scaledWidth / TILES_PER_ROW
+            self.displayTileHeight = scaledHeight / TILES_PER_COL
+
+        # pygame.transform.scale() picks its source pixels by exact
+        # integer stepping, so any span of CDG pixels that begins and
+        # ends on a multiple of scaleStepX (or scaleStepY) comes out
+        # exactly as it would if the whole tile were scaled at once.
+        # We widen each dirty rectangle to these multiples before
+        # scaling it, so that the result doesn't depend on which
+        # parts of the screen happened to be redrawn together.
+        self.scaleStepX = TILE_WIDTH / gcd(TILE_WIDTH, self.displayTileWidth)
+        self.scaleStepY = TILE_HEIGHT / gcd(TILE_HEIGHT, self.displayTileHeight)
+
+        # If the graphics are drawn at their original size, and fit
+        # within the surface, the CdgPacketReader can fill in the
+        # changed parts straight onto the surface, rather than into
+        # workingSurface and then blitting them from there.  (Not in
+        # palette mode, where it writes colour indices.)
+        self.fillDirect = (self.zoom == 'none' and not self.usePalette and
+                           self.displayRowOffset >= 0 and
+                           self.displayColOffset >= 0)
+
+        # The whole surface will need to be redrawn.
+        self.Reset()
+
+    def Draw(self, surface):
+        """ Draws any changes since the last call onto the indicated
+        surface.  Returns the list of rectangles that were updated,
+        or None if the whole surface should be considered updated. """
+
+        # This routine is responsible for taking the unscaled output
+        # pixel data from the CdgPacketReader, scaling it and blitting
+        # it to the actual display surface.  The viewable area of the
+        # unscaled surface is 288x192 pixels.  Because scaling and
+        # blitting are heavy operations, we only scale and blit those
+        # parts of the screen which have been updated recently.  The
+        # CdgPacketReader class (self.packetReader) is responsible
+        # for keeping track of which 6x12 blocks of the screen have
+        # been modified, and merges them into a list of rectangles
+        # for us.  Each rectangle is first copied into
+        # self.workingSurface, which is maintained as the non-scaled
+        # version of the CDG graphics.
+
+        # There are four different approaches for blitting these
+        # rectangles onto the display:
+
+        # settings.CdgZoom == 'none':
+        #   No scaling.  The CDG graphics are centered within the
+        #   display.  Each dirty rectangle is filled in by the
+        #   CdgPacketReader directly onto surface (or, in palette
+        #   mode, blitted to it from workingSurface).  After all
+        #   dirty rectangles have been drawn, we then use
+        #   display.update to flip only those rectangles on the
+        #   screen that have been drawn.
+
+        # settings.CdgZoom = 'quick':
+        #   Trivial scaling.  Similar to 'none', but each rectangle
+        #   is first scaled to its target scale using
+        #   pygame.transform.scale(), which is quick but gives a
+        #   pixelly result.  The scaled rectangle is then blitted to
+        #   surface.
+
+        # settings.CdgZoom = 'int':
+        #   The same as 'quick', but the scaling is constrained to be
+        #   an integer multiple or divisor of its original size, which
+        #   may reduce artifacts somewhat.
+
+        # settings.CdgZoom = 'full':
+        #   The same as 'quick', but the scaling is allowed to
+        #   completely fill the window in both x and y, regardless of
+        #   aspect ratio constraints.
+
+        # settings.CdgZoom = 'soft':
+        #   Antialiased scaling.  After all dirty rectangles have
+        #   been copied to self.workingSurface, we use
+        #   pygame.transform.rotozoom() to make a nice, antialiased
+        #   scaling of workingSurface to surface, and then flip the
+        #   whole display.  (We can't scale and blit the rectangles
+        #   one a time in this mode, since that introduces artifacts
+        #   between their edges.)
+
+        # In palette mode, the working surface holds colour indices,
+        # and a change to the colour table is just a change to its
+        # palette.
+        borderColour = self.packetReader.GetBorderColour()
+        if self.usePalette:
+            palette = self.packetReader.GetPalette()
+            if palette != self.palette:
+                self.palette = palette
+                self.workingSurface.set_palette(palette)
+            if borderColour != None:
+                borderColour = palette[borderColour]
+
+        if borderColour != self.borderColour:
+            # When the border colour changes, blit the whole screen
+            # and redraw it.
+            self.borderColour = borderColour
+            if borderColour != None:
+                surface.fill(borderColour)
+                self.packetReader.MarkTilesDirty()
+
+        dirtyRects = self.packetReader.GetDirtyRects()
+        if not dirtyRects:
+            # If nothing is dirty, don't bother.
+            return []
+
+        # List of update rectangles (in scaled output window)
+        rect_list = []
+
+        if self.fillDirect:
+            # Each pixel is written just once, straight onto surface.
+            for rect in dirtyRects:
+                x, y, w, h = rect
+                dest = pygame.Rect(x + self.displayRowOffset,
+                                   y + self.displayColOffset, w, h)
+                self.packetReader.FillRect(surface, rect, dest.topleft)
+                rect_list.append(dest)
+            if dirtyRects == [(0, 0, CDG_DISPLAY_WIDTH, CDG_DISPLAY_HEIGHT)]:
+                return None
+            return rect_list
+
+        # Bring the changed parts of workingSurface up to date.
+        dirtyArea = 0
+        for x, y, w, h in dirtyRects:
+            self.packetReader.FillRect(self.workingSurface, (x, y, w, h))
+            dirtyArea += w * h + CDG_RECT_OVERHEAD
+
+        if self.zoom == 'soft':
+            # Now scale and blit the whole screen.
+            scaled = pygame.transform.rotozoom(self.workingSurface, 0, self.displayScale)
+            surface.blit(scaled, (self.displayRowOffset, self.displayColOffset))
+            return None
+
+        if self.zoom != 'none' and \
+           dirtyArea >= self.wholeFrameFraction * CDG_DISPLAY_WIDTH * CDG_DISPLAY_HEIGHT:
+            # So much has changed that it is cheaper to scale the
+            # whole screen in one go than piece by piece.  Since
+            # scaling is done the same way either way (see Resize()),
+            # the result is the same.
+            self.__scale(surface, (0, 0, CDG_DISPLAY_WIDTH, CDG_DISPLAY_HEIGHT),
+                         pygame.Rect(self.displayRowOffset, self.displayColOffset,
+                                     self.displayTileWidth * TILES_PER_ROW,
+                                     self.displayTileHeight * TILES_PER_COL))
+            return None
+
+        # Scale and blit only those rectangles which have been updated
+        for rect in dirtyRects:
+            x, y, w, h = rect
+
+            if self.zoom == 'none':
+                # The no-scale approach.
+                dest = pygame.Rect(x + self.displayRowOffset,
+                                   y + self.displayColOffset, w, h)
+                surface.blit(self.workingSurface, dest, rect)
+                rect_list.append(dest)
+
+            else:
+                # The quick-scale approach.  The rectangle is first
+                # widened as described in Resize().  Every part of
+                # workingSurface is current, so the widened
+                # rectangle may be scaled from it as it stands.
+                x, w = self.__widenSpan(x, w, self.scaleStepX)
+                y, h = self.__widenSpan(y, h, self.scaleStepY)
+                x0 = x * self.displayTileWidth / TILE_WIDTH
+                x1 = (x + w) * self.displayTileWidth / TILE_WIDTH
+                y0 = y * self.displayTileHeight / TILE_HEIGHT
+                y1 = (y + h) * self.displayTileHeight / TILE_HEIGHT
+                if x1 == x0 or y1 == y0:
+                    continue
+                dest = pygame.Rect(x0 + self.displayRowOffset,
+                                   y0 + self.displayColOffset,
+                                   x1 - x0, y1 - y0)
+                self.__scale(surface, (x, y, w, h), dest)
+                rect_list.append(dest)
+
+        if dirtyRects == [(0, 0, CDG_DISPLAY_WIDTH, CDG_DISPLAY_HEIGHT)]:
+            return None
+        else:
+            return rect_list
+
+    def __scale(self, surface, rect, dest):
+        """ Scales the indicated rectangle of workingSurface to fill
+        the dest rectangle of surface. """
+
+        source = self.workingSurface.subsurface(rect)
+        if self.usePalette:
+            # The palettized workingSurface must be converted to the
+            # surface's format, which blit() does for us.
+            scaled = pygame.transform.scale(source, dest.size)
+            surface.blit(scaled, dest)
+        else:
+            # workingSurface has the same format as surface, so we
+            # can scale straight onto it, without an intermediate
+            # surface.
+            pygame.transform.scale(source, dest.size, surface.subsurface(dest))
+
+    def __widenSpan(self, start, length, step):
+        """ Returns the (start, length) of the smallest span that
+        contains the indicated one, and begins and ends on a multiple
+        of step. """
+
+        end = start + length
+        start -= start % step
+        end += -end % step
+        return start, end - start
+
+def generateFrames(cdgData, times, size = (CDG_DISPLAY_WIDTH, CDG_DISPLAY_HEIGHT),
+                   zoom = 'quick', useC = True, usePalette = False):
+    """ Like renderFrames(), but a generator: it decodes only as far as
+    each frame as that frame is asked for, and yields the same 32-bit
+    surface each time, redrawn to show the next frame.  So there is
+    nothing to copy, but a frame should be copied if it is needed
+    after the next one is asked for. """
+
+    surface = pygame.Surface(size, 0, 32)
+    surface.fill((0, 0, 0))
+    renderer = cdgRenderer(cdgData, surface, zoom, useC, usePalette)
+    packetReader = renderer.packetReader
+
+    pos = 0
+    for ms in times:
+        packetPos = max(int((ms * 300) / 1000), 0)
+        if packetPos < pos:
+            raise ValueError, "Frame times must be in ascending order"
+        if packetPos - pos >= CDG_CATCH_UP_PACKETS:
+            packetReader.CatchUp(packetPos - pos)
+        elif packetPos > pos:
+            packetReader.DoPackets(packetPos - pos)
+        pos = packetPos
+
+        renderer.Draw(surface)
+        yield surface
+
+def renderFrames(cdgData, times, size = (CDG_DISPLAY_WIDTH, CDG_DISPLAY_HEIGHT),
+                 zoom = 'quick', format = 'surface', useC = True,
+                 usePalette = False):
+    """ Renders the indicated CDG stream (the contents of a .cdg file,
+    or its compiled form) as it would be shown at each of the
+    indicated times, in milliseconds from the start of the song.  The
+    times must be in ascending order, since the stream is decoded just
+    once, from start to finish.  Returns a list with a frame for each
+    time: a 32-bit pygame surface of the indicated size if format is
+    'surface', an RGB string as from pygame.image.tostring() if it is
+    'string', or a width x height x 3 array from
+    pygame.surfarray.array3d() if it is 'array'.
+
+    This needs neither a display nor a cdgPlayer, so it works under
+    SDL's dummy video driver. """
+
+    if format not in ('surface', 'string', 'array'):
+        raise ValueError, "Unknown frame format %s" % (format)
+
+    frames = []
+    for surface in generateFrames(cdgData, times, size, zoom, useC,
+                                  usePalette):
+        if format == 'surface':
+            frames.append(surface.copy())
+        elif format == 'string':
+            frames.append(pygame.image.tostring(surface, 'RGB'))
+        else:
+            frames.append(pygame.surfarray.array3d(surface))
+
+    return frames
+
+def renderFrame(cdgData, ms, size = (CDG_DISPLAY_WIDTH, CDG_DISPLAY_HEIGHT),
+                zoom = 'quick', format = 'surface', useC = True,
+                usePalette = False):
+    """ Renders the indicated CDG stream as it would be shown at the
+    indicated time, in milliseconds.  See renderFrames(). """
+
+    return renderFrames(cdgData, [ms], size, zoom, format, useC,
+                        usePalette)[0]
+
+def findPreviewFrame(cdgData, useC = True):
+    """ Returns a surface showing the first screen of the indicated
+    CDG stream that has something substantial on it: usually the
+    title, or the first lyrics.  See CDG_THUMBNAIL_MIN_FILL.  If there
+    is no such screen, returns the last one looked at. """
+
+    times = range(0, CDG_THUMBNAIL_MAX_MS + 1, CDG_THUMBNAIL_STEP_MS)
+    numPixels = CDG_DISPLAY_WIDTH * CDG_DISPLAY_HEIGHT
+
+    preview = None
+    previewFill = 0.0
+    for surface in generateFrames(cdgData, times, zoom = 'none', useC = useC):
+        # The fraction of the screen that is not the background
+        # colour, taking the top-left pixel to be the background.
+        background = pygame.mask.from_threshold(surface, surface.get_at((0, 0)),
+                                                (1, 1, 1, 255))
+        fill = 1.0 - float(background.count()) / numPixels
+        if preview != None and fill <= previewFill:
+            # The screen has been drawn.
+            break
+        if fill >= CDG_THUMBNAIL_MIN_FILL:
+            preview = surface.copy()
+            previewFill = fill
+
+    if preview == None:
+        preview = surface.copy()
+    return preview
+
+def findCdgThumbnail(cdgData, thumbDir):
+    """ Returns the filename of the preview thumbnail of the indicated
+    CDG stream in thumbDir, or None if it hasn't been made. """
+
+    base = os.path.join(thumbDir, md5(cdgData).hexdigest())
+    for ext in CDG_THUMBNAIL_EXTS:
+        if os.path.exists(base + ext):
+            return base + ext
+    return None
+
+def makeCdgThumbnail(cdgData, thumbDir):
+    """ Makes a preview thumbnail of the indicated CDG stream, saves
+    it in thumbDir, and returns its filename, or None if it couldn't
+    be made.  This may be called in a worker process; see
+    SongDB.makeCdgThumbnails(). """
+
+    ext = CDG_THUMBNAIL_EXTS[0]
+    if not pygame.image.get_extended():
+        ext = CDG_THUMBNAIL_EXTS[-1]
+    filename = os.path.join(thumbDir, md5(cdgData).hexdigest() + ext)
+
+    try:
+        preview = findPreviewFrame(cdgData)
+    except (ValueError, pygame.error):
+        print "Couldn't decode CDG for %s" % (filename)
+        return None
+
+    # smoothscale() is new in pygame 1.8.
+    scale = getattr(pygame.transform, 'smoothscale', pygame.transform.scale)
+    thumbnail = scale(preview, CDG_THUMBNAIL_SIZE)
+
+    # As in getCompiledCdg(), write the file under a temporary name
+    # first.  The name must still end with the extension, which is how
+    # pygame picks the file format.
+    tempFilename = '%s.%s.tmp%s' % (filename[:-len(ext)], os.getpid(), ext)
+    try:
+        if not os.path.exists(thumbDir):
+            os.makedirs(thumbDir)
+        pygame.image.save(thumbnail, tempFilename)
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tempFilename, filename)
+    except (IOError, OSError, pygame.error):
+        print "Couldn't write %s" % (filename)
+        return None
+
+    return filename
+
+def printCdgStats(stats):
+    """ Prints the statistics returned by CdgPacketReader.GetStats()
+    as a table, with the instructions that took the most time
+    first. """
+
+    if not stats:
+        return
+
+    items = stats.items()
+    items.sort(lambda a, b: cmp(b[1][1], a[1][1]))
+
+    print "%-18s %8s %10s %10s %7s %9s" % (
+        'Instruction', 'Count', 'Total ms', 'us each', 'Remaps', 'Dirtied')
+    for name, (count, seconds, remaps, dirtied) in items:
+        # The C implementation doesn't re-map the screen, so it
+        # doesn't count them.
+        if remaps is None:
+            remaps = 'n/a'
+        print "%-18s %8d %10.1f %10.2f %7s %9d" % (
+            name, count, seconds * 1000.0, seconds * 1000000.0 / count,
+            remaps, dirtied)
+
+# The cdgRenderer belonging to a --dump-jobs worker process, and the
+# surface it draws onto.
+dumpWorker = None
+
+def dumpWorkerInit(cdgData, size, depth, masks, zoom, useC, usePalette,
+                   wholeFrameFraction, useNumpy):
+    """ Sets up a --dump-jobs worker process to render frames of
+    the indicated CDG stream. """
+    global dumpWorker
+
+    surface = pygame.Surface(size, 0, depth, masks)
+    renderer = cdgRenderer(cdgData, surface, zoom, useC, usePalette,
+                           wholeFrameFraction, useNumpy)
+    dumpWorker = (renderer, surface)
+
+def dumpWorkerRender(state, startPacket, targets):
+    """ Renders a segment of frames in a --dump-jobs worker process.
+    state is a decoder state from GetState(), taken startPacket
+    packets into the stream; targets lists, for each frame, the
+    number of packets that should have been decoded for it to be
+    drawn, or -1 if nothing has been drawn yet.  Returns the frames
+    as a list of RGB strings, with None in place of each frame after
+    the first that is the same as the one before it. """
+
+    renderer, surface = dumpWorker
+    renderer.packetReader.SetState(state)
+    renderer.Reset()
+    surface.fill((0, 0, 0))
+
+    frames = []
+    pos = startPacket
+    for target in targets:
+        changed = not frames
+        if target >= 0:
+            renderer.packetReader.DoPackets(target - pos)
+            pos = target
+            if renderer.Draw(surface) != []:
+                changed = True
+        if changed:
+            frames.append(pygame.image.tostring(surface, 'RGB'))
+        else:
+            frames.append(None)
+
+    return frames
+
+def decodePacketsTo(packetReader, readPackets, packetPos, snapshots):
+    """ Decodes the CDG stream with packetReader, which has decoded
+    readPackets packets so far, up to the packet packetPos.  A
+    snapshot of the decoder state is appended to the list snapshots
+    at each multiple of CDG_SNAPSHOT_PACKETS that it doesn't reach
+    yet.  Returns the new value of readPackets, and False if the end
+    of the stream has been reached, or True otherwise. """
+
+    doPackets = packetReader.DoPackets
+    if packetPos - readPackets >= CDG_CATCH_UP_PACKETS:
+        doPackets = packetReader.CatchUp
+
+    while readPackets < packetPos:
+        nextSnapshot = len(snapshots) * CDG_SNAPSHOT_PACKETS
+        if readPackets == nextSnapshot:
+            snapshots.append(packetReader.GetState())
+            nextSnapshot += CDG_SNAPSHOT_PACKETS
+
+        numPackets = packetPos - readPackets
+        if readPackets < nextSnapshot:
+            numPackets = min(numPackets, nextSnapshot - readPackets)
+        if not doPackets(numPackets):
+            return packetPos, False
+        readPackets += numPackets
+
+    return readPackets, True
+
+# cdgDecodeAhead Class
+class cdgDecodeAhead:
+    """ Decodes and draws a CDG stream in a separate thread, a few
+    screen updates ahead of the music.  Each update is drawn onto a
+    private surface, and the parts of it that changed are copied off
+    and queued, with the song position at which they should be shown,
+    in a queue of CDG_DECODE_AHEAD_FRAMES entries.  The main loop
+    takes the ones that are due with getUpdatesDue(), and need only
+    blit them to the display.
+
+    While the thread is running, it owns the renderer and its
+    packetReader, as well as its own count of the packets decoded and
+    list of snapshots, and nothing else may use them until stop() has
+    returned.  The count is passed back with each update; the player
+    takes back the snapshots, in readPackets and snapshots, once the
+    thread has stopped.  An exception raised in the thread is raised
+    again by the next call to getUpdatesDue(). """
+
+    def __init__(self, renderer, readPackets, snapshots, surface, startMs,
+                 msPerUpdate, queueFrames = CDG_DECODE_AHEAD_FRAMES):
+        """ readPackets is the number of packets the renderer's
+        packetReader has decoded so far, and snapshots the list of
+        snapshots taken so far, as for decodePacketsTo(); the thread
+        works on a copy of the list.  surface is a surface of the same
+        size and format as the one that the updates will be blitted
+        onto.  The first update is drawn for the song position
+        startMs, and the rest follow every msPerUpdate
+        milliseconds. """
+
+        self.renderer = renderer
+        self.readPackets = readPackets
+        self.snapshots = snapshots[:]
+        self.surface = surface
+        self.nextMs = startMs
+        self.msPerUpdate = msPerUpdate
+        self.queue = Queue.Queue(queueFrames)
+        self.error = None
+        self.stopping = False
+
+        # The song position most recently passed to getUpdatesDue().
+        # If the thread falls behind this, it skips straight to it.
+        self.clockMs = startMs
+
+        # The update taken from the queue, but not yet due.
+        self.nextUpdate = None
+
+        # The first update redraws the whole screen.
+        self.renderer.Reset()
+
+        self.thread = threading.Thread(target = self.__decode)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def getUpdatesDue(self, ms):
+        """ Returns the list of updates that are due to be shown by the
+        song position ms, in order.  Each update is a tuple (patches,
+        endOfStream, readPackets), where patches is a list of (rect,
+        surface) pairs, with rect None if the surface covers the whole
+        screen, and readPackets is the number of packets that had been
+        decoded for it. """
+
+        self.clockMs = ms
+        updates = []
+        while True:
+            if self.nextUpdate == None:
+                try:
+                    self.nextUpdate = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+            updateMs, patches, endOfStream, readPackets = self.nextUpdate
+            if updateMs > ms:
+                break
+            updates.append((patches, endOfStream, readPackets))
+            self.nextUpdate = None
+
+        if not updates and self.error:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+        return updates
+
+    def stop(self):
+        """ Stops the thread, and discards the updates not yet
+        taken. """
+
+        self.stopping = True
+        while self.thread.isAlive():
+            # Make room in the queue, in case the thread is waiting to
+            # add to it.
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except Queue.Empty:
+                pass
+            self.thread.join(0.01)
+        self.nextUpdate = None
+
+    def __decode(self):
+        try:
+            while not self.stopping:
+                # If the thread has fallen behind the music (because
+                # the whole process was held up, say), there's no
+                # point drawing the updates that have already been
+                # missed.
+                ms = max(self.nextMs, self.clockMs)
+                self.nextMs = ms + self.msPerUpdate
+
+                packetPos = max(int((ms * 300) / 1000), 0)
+                self.readPackets, more = decodePacketsTo(
+                    self.renderer.packetReader, self.readPackets,
+                    packetPos, self.snapshots)
+
+                rect_list = self.renderer.Draw(self.surface)
+                if rect_list == None:
+                    patches = [(None, self.surface.copy())]
+                else:
+                    patches = [(rect, self.surface.subsurface(rect).copy())
+                               for rect in rect_list]
+
+                self.queue.put((ms, patches, not more, self.readPackets))
+                if not more:
+                    break
+        except:
+            self.error = sys.exc_info()
+
 # cdgPlayer Class
 class cdgPlayer(pykPlayer):
     # Initialise the player instace
@@ -247,29 +1153,31 @@ class cdgPlayer(pykPlayer):
         manager.InitPlayer(self)
         manager.OpenDisplay()
         manager.surface.fill((0, 0, 0))
-
-        # A working surface for blitting tiles, one at a time.
-        self.workingTile = pygame.Surface((TILE_WIDTH, TILE_HEIGHT),
-                                          0, manager.surface)
-
-        # A surface that contains the set of all tiles as they are to
-        # be assembled onscreen.  This surface is kept at the original
-        # scale, then zoomed to display size.  It is only used if
-        # settings.CdgZoom == 'soft'.
-        self.workingSurface = pygame.Surface((CDG_DISPLAY_WIDTH, CDG_DISPLAY_HEIGHT),
-                                             pygame.HWSURFACE,
-                                             manager.surface)
-
-        self.borderColour = None
-        self.computeDisplaySize()
-
-        aux = aux_c
-        if not aux or not manager.settings.CdgUseC:
+        self.frameDirty = True
+
+        useC = aux_c and manager.settings.CdgUseC
+
+        # Decoding is quicker from the compiled form of the CDG
+        # stream, which is kept in a cache on disk.
+        self.cdgData = self.cdgFileData.GetData()
+        self.cdgNumPackets = len(self.cdgData) / 24
+        if manager.settings.CdgCompiledCache:
+            self.cdgData = getCompiledCdg(self.cdgData, self.songDb.getCdgCacheDirectory())
+
+        # Open the cdg and sound files.  The renderer decodes the CDG
+        # stream and draws it onto manager.surface; we drive its
+        # packetReader directly as the song plays.
+        self.renderer = cdgRenderer(self.cdgData, manager.surface,
+                                    manager.settings.CdgZoom, useC,
+                                    manager.settings.CdgUsePalette,
+                                    manager.settings.CdgWholeFrameFraction,
+                                    manager.settings.CdgUseNumpy,
+                                    manager.options.cdg_stats)
+        self.packetReader = self.renderer.packetReader
+        if self.renderer.useNumpy:
+            print "Using NumPy implementation of CDG interpreter."
+        elif not self.renderer.useC:
             print "Using Python implementation of CDG interpreter."
-            aux = aux_python
-
-        # Open the cdg and sound files
-        self.packetReader = aux.CdgPacketReader(self.cdgFileData.GetData(), self.workingTile)
         manager.setCpuSpeed('cdg')
 
         if self.soundFileData:
@@ -308,8 +1216,31 @@ class cdgPlayer(pykPlayer):
         self.cdgPacketsDue = 0
         self.LastPos = self.curr_pos = 0
 
+        # The list of decoder snapshots, one for each multiple of
+        # CDG_SNAPSHOT_PACKETS decoded so far.
+        self.snapshots = []
+
+        # The song position (in milliseconds) at which the music was
+        # most recently started by SetPos().
+        self.seekOffsetTime = 0
+
         # Some session-wide constants.
         self.ms_per_update = (1000.0 / manager.options.fps)
+        self.ms_per_idle_update = self.ms_per_update
+        if manager.options.idle_fps > 0 and manager.options.idle_fps < manager.options.fps:
+            self.ms_per_idle_update = (1000.0 / manager.options.idle_fps)
+
+        # While the last screen update found nothing changed, this is
+        # the position of the next CDG command in the stream (or the
+        # end of the stream, if there are none); until that command
+        # has been decoded, nothing can change, so the screen is
+        # updated only every ms_per_idle_update.  It is None
+        # otherwise.
+        self.cdgIdleUntil = None
+
+        # The cdgDecodeAhead that decodes the stream in another
+        # thread, while playing with settings.CdgDecodeAhead.
+        self.decodeAhead = None
 
     def doPlay(self):
         if self.soundFileData:
@@ -328,12 +1259,16 @@ class cdgPlayer(pykPlayer):
 
     # you must call Play() to restart. Blocks until pygame is initialised
     def doRewind(self):
+        self.stopDecodeAhead()
+
         # Reset the state of the packet-reading thread
         self.cdgReadPackets = 0
         self.cdgPacketsDue = 0
         self.LastPos = 0
+        self.cdgIdleUntil = None
         # No need for the Pause() fix anymore
         self.pauseOffsetTime = 0
+        self.seekOffsetTime = 0
         # Move file pointer to the beginning of the file
         self.packetReader.Rewind()
 
@@ -350,10 +1285,60 @@ class cdgPlayer(pykPlayer):
     # not initialised yet.
     def GetPos(self):
         if self.soundFileData:
-            return pygame.mixer.music.get_pos()
+            return pygame.mixer.music.get_pos() + self.seekOffsetTime
         else:
             return pykPlayer.GetPos(self)
 
+    # Jump to the indicated time (in milliseconds) in the song.
+    def SetPos(self, ms):
+        if self.State != STATE_PLAYING and self.State != STATE_PAUSED:
+            return
+        ms = max(int(ms), 0)
+        self.stopDecodeAhead()
+
+        if self.soundFileData:
+            # pygame can only start the music part-way through for
+            # these formats.
+            if self.soundFileData.Ext not in ['.ogg', '.mp3']:
+                self.ErrorNotifyCallback("Cannot seek within this audio file")
+                return
+
+            # Restart the music at the new position.
+            pygame.mixer.music.play(0, ms / 1000.0)
+            self.seekOffsetTime = ms
+            self.pauseOffsetTime = 0
+            if self.State == STATE_PAUSED:
+                pygame.mixer.music.pause()
+                self.PauseStartTime = self.GetPos()
+
+        if self.State == STATE_PLAYING:
+            self.PlayStartTime = pygame.time.get_ticks() - ms
+        else:
+            self.PlayTime = ms
+
+        # Now bring the CDG decoder to the same point.  If we are
+        # going backwards, or if there is a snapshot ahead of where
+        # we are now, start from the nearest snapshot; otherwise,
+        # just keep decoding from here.
+        self.curr_pos = ms + self.InternalOffsetTime + manager.settings.SyncDelayMs
+        packetPos = max(int((self.curr_pos * 300) / 1000), 0)
+        index = min(packetPos / CDG_SNAPSHOT_PACKETS, len(self.snapshots) - 1)
+        if index >= 0:
+            snapshotPos = index * CDG_SNAPSHOT_PACKETS
+            if packetPos < self.cdgReadPackets or snapshotPos > self.cdgReadPackets:
+                self.packetReader.SetState(self.snapshots[index])
+                self.cdgReadPackets = snapshotPos
+
+        self.cdgPacketsDue = packetPos
+        if not self.cdgReadPacketsTo(packetPos):
+            self.Close()
+            return
+
+        # Redraw the whole screen.
+        self.renderer.Reset()
+        self.cdgDisplayUpdate()
+        self.LastPos = self.curr_pos
+
     def SetupOptions(self):
         """ Initialise and return optparse OptionParser object,
         suitable for parsing the command line options to this
@@ -374,91 +1359,225 @@ class cdgPlayer(pykPlayer):
             if manager.audioProps:
                 pygame.mixer.music.stop()
 
+        self.stopDecodeAhead()
+
+        if self.packetReader and manager.options.cdg_stats:
+            printCdgStats(self.packetReader.GetStats())
+
         # Make sure our surfaces are deallocated before we call up to
         # CloseDisplay(), otherwise bad things can happen.
-        self.workingSurface = None
-        self.workingTile = None
+        self.renderer = None
         self.packetReader = None
         pykPlayer.shutdown(self)
 
     def doStuff(self):
+        if self.State == STATE_CAPTURING and manager.options.dump_jobs > 1:
+            # Render the whole dump at once, in parallel.
+            self.doParallelDump()
+            self.Close()
+            return
+
         pykPlayer.doStuff(self)
 
+        if self.decodeAhead and not manager.settings.CdgDecodeAhead:
+            self.stopDecodeAhead()
+
+        if self.State == STATE_PLAYING and manager.settings.CdgDecodeAhead:
+            # The CDG data is decoded and drawn in another thread, so
+            # all we need do is show the updates that are now due.
+            self.curr_pos = self.GetPos() + self.InternalOffsetTime + manager.settings.SyncDelayMs - self.pauseOffsetTime
+            if not self.decodeAhead:
+                self.decodeAhead = cdgDecodeAhead(self.renderer, self.cdgReadPackets,
+                                                  self.snapshots,
+                                                  manager.surface.copy(),
+                                                  self.curr_pos, self.ms_per_update)
+                self.cdgIdleUntil = None
+            self.cdgShowUpdatesDue()
+
         # Check whether the songfile has moved on, if so
         # get the relevant CDG data and update the screen.
-        if self.State == STATE_PLAYING or self.State == STATE_CAPTURING:
+        elif self.State == STATE_PLAYING or self.State == STATE_CAPTURING:
             self.curr_pos = self.GetPos() + self.InternalOffsetTime + manager.settings.SyncDelayMs - self.pauseOffsetTime
 
             self.cdgPacketsDue = int((self.curr_pos * 300) / 1000)
-            numPackets = self.cdgPacketsDue - self.cdgReadPackets
-            if numPackets > 0:
-                if not self.packetReader.DoPackets(numPackets):
-                    # End of file.
-                    #print "End of file on cdg."
-                    self.Close()
-                self.cdgReadPackets += numPackets
+            if not self.cdgReadPacketsTo(self.cdgPacketsDue):
+                # End of file.
+                #print "End of file on cdg."
+                self.Close()
 
             # Check if any screen updates are now due.
-            if (self.curr_pos - self.LastPos) > self.ms_per_update:
+            if (self.curr_pos - self.LastPos) > self.cdgMsPerUpdate():
                 self.cdgDisplayUpdate()
                 self.LastPos = self.curr_pos
 
+    def getWaitTime(self):
+        if self.State != STATE_PLAYING:
+            return pykPlayer.getWaitTime(self)
+
+        # Nothing can be seen to change until the next screen update,
+        # so the packets due before then can wait until it is due.
+        waitTime = max(int(self.LastPos + self.cdgMsPerUpdate() - self.curr_pos) + 1, 0)
+        if self.cdgIsIdle():
+            # But if the next CDG command is due before then, the
+            # screen should go back to the full rate when it is
+            # decoded, so wake up for it (though not sooner than the
+            # full rate would have).
+            commandMs = ((self.cdgIdleUntil + 1) * 1000 + 299) / 300
+            fullRateMs = self.LastPos + self.ms_per_update
+            wakeTime = max(int(max(commandMs, fullRateMs) - self.curr_pos) + 1, 0)
+            waitTime = min(waitTime, wakeTime)
+        if self.decodeAhead:
+            # If the decode-ahead thread is late with that update,
+            # don't keep it from the interpreter lock by spinning.
+            waitTime = max(waitTime, int(self.ms_per_update / 4))
+        return waitTime
+
+    # Returns true while the screen is idle, as described for
+    # self.cdgIdleUntil.
+    def cdgIsIdle(self):
+        return self.State == STATE_PLAYING and self.cdgIdleUntil != None and \
+               self.cdgReadPackets <= self.cdgIdleUntil
+
+    # Returns the number of milliseconds between screen updates,
+    # which is longer while the screen is idle.
+    def cdgMsPerUpdate(self):
+        if self.cdgIsIdle():
+            return self.ms_per_idle_update
+        return self.ms_per_update
+
+    # Decode the CDG stream up to the indicated packet, saving a
+    # snapshot of the decoder state at each multiple of
+    # CDG_SNAPSHOT_PACKETS that hasn't been reached before.  Returns
+    # False if the end of the stream has been reached.
+    def cdgReadPacketsTo(self, packetPos):
+        self.cdgReadPackets, more = decodePacketsTo(
+            self.packetReader, self.cdgReadPackets, packetPos, self.snapshots)
+        return more
+
+    def stopDecodeAhead(self):
+        """ Stops the decode-ahead thread, if it is running, and takes
+        back its count of packets decoded and its snapshots.  It may
+        have drawn updates that were never shown, so the next update
+        redraws the whole screen. """
+
+        if self.decodeAhead:
+            self.decodeAhead.stop()
+            self.cdgReadPackets = self.decodeAhead.readPackets
+            self.snapshots = self.decodeAhead.snapshots
+            self.decodeAhead = None
+            self.renderer.Reset()
+            self.cdgIdleUntil = None
+
+    def doParallelDump(self):
+        """ Writes all of the frames for --dump, rendering them in
+        manager.options.dump_jobs worker processes.  This produces the
+        same frames, in the same order, as capturing one frame per
+        call to doStuff(). """
+
+        import multiprocessing
+
+        numPackets = self.cdgNumPackets
+
+        # First, work out which packet the display has been drawn up
+        # to in each frame, by stepping through the frame times just
+        # as doStuff() would.  Frame 0 is dumped before anything is
+        # drawn, and each frame after that shows what was drawn on the
+        # previous step.
+        targets = []
+        readPackets = 0
+        lastPos = 0
+        drawnPackets = -1
+        frame = 0
+        while True:
+            playTime = 1000.0 * frame / self.dumpFrameRate
+            curr_pos = playTime + self.InternalOffsetTime + manager.settings.SyncDelayMs
+            packetsDue = int((curr_pos * 300) / 1000)
+            if packetsDue > readPackets:
+                if readPackets >= numPackets:
+                    # End of file.
+                    break
+                readPackets = min(packetsDue, numPackets)
+            if (curr_pos - lastPos) > self.ms_per_update:
+                drawnPackets = readPackets
+                lastPos = curr_pos
+            targets.append(drawnPackets)
+            frame += 1
+
+        surface = manager.surface
+        pool = multiprocessing.Pool(manager.options.dump_jobs, dumpWorkerInit,
+                                    (self.cdgData, surface.get_size(),
+                                     surface.get_bitsize(), surface.get_masks(),
+                                     self.renderer.zoom, self.renderer.useC,
+                                     self.renderer.usePalette,
+                                     self.renderer.wholeFrameFraction,
+                                     self.renderer.useNumpy))
+
+        # Frame 0.
+        self.PlayFrame = 0
+        self.doFrameDump()
+        self.lastDumpFrame = None
+
+        # Now decode the stream once more, here, to collect the
+        # decoder state at the start of each segment, and hand the
+        # segments out to the workers.  Only a few segments are
+        # kept outstanding at a time, so that the frames waiting to
+        # be written don't pile up in memory.
+        pending = []
+        for i in range(0, len(targets), CDG_DUMP_SEGMENT_FRAMES):
+            segment = targets[i : i + CDG_DUMP_SEGMENT_FRAMES]
+            startPacket = max(segment[0], 0)
+            self.cdgReadPacketsTo(startPacket)
+            state = self.packetReader.GetState()
+            pending.append(pool.apply_async(dumpWorkerRender,
+                                            (state, startPacket, segment)))
+            if len(pending) >= manager.options.dump_jobs * 2:
+                self.dumpFrames(pending.pop(0).get())
+
+        while pending:
+            self.dumpFrames(pending.pop(0).get())
+
+        pool.close()
+        pool.join()
+
+    def dumpFrames(self, frames):
+        """ Writes the indicated list of RGB strings, as returned by
+        dumpWorkerRender(), as the next frames of the dump. """
+
+        size = manager.surface.get_size()
+        for frame in frames:
+            if frame != None and frame != self.lastDumpFrame:
+                image = pygame.image.fromstring(frame, size, 'RGB')
+                manager.surface.blit(image, (0, 0))
+                self.lastDumpFrame = frame
+                self.frameDirty = True
+            self.PlayFrame += 1
+            self.doFrameDump()
+
     def handleEvent(self, event):
         if event.type == pygame.KEYDOWN and event.key == pygame.K_RETURN and (event.mod & (pygame.KMOD_LSHIFT | pygame.KMOD_RSHIFT | pygame.KMOD_LMETA | pygame.KMOD_RMETA)):
             # Shift/meta return: start/stop song.  Useful for keybinding apps.
             self.Close()
             return
+
+        # Use the left/right arrow (without control) to jump back or
+        # forward in the song.
+        if event.type == pygame.KEYDOWN and \
+           (event.key == pygame.K_LEFT or event.key == pygame.K_RIGHT) and \
+           not (event.mod & (pygame.KMOD_LCTRL | pygame.KMOD_RCTRL)):
+            pos = self.GetPos() - self.pauseOffsetTime
+            if event.key == pygame.K_LEFT:
+                self.SetPos(pos - CDG_SEEK_STEP_MS)
+            else:
+                self.SetPos(pos + CDG_SEEK_STEP_MS)
+            return
         
         pykPlayer.handleEvent(self, event)
 
     def doResize(self, newSize):
-        self.computeDisplaySize()
-
-        if self.borderColour != None:
-            manager.surface.fill(self.borderColour)
-
-        self.packetReader.MarkTilesDirty()
-
-    def computeDisplaySize(self):
-        """ Figures out what scale and placement to use for blitting
-        tiles to the screen.  This must be called at startup, and
-        whenever the window size changes. """
-
-        winWidth, winHeight = manager.displaySize
-
-        # Compute an appropriate uniform scale to letterbox the image
-        # within the window
-        scale = min(float(winWidth) / CDG_DISPLAY_WIDTH,
-                    float(winHeight) / CDG_DISPLAY_HEIGHT)
-        if manager.settings.CdgZoom == 'none':
-            scale = 1
-        elif manager.settings.CdgZoom == 'int':
-            if scale < 1:
-                scale = 1.0/math.ceil(1.0/scale)
-            else:
-                scale = int(scale)
-        self.displayScale = scale
-
-        scaledWidth = int(scale * CDG_DISPLAY_WIDTH)
-        scaledHeight = int(scale * CDG_DISPLAY_HEIGHT)
-
-        if manager.settings.CdgZoom == 'full':
-            # If we are allowing non-proportional scaling, allow
-            # scaledWidth and scaledHeight to be independent.
-            scaledWidth = winWidth
-            scaledHeight = winHeight
-
-        # And the center of the display after letterboxing.
-        self.displayRowOffset = (winWidth - scaledWidth) / 2
-        self.displayColOffset = (winHeight - scaledHeight) / 2
-
-        # Calculate the scaled width and height for each tile
-        if manager.settings.CdgZoom == 'soft':
-            self.displayTileWidth = CDG_DISPLAY_WIDTH / TILES_PER_ROW
-            self.displayTileHeight = CDG_DISPLAY_HEIGHT / TILES_PER_COL
-        else:
-            self.displayTileWidth = scaledWidth / TILES_PER_ROW
-            self.displayTileHeight = scaledHeight / TILES_PER_COL
+        self.stopDecodeAhead()
+        self.renderer.Resize(manager.displaySize)
+        self.cdgIdleUntil = None
+        self.frameDirty = True
 
     def getAudioProperties(self, soundFileData):
         """ Attempts to determine the samplerate, etc., from the
@@ -507,106 +1626,48 @@ class cdgPlayer(pykPlayer):
 
     # Actually update/refresh the video output
     def cdgDisplayUpdate(self):
-        # This routine is responsible for taking the unscaled output
-        # pixel data from self.cdgSurfarray, scaling it and blitting
-        # it to the actual display surface. The viewable area of the
-        # unscaled surface is 294x204 pixels.  Because scaling and
-        # blitting are heavy operations, we divide the screen into 24
-        # tiles, and only scale and blit those tiles which have been
-        # updated recently.  The CdgPacketReader class
-        # (self.packetReader) is responsible for keeping track of
-        # which areas of the screen have been modified.
-
-        # There are four different approaches for blitting tiles onto
-        # the display:
-
-        # settings.CdgZoom == 'none':
-        #   No scaling.  The CDG graphics are centered within the
-        #   display.  When a tile is dirty, it is blitted directly to
-        #   manager.surface.  After all dirty tiles have been blitted,
-        #   we then use display.update to flip only those rectangles
-        #   on the screen that have been blitted.
-
-        # settings.CdgZoom = 'quick':
-        #   Trivial scaling.  Similar to 'none', but each tile is
-        #   first scaled to its target scale using
-        #   pygame.transform.scale(), which is quick but gives a
-        #   pixelly result.  The scaled tile is then blitted to
-        #   manager.surface.
-
-        # settings.CdgZoom = 'int':
-        #   The same as 'quick', but the scaling is constrained to be
-        #   an integer multiple or divisor of its original size, which
-        #   may reduce artifacts somewhat.
-
-        # settings.CdgZoom = 'full':
-        #   The same as 'quick', but the scaling is allowed to
-        #   completely fill the window in both x and y, regardless of
-        #   aspect ratio constraints.
-
-        # settings.CdgZoom = 'soft':
-        #   Antialiased scaling.  We blit all tiles onto
-        #   self.workingSurface, which is maintained as the non-scaled
-        #   version of the CDG graphics, similar to 'none'.  Then,
-        #   after all dirty tiles have been blitted to
-        #   self.workingSurface, we use pygame.transform.rotozoom() to
-        #   make a nice, antialiased scaling of workingSurface to
-        #   manager.surface, and then flip the whole display.  (We
-        #   can't scale and blit the tiles one a time in this mode,
-        #   since that introduces artifacts between the tile edges.)
-        borderColour = self.packetReader.GetBorderColour()
-        if borderColour != self.borderColour:
-            # When the border colour changes, blit the whole screen
-            # and redraw it.
-            self.borderColour = borderColour
-            if borderColour != None:
-                manager.surface.fill(borderColour)
-                self.packetReader.MarkTilesDirty()
-
-        dirtyTiles = self.packetReader.GetDirtyTiles()
-        if not dirtyTiles:
-            # If no tiles are dirty, don't bother.
-            return
+        rect_list = self.renderer.Draw(manager.surface)
+        if rect_list != []:
+            self.frameDirty = True
+            self.cdgIdleUntil = None
+        elif self.ms_per_idle_update != self.ms_per_update:
+            # Nothing has changed, so drop to the idle rate until the
+            # next CDG command.
+            self.cdgIdleUntil = self.packetReader.GetNextCommandPos()
+            if self.cdgIdleUntil == None:
+                self.cdgIdleUntil = self.cdgNumPackets
+        if rect_list == None:
+            manager.Flip()
+        elif rect_list:
+            # Only update those areas which have changed
+            if manager.display:
+                pygame.display.update(rect_list)
 
-        # List of update rectangles (in scaled output window)
+    # Show the updates from the decode-ahead thread that are now due
+    def cdgShowUpdatesDue(self):
         rect_list = []
+        for patches, endOfStream, readPackets in self.decodeAhead.getUpdatesDue(self.curr_pos):
+            self.cdgReadPackets = readPackets
+            for rect, surface in patches:
+                if rect == None:
+                    manager.surface.blit(surface, (0, 0))
+                    rect_list = None
+                else:
+                    manager.surface.blit(surface, rect)
+                    if rect_list != None:
+                        rect_list.append(rect)
+                self.frameDirty = True
+            self.LastPos = self.curr_pos
+
+            if endOfStream:
+                self.Close()
+                break
 
-        # Scale and blit only those tiles which have been updated
-        for row, col in dirtyTiles:
-            self.packetReader.FillTile(self.workingTile, row, col)
-
-            if manager.settings.CdgZoom == 'none':
-                # The no-scale approach.
-                rect = pygame.Rect(self.displayTileWidth * row + self.displayRowOffset,
-                                   self.displayTileHeight * col + self.displayColOffset,
-                                   self.displayTileWidth, self.displayTileHeight)
-                manager.surface.blit(self.workingTile, rect)
-                rect_list.append(rect)
-
-            elif manager.settings.CdgZoom == 'soft':
-                # The soft-scale approach.
-                self.workingSurface.blit(self.workingTile, (self.displayTileWidth * row, self.displayTileHeight * col))
-
-            else:
-                # The quick-scale approach.
-                scaled = pygame.transform.scale(self.workingTile, (self.displayTileWidth,self.displayTileHeight))
-                rect = pygame.Rect(self.displayTileWidth * row + self.displayRowOffset,
-                                   self.displayTileHeight * col + self.displayColOffset,
-                                   self.displayTileWidth, self.displayTileHeight)
-                manager.surface.blit(scaled, rect)
-                rect_list.append(rect)
-
-        if manager.settings.CdgZoom == 'soft':
-            # Now scale and blit the whole screen.
-            scaled = pygame.transform.rotozoom(self.workingSurface, 0, self.displayScale)
-            manager.surface.blit(scaled, (self.displayRowOffset, self.displayColOffset))
+        if rect_list == None:
             manager.Flip()
-        elif len(rect_list) < 24:
-            # Only update those areas which have changed
+        elif rect_list:
             if manager.display:
                 pygame.display.update(rect_list)
-        else:
-            manager.Flip()
 
 def defaultErrorPrint(ErrorString):
     print (ErrorString)
@@ -21,11 +21,20 @@ On the off-chance a C compiler is not available or not reliable for
 some reason, you can use this implementation instead. """
 
 import pygame
+import struct
+from timeit import default_timer
 try:
     import Numeric as N
 except ImportError:
     import numpy.oldnumeric as N
 
+# numpy can look at the CDG file data in place, without copying it.
+# The older Numeric module has to make a copy.
+try:
+    frombuffer = N.frombuffer
+except AttributeError:
+    frombuffer = N.fromstring
+
 # CDG Command Code
 CDG_COMMAND             = 0x09
 
@@ -40,6 +49,19 @@ CDG_INST_LOAD_COL_TBL_0_7   = 30
 CDG_INST_LOAD_COL_TBL_8_15  = 31
 CDG_INST_TILE_BLOCK_XOR     = 38
 
+# The names of the instructions, as used by GetStats().
+CDG_INST_NAMES = {
+    CDG_INST_MEMORY_PRESET : 'MEMORY_PRESET',
+    CDG_INST_BORDER_PRESET : 'BORDER_PRESET',
+    CDG_INST_TILE_BLOCK : 'TILE_BLOCK',
+    CDG_INST_SCROLL_PRESET : 'SCROLL_PRESET',
+    CDG_INST_SCROLL_COPY : 'SCROLL_COPY',
+    CDG_INST_DEF_TRANSP_COL : 'DEF_TRANSP_COL',
+    CDG_INST_LOAD_COL_TBL_0_7 : 'LOAD_COL_TBL_0_7',
+    CDG_INST_LOAD_COL_TBL_8_15 : 'LOAD_COL_TBL_8_15',
+    CDG_INST_TILE_BLOCK_XOR : 'TILE_BLOCK_XOR',
+    }
+
 # Bitmask for all CDG fields
 CDG_MASK            = 0x3F
 
@@ -74,23 +96,58 @@ TILES_PER_COL           = 4
 TILE_WIDTH              = CDG_DISPLAY_WIDTH / TILES_PER_ROW
 TILE_HEIGHT             = CDG_DISPLAY_HEIGHT / TILES_PER_COL
 
+# Changes to the screen are tracked at the granularity of the CDG's
+# own 6x12 blocks, of which there are 50x18 across the full area.
+# GetDirtyRects() merges the dirty blocks into a handful of
+# rectangles, so that redrawing a frame in which only a few blocks
+# have changed touches only those pixels.
+BLOCK_WIDTH             = 6
+BLOCK_HEIGHT            = 12
+CDG_BLOCKS_WIDE         = CDG_FULL_WIDTH / BLOCK_WIDTH
+CDG_BLOCKS_HIGH         = CDG_FULL_HEIGHT / BLOCK_HEIGHT
+CDG_NUM_BLOCKS          = CDG_BLOCKS_WIDE * CDG_BLOCKS_HIGH
+
+# When no more than this many blocks are dirty, GetDirtyRects() checks
+# each of them in turn for changes; otherwise it compares the whole
+# screen at once.  This is a rough guess at where the two cost the
+# same.
+CHANGED_BLOCKS_LOOP_MAX = 32
+
 COLOUR_TABLE_SIZE       = 16
 
-class CdgPacket:
-    """ This class just represents a single 24-byte packet read from
-    the CDG stream.  It's not used outside this module. """
-    
-    def __init__(self, packetData):
-        self.command = packetData[0]
-        self.instruction = packetData[1]
-        #self.parityQ = packetData[2:4]
-        self.data = packetData[4:20]
-        #self.parity = packetData[20:24]
+# The offset and size of the data field within each 24-byte packet.
+# The remaining bytes are the command, instruction and parity fields.
+PACKET_SIZE             = 24
+PACKET_DATA_START       = 4
+PACKET_DATA_END         = 20
+
+# A compiled CDG stream, as made by pycdg.compileCdg(), begins with a
+# 24-byte header: this magic string, and then the number of packets
+# in the original stream as a little-endian 32-bit integer.  It is
+# followed by just those packets that do something, with the last
+# four bytes of each (the parity field) replaced by its position in
+# the original stream, also as a little-endian 32-bit integer.
+COMPILED_MAGIC          = 'PYKCDGC1'
+COMPILED_HEADER         = '<8sI12x'
+
+# The shift to apply to each byte of a tile block to extract each of
+# its six pixels, most significant bit first.  Arranged as a column so
+# that it broadcasts across the 12 bytes of the block, giving a 6x12
+# array indexed the same way as our pixel arrays.
+TILE_PIXEL_SHIFTS       = N.array([[5], [4], [3], [2], [1], [0]])
 
 class CdgPacketReader:
     """ This class does the all work of reading packets from the CDG
     file, and evaluating them to fill in pixels in a Numeric array.
-    Its public interface is in five methods. """
+    Its public interface is in these methods:
+
+    DoPackets(), CatchUp() and GetNextCommandPos() advance through
+    the stream, and Rewind(), GetState() and SetState() move around
+    in it.  GetDirtyRects() (or the older GetDirtyTiles()) reports
+    what has changed since the last call, and FillRect() (or
+    FillTile()) draws it; MarkTilesDirty() forces a full redraw.
+    GetBorderColour() and GetPalette() return the current colours,
+    and GetStats() the per-instruction statistics, if kept. """
 
     # In this class, we are aggressive with the use of the leading
     # double underscore, Python's convention to indicate private
@@ -100,13 +157,71 @@ class CdgPacketReader:
     # in practice, the C port follows this class structure quite
     # closely, including duplicating the private members.)
     
-    def __init__(self, cdgData, mapperSurface):
+    def __init__(self, cdgData, mapperSurface, usePalette = False,
+                 keepStats = False):
         self.__cdgData = cdgData
         self.__cdgDataPos = 0
 
+        # View the whole stream as an array of 24-byte packets, once,
+        # rather than slicing out and decoding each packet as we come
+        # to it.  A partial packet at the end of the file is ignored.
+        numPackets = len(cdgData) / PACKET_SIZE
+        packets = frombuffer(cdgData, N.UnsignedInt8)
+        packets = N.reshape(packets[:numPackets * PACKET_SIZE],
+                            (numPackets, PACKET_SIZE))
+
+        # Most packets in a typical file are not CDG commands at all,
+        # so we find the ones that are up front and never look at the
+        # others again.  __cdgCommandPositions is the sorted list of
+        # stream positions (in packets) of the CDG commands, and
+        # __cdgInstructions and __cdgPacketData hold the instruction
+        # code and data field of each of those packets.
+        if cdgData[:len(COMPILED_MAGIC)] == COMPILED_MAGIC:
+            # A compiled stream has done this work already.
+            magic, self.__cdgNumPackets = struct.unpack(COMPILED_HEADER, cdgData[:PACKET_SIZE])
+            packets = packets[1:]
+            position = packets[:, PACKET_DATA_END:].astype(N.Int32)
+            self.__cdgCommandPositions = position[:, 0] + (position[:, 1] << 8) + \
+                                         (position[:, 2] << 16) + (position[:, 3] << 24)
+        else:
+            self.__cdgNumPackets = numPackets
+            isCommand = N.equal(N.bitwise_and(packets[:, 0], CDG_MASK), CDG_COMMAND)
+            self.__cdgCommandPositions = N.compress(isCommand, N.arange(numPackets))
+            packets = N.take(packets, self.__cdgCommandPositions, 0)
+        instructions = N.bitwise_and(packets[:, 1], CDG_MASK)
+        self.__cdgInstructions = instructions.tolist()
+        self.__cdgPacketData = packets[:, PACKET_DATA_START:PACKET_DATA_END].astype(N.Int32)
+
+        # The index within __cdgCommandPositions of the next command
+        # to be processed.
+        self.__cdgCommandIndex = 0
+
         # This is just for the purpose of mapping colors.
         self.__mapperSurface = mapperSurface
 
+        # If usePalette is true, we are drawing onto 8-bit surfaces
+        # whose palette is the CDG colour table.  In this mode we
+        # keep only the array of colour indices; there is no RGB
+        # surfarray to keep up to date, so loading the colour table
+        # doesn't require redrawing every pixel.  The caller uses
+        # GetPalette() to fetch the colours.
+        self.__usePalette = usePalette
+
+        # This is set during CatchUp(), which leaves __cdgSurfarray
+        # and __dirtyBlocks alone until the end.
+        self.__catchingUp = False
+
+        # If keepStats is true, __stats maps each instruction code to
+        # a list of the statistics returned by GetStats(); see
+        # __cdgPacketProcessCounted().  __numRemaps and
+        # __blocksDirtied count all of the re-maps of the whole screen
+        # and the blocks marked dirty so far.
+        self.__stats = None
+        if keepStats:
+            self.__stats = {}
+        self.__numRemaps = 0
+        self.__blocksDirtied = 0
+
         self.Rewind()
         
     def Rewind(self):
@@ -115,12 +230,17 @@ class CdgPacketReader:
         again. """
         
         self.__cdgDataPos = 0
+        self.__cdgCommandIndex = 0
 
         # Initialise the colour table. Set a default value for any
         # CDG files that don't actually load the colour table
         # before doing something with it.
         defaultColour = 0
         self.__cdgColourTable = [defaultColour] * COLOUR_TABLE_SIZE
+        self.__cdgPalette = [(0, 0, 0)] * COLOUR_TABLE_SIZE
+        if self.__usePalette:
+            # Each colour index maps to itself on a palettized surface.
+            self.__cdgColourTable = range(COLOUR_TABLE_SIZE)
 
         self.__justClearedColourIndex = -1
         self.__cdgPresetColourIndex = -1
@@ -137,6 +257,18 @@ class CdgPacketReader:
         # one-pixel-at-a-time scrolls.
         self.__hOffset = 0
         self.__vOffset = 0
+
+        # These values implement scrolling.  Rather than moving every
+        # pixel on each scroll command, we treat the pixel arrays as
+        # circular, and keep track of where the top-left corner of
+        # the CDG screen currently lies within them.  A copy scroll
+        # then just moves this origin, and a preset scroll moves it
+        # and fills in one strip.  The origin is always a multiple of
+        # 6 pixels horizontally and 12 pixels vertically, so each
+        # 6x12 block of the screen is also a contiguous block of the
+        # arrays.
+        self.__hOrigin = 0
+        self.__vOrigin = 0
         
         # Build a 306x228 array for the pixel indeces, including border area
         self.__cdgPixelColours = N.zeros((CDG_FULL_WIDTH, CDG_FULL_HEIGHT))
@@ -145,41 +277,163 @@ class CdgPacketReader:
         # be changed by the various commands, and blitted to the
         # screen now and again. But the border area will not be
         # blitted, only the central 288x192 area.
-        self.__cdgSurfarray = N.zeros((CDG_FULL_WIDTH, CDG_FULL_HEIGHT))
-
-        # Start with all tiles requiring update
-        self.__updatedTiles = 0xFFFFFFFFL
+        self.__cdgSurfarray = None
+        if not self.__usePalette:
+            self.__cdgSurfarray = N.zeros((CDG_FULL_WIDTH, CDG_FULL_HEIGHT))
+
+        # One flag for each 6x12 block of the CDG screen, indexed
+        # [y][x] in blocks, which is set when that block has changed.
+        # These are screen positions, not positions within the
+        # circular pixel arrays.  Start with everything requiring
+        # update.
+        self.__dirtyBlocks = N.ones((CDG_BLOCKS_HIGH, CDG_BLOCKS_WIDE), N.UnsignedInt8)
+
+        # The colour index at each screen position, and the colour
+        # table, as they were at the last call to GetDirtyRects().
+        # Streams often paint a block with what is already there (or
+        # XOR it and XOR it back again), so a dirty block isn't
+        # reported unless its colours are now different from these.
+        # __redrawAll is set when the whole screen must be reported
+        # regardless.
+        self.__shownColours = N.zeros((CDG_FULL_WIDTH, CDG_FULL_HEIGHT))
+        self.__shownPalette = self.__cdgPalette[:]
+        self.__redrawAll = True
 
     def MarkTilesDirty(self):
-        """ Marks all the tiles dirty, so that the next call to
-        GetDirtyTiles() will return the complete list of tiles. """
+        """ Marks the whole screen dirty, so that the next call to
+        GetDirtyRects() or GetDirtyTiles() will return all of it. """
         
-        self.__updatedTiles = 0xFFFFFFFFL
+        self.__redrawAll = True
+
+    def GetDirtyRects(self):
+        """ Returns a list of (x, y, w, h) tuples, in pixels within
+        the visible CDG_DISPLAY_WIDTH x CDG_DISPLAY_HEIGHT area,
+        covering all of the parts of the screen that have changed.
+        Then resets the dirty area to empty. """
+
+        dirtyBlocks = self.__findChangedBlocks()
+
+        # The range of blocks that are at least partly visible.
+        firstX = (6 + self.__hOffset) / BLOCK_WIDTH
+        lastX = (6 + self.__hOffset + CDG_DISPLAY_WIDTH - 1) / BLOCK_WIDTH
+        firstY = (12 + self.__vOffset) / BLOCK_HEIGHT
+        lastY = (12 + self.__vOffset + CDG_DISPLAY_HEIGHT - 1) / BLOCK_HEIGHT
+
+        # Find the runs of dirty blocks along each row, and merge
+        # each run with the same run on the row above, if there is
+        # one.  openRuns maps (x0, x1) for each run on the previous
+        # row to the row its rectangle started on.
+        blocks = []
+        openRuns = {}
+        rows = N.sometrue(dirtyBlocks[:, firstX:lastX + 1], 1)
+        for by in range(firstY, lastY + 2):
+            runs = []
+            if by <= lastY and rows[by]:
+                row = dirtyBlocks[by].tolist()
+                bx = firstX
+                while bx <= lastX:
+                    if row[bx]:
+                        x0 = bx
+                        while bx <= lastX and row[bx]:
+                            bx += 1
+                        runs.append((x0, bx))
+                    else:
+                        bx += 1
+
+            for run, y0 in openRuns.items():
+                if run not in runs:
+                    blocks.append((run[0], y0, run[1], by))
+                    del openRuns[run]
+            for run in runs:
+                if run not in openRuns:
+                    openRuns[run] = by
+
+        self.__dirtyBlocks[:,:] = 0
+        self.__redrawAll = False
+
+        # Convert the blocks to pixels on the visible area.
+        rects = []
+        for x0, y0, x1, y1 in blocks:
+            x0 = max(x0 * BLOCK_WIDTH - 6 - self.__hOffset, 0)
+            x1 = min(x1 * BLOCK_WIDTH - 6 - self.__hOffset, CDG_DISPLAY_WIDTH)
+            y0 = max(y0 * BLOCK_HEIGHT - 12 - self.__vOffset, 0)
+            y1 = min(y1 * BLOCK_HEIGHT - 12 - self.__vOffset, CDG_DISPLAY_HEIGHT)
+            rects.append((x0, y0, x1 - x0, y1 - y0))
+
+        return rects
 
     def GetDirtyTiles(self):
         """ Returns a list of (row, col) tuples, corresponding to all
         of the currently-dirty tiles.  Then resets the list of dirty
         tiles to empty. """
+
+        updatedTiles = 0
+        for x, y, w, h in self.GetDirtyRects():
+            for col in range(y / TILE_HEIGHT, (y + h - 1) / TILE_HEIGHT + 1):
+                for row in range(x / TILE_WIDTH, (x + w - 1) / TILE_WIDTH + 1):
+                    updatedTiles |= ((1 << row) << (col * 8))
         
         tiles = []
-        if self.__updatedTiles != 0:
+        if updatedTiles != 0:
             for col in range(TILES_PER_COL):
                 for row in range(TILES_PER_ROW):
-                    if (self.__updatedTiles & ((1 << row) << (col * 8))):
+                    if (updatedTiles & ((1 << row) << (col * 8))):
                         tiles.append((row, col))
 
-        self.__updatedTiles = 0
         return tiles
 
     def GetBorderColour(self):
         """ Returns the current border colour, as a mapped integer
-        ready to apply to the surface.  Returns None if the border
-        colour has not yet been specified by the CDG stream. """
+        ready to apply to the surface (or, in palette mode, as a colour
+        index).  Returns None if the border colour has not yet been
+        specified by the CDG stream. """
         
         if self.__cdgBorderColourIndex == -1:
             return None
         return self.__cdgColourTable[self.__cdgBorderColourIndex]
 
+    def GetPalette(self):
+        """ Returns the current colour table, as a list of 16 (r, g,
+        b) tuples suitable for passing to Surface.set_palette(). """
+
+        return self.__cdgPalette[:]
+
+    def GetState(self):
+        """ Returns a snapshot of the decoder's current state, which
+        may later be passed to SetState() to return to this point in
+        the stream.  Only the colour indices are saved; the RGB
+        values are recomputed from them when the snapshot is
+        restored. """
+
+        return (self.__cdgDataPos, self.__cdgCommandIndex,
+                self.__cdgColourTable[:], self.__cdgPalette[:],
+                self.__justClearedColourIndex, self.__cdgPresetColourIndex,
+                self.__cdgBorderColourIndex, self.__cdgTransparentColour,
+                self.__hOffset, self.__vOffset,
+                self.__hOrigin, self.__vOrigin,
+                self.__cdgPixelColours.astype(N.UnsignedInt8))
+
+    def SetState(self, state):
+        """ Restores the decoder to a state previously returned by
+        GetState(), and marks all the tiles dirty. """
+
+        (self.__cdgDataPos, self.__cdgCommandIndex,
+         colourTable, palette,
+         self.__justClearedColourIndex, self.__cdgPresetColourIndex,
+         self.__cdgBorderColourIndex, self.__cdgTransparentColour,
+         self.__hOffset, self.__vOffset,
+         self.__hOrigin, self.__vOrigin,
+         pixelColours) = state
+        self.__cdgColourTable = colourTable[:]
+        self.__cdgPalette = palette[:]
+        self.__cdgPixelColours[:,:] = pixelColours
+
+        if not self.__usePalette:
+            lookupTable = N.array(self.__cdgColourTable)
+            self.__cdgSurfarray.flat[:] = N.take(lookupTable, N.ravel(self.__cdgPixelColours))
+
+        self.__redrawAll = True
+
     def DoPackets(self, numPackets):
         """ Reads numPackets 24-byte packets from the CDG stream, and
         processes their instructions on the internal tables stored
@@ -187,77 +441,247 @@ class CdgPacketReader:
         the end-of-file has been reached and no more packets can be
         processed."""
         
-        for i in range(numPackets):
-            # Extract the nexxt packet
-            packd = self.__getNextPacket()
-            if not packd:
-                # No more packets.  Return False, but only if we
-                # reached this condition on the first packet.
-                return (i != 0)
+        if numPackets <= 0:
+            return True
+        if self.__cdgDataPos >= self.__cdgNumPackets:
+            # No more packets.
+            return False
+
+        # Process all of the CDG commands that fall within the next
+        # numPackets packets of the stream.  The other packets don't
+        # need to be looked at.
+        endPos = min(self.__cdgDataPos + numPackets, self.__cdgNumPackets)
+        endIndex = N.searchsorted(self.__cdgCommandPositions, endPos)
+        process = self.__cdgPacketProcess
+        if self.__stats != None:
+            process = self.__cdgPacketProcessCounted
+        for i in range(self.__cdgCommandIndex, endIndex):
+            process(self.__cdgInstructions[i], self.__cdgPacketData[i])
+
+        self.__cdgCommandIndex = endIndex
+        self.__cdgDataPos = endPos
+        return True
 
-            self.__cdgPacketProcess (packd)
+    def CatchUp(self, numPackets):
+        """ Does the same as DoPackets(), more quickly, for a long run
+        of packets with no screen update in between.  The RGB values
+        of the pixels and the dirty area are not kept up to date as
+        each command is processed; the RGB values are worked out once
+        at the end, and the whole screen is marked dirty. """
+
+        self.__catchingUp = True
+        try:
+            result = self.DoPackets(numPackets)
+        finally:
+            self.__catchingUp = False
+
+        if not self.__usePalette:
+            lookupTable = N.array(self.__cdgColourTable)
+            self.__cdgSurfarray.flat[:] = N.take(lookupTable, N.ravel(self.__cdgPixelColours))
+        self.__redrawAll = True
+        return result
+
+    def GetNextCommandPos(self):
+        """ Returns the position in the stream (in packets) of the
+        next CDG command that DoPackets() will process, or None if
+        there are no more. """
+
+        if self.__cdgCommandIndex >= len(self.__cdgCommandPositions):
+            return None
+        return int(self.__cdgCommandPositions[self.__cdgCommandIndex])
 
-        return True
+    def GetStats(self):
+        """ If the reader was made with keepStats true, returns a
+        dictionary with an entry for each type of CDG instruction
+        processed so far, mapping its name to a tuple of (count,
+        total seconds, re-maps of the whole screen, 6x12 blocks
+        marked dirty).  (The C version gives the re-maps as None,
+        since it never does one.)  Otherwise, returns None. """
+
+        if self.__stats == None:
+            return None
+
+        stats = {}
+        for inst_code, (count, seconds, remaps, dirtied) in self.__stats.items():
+            name = CDG_INST_NAMES.get(inst_code, 'UNKNOWN_%d' % (inst_code))
+            stats[name] = (count, seconds, remaps, dirtied)
+        return stats
 
     def FillTile(self, surface, row, col):
         """ Fills in the pixels on the indicated one-tile surface
         (which must be a TILE_WIDTH x TILE_HEIGHT sized surface) with
         the pixels from the indicated tile. """
         
-        # Calculate the row & column starts/ends
-        row_start = 6 + self.__hOffset + (row * TILE_WIDTH)
-        row_end = 6 + self.__hOffset + ((row + 1) * TILE_WIDTH)
-        col_start = 12 + self.__vOffset + (col * TILE_HEIGHT)
-        col_end = 12 + self.__vOffset + ((col + 1) * TILE_HEIGHT)
-        pygame.surfarray.blit_array( \
-            surface, \
-            self.__cdgSurfarray[row_start:row_end, col_start:col_end])
+        tile = self.__getArea(row * TILE_WIDTH, col * TILE_HEIGHT,
+                              TILE_WIDTH, TILE_HEIGHT)
+        pygame.surfarray.blit_array(surface, tile)
+
+    def FillRect(self, surface, rect, pos = None):
+        """ Fills in the pixels within the indicated (x, y, w, h)
+        rectangle of the visible area, as returned by GetDirtyRects(),
+        onto the indicated surface, with its top-left corner at pos.
+        If pos is omitted, the pixels go at the same position on the
+        surface (which then must be a CDG_DISPLAY_WIDTH x
+        CDG_DISPLAY_HEIGHT sized surface). """
+
+        x, y, w, h = rect
+        if pos is None:
+            pos = (x, y)
+        area = self.__getArea(x, y, w, h)
+        pygame.surfarray.blit_array(surface.subsurface(pos, (w, h)), area)
 
 
     # The remaining methods are all private; they are not part of the
     # public interface.
 
-    # Read the next CDG command from the file (24 bytes each)
-    def __getNextPacket(self):
-        packetData = map(ord, self.__cdgData[self.__cdgDataPos : self.__cdgDataPos + 24])
-        self.__cdgDataPos += 24
-        if (len(packetData) == 24):
-            return CdgPacket(packetData)
-        else:
-            self.__cdgDataPos = len(self.__cdgData)
-            return None
-
-    # Decode and perform the CDG commands in the indicated packet.
-    def __cdgPacketProcess (self, packd):
-        if (packd.command & CDG_MASK) == CDG_COMMAND:
-            inst_code = (packd.instruction & CDG_MASK)
-            if inst_code == CDG_INST_MEMORY_PRESET:
-                self.__cdgMemoryPreset (packd)
-            elif inst_code == CDG_INST_BORDER_PRESET:
-                self.__cdgBorderPreset (packd)
-            elif inst_code == CDG_INST_TILE_BLOCK:
-                self.__cdgTileBlockCommon(packd, xor = 0)
-            elif inst_code == CDG_INST_SCROLL_PRESET:
-                self.__cdgScrollPreset (packd)
-            elif inst_code == CDG_INST_SCROLL_COPY:
-                self.__cdgScrollCopy (packd)
-            elif inst_code == CDG_INST_DEF_TRANSP_COL:
-                self.__cdgDefineTransparentColour (packd)
-            elif inst_code == CDG_INST_LOAD_COL_TBL_0_7:
-                self.__cdgLoadColourTableCommon (packd, 0)
-            elif inst_code == CDG_INST_LOAD_COL_TBL_8_15:
-                self.__cdgLoadColourTableCommon (packd, 1)
-            elif inst_code == CDG_INST_TILE_BLOCK_XOR:
-                self.__cdgTileBlockCommon(packd, xor = 1)
+    # Returns an array of flags, like __dirtyBlocks, for the blocks
+    # that must be redrawn: the dirty blocks whose colours are not the
+    # same as when they were last shown.  Then brings __shownColours
+    # and __shownPalette up to date.  When only a few blocks are
+    # dirty, as while lyrics are drawn, each is looked at in place in
+    # the circular pixel array, as in the C version.  When more are
+    # (after a scroll, say), a Python loop over them would cost more
+    # than it saves, so the whole screen is compared at once instead.
+    def __findChangedBlocks(self):
+        if not self.__redrawAll:
+            dirty = N.nonzero(N.ravel(self.__dirtyBlocks))
+            if len(dirty) == 0:
+                return self.__dirtyBlocks
+
+        # The colour indices whose colour has changed, if any.
+        changedPalette = [int(self.__cdgPalette[i] != self.__shownPalette[i])
+                          for i in range(COLOUR_TABLE_SIZE)]
+        paletteChanged = (1 in changedPalette)
+        changedPalette = N.array(changedPalette)
+
+        if self.__redrawAll or len(dirty) > CHANGED_BLOCKS_LOOP_MAX:
+            return self.__findChangedBlocksWhole(changedPalette, paletteChanged)
+
+        changed = N.zeros((CDG_BLOCKS_HIGH, CDG_BLOCKS_WIDE), N.UnsignedInt8)
+        pixels = self.__cdgPixelColours
+        for i in dirty:
+            by, bx = divmod(int(i), CDG_BLOCKS_WIDE)
+
+            # The block's position on the screen, and within the
+            # circular pixel array.  Only a block on the edge of the
+            # array can wrap around it.
+            sx = bx * BLOCK_WIDTH
+            sy = by * BLOCK_HEIGHT
+            x = (sx + self.__hOrigin) % CDG_FULL_WIDTH
+            y = (sy + self.__vOrigin) % CDG_FULL_HEIGHT
+            if x + BLOCK_WIDTH <= CDG_FULL_WIDTH and y + BLOCK_HEIGHT <= CDG_FULL_HEIGHT:
+                colours = pixels[x:x + BLOCK_WIDTH, y:y + BLOCK_HEIGHT]
             else:
-                # Don't use the error popup, ignore the unsupported command
-                ErrorString = "CDG file may be corrupt, cmd: " + str(inst_code)
-                print (ErrorString)
+                xs = (N.arange(sx, sx + BLOCK_WIDTH) + self.__hOrigin) % CDG_FULL_WIDTH
+                ys = (N.arange(sy, sy + BLOCK_HEIGHT) + self.__vOrigin) % CDG_FULL_HEIGHT
+                colours = N.take(N.take(pixels, xs, 0), ys, 1)
+
+            # The block has changed if any of its pixels has a
+            # different colour index, or one whose colour is now
+            # different.
+            shown = self.__shownColours[sx:sx + BLOCK_WIDTH, sy:sy + BLOCK_HEIGHT]
+            if N.sometrue(N.ravel(N.not_equal(colours, shown))) or \
+               (paletteChanged and N.sometrue(N.take(changedPalette, N.ravel(colours)))):
+                shown[:,:] = colours
+                changed[by, bx] = 1
+
+        self.__shownPalette = self.__cdgPalette[:]
+        return changed
+
+    # Does the work of __findChangedBlocks() for the whole screen at
+    # once.
+    def __findChangedBlocksWhole(self, changedPalette, paletteChanged):
+        # Lay out the circular pixel array in screen order.
+        colours = self.__cdgPixelColours
+        colours = N.concatenate((colours[self.__hOrigin:], colours[:self.__hOrigin]), 0)
+        colours = N.concatenate((colours[:, self.__vOrigin:], colours[:, :self.__vOrigin]), 1)
+
+        if self.__redrawAll:
+            changed = N.ones((CDG_BLOCKS_HIGH, CDG_BLOCKS_WIDE), N.UnsignedInt8)
+        else:
+            # Find the pixels with a different colour index, or whose
+            # colour index now has a different colour.
+            changed = N.not_equal(colours, self.__shownColours)
+            if paletteChanged:
+                changed = N.logical_or(changed, N.take(changedPalette, colours))
+
+            # Then the dirty blocks with any such pixels.
+            changed = N.reshape(changed, (CDG_BLOCKS_WIDE, BLOCK_WIDTH,
+                                          CDG_BLOCKS_HIGH, BLOCK_HEIGHT))
+            changed = N.sometrue(N.sometrue(changed, 3), 1)
+            changed = N.logical_and(N.transpose(changed), self.__dirtyBlocks)
+
+        self.__shownColours = colours
+        self.__shownPalette = self.__cdgPalette[:]
+        return changed
+
+    # Returns the array of pixels (RGB values, or colour indices in
+    # palette mode) for the indicated rectangle of the visible area.
+    def __getArea(self, x, y, w, h):
+        # Calculate the row & column starts/ends
+        row_start = 6 + self.__hOffset + x
+        row_end = row_start + w
+        col_start = 12 + self.__vOffset + y
+        col_end = col_start + h
+        pixels = self.__cdgSurfarray
+        if self.__usePalette:
+            pixels = self.__cdgPixelColours
+
+        # Find the area within the circular pixel array.  Usually it
+        # is a simple slice; if it wraps around the edge of the
+        # array, we have to gather its rows and columns instead.
+        x = (row_start + self.__hOrigin) % CDG_FULL_WIDTH
+        y = (col_start + self.__vOrigin) % CDG_FULL_HEIGHT
+        if x + w <= CDG_FULL_WIDTH and y + h <= CDG_FULL_HEIGHT:
+            return pixels[x:x + w, y:y + h]
+
+        xs = (N.arange(row_start, row_end) + self.__hOrigin) % CDG_FULL_WIDTH
+        ys = (N.arange(col_start, col_end) + self.__vOrigin) % CDG_FULL_HEIGHT
+        return N.take(N.take(pixels, xs, 0), ys, 1)
+
+    # Does the same as __cdgPacketProcess(), and adds to the
+    # statistics for the instruction.
+    def __cdgPacketProcessCounted (self, inst_code, data_block):
+        remaps = self.__numRemaps
+        dirtied = self.__blocksDirtied
+        start = default_timer()
+        self.__cdgPacketProcess(inst_code, data_block)
+        stats = self.__stats.setdefault(inst_code, [0, 0.0, 0, 0])
+        stats[0] += 1
+        stats[1] += default_timer() - start
+        stats[2] += self.__numRemaps - remaps
+        stats[3] += self.__blocksDirtied - dirtied
+
+    # Perform the indicated CDG instruction, given the data field
+    # of its packet.
+    def __cdgPacketProcess (self, inst_code, data_block):
+        if inst_code == CDG_INST_MEMORY_PRESET:
+            self.__cdgMemoryPreset (data_block)
+        elif inst_code == CDG_INST_BORDER_PRESET:
+            self.__cdgBorderPreset (data_block)
+        elif inst_code == CDG_INST_TILE_BLOCK:
+            self.__cdgTileBlockCommon(data_block, xor = 0)
+        elif inst_code == CDG_INST_SCROLL_PRESET:
+            self.__cdgScrollPreset (data_block)
+        elif inst_code == CDG_INST_SCROLL_COPY:
+            self.__cdgScrollCopy (data_block)
+        elif inst_code == CDG_INST_DEF_TRANSP_COL:
+            self.__cdgDefineTransparentColour (data_block)
+        elif inst_code == CDG_INST_LOAD_COL_TBL_0_7:
+            self.__cdgLoadColourTableCommon (data_block, 0)
+        elif inst_code == CDG_INST_LOAD_COL_TBL_8_15:
+            self.__cdgLoadColourTableCommon (data_block, 1)
+        elif inst_code == CDG_INST_TILE_BLOCK_XOR:
+            self.__cdgTileBlockCommon(data_block, xor = 1)
+        else:
+            # Don't use the error popup, ignore the unsupported command
+            ErrorString = "CDG file may be corrupt, cmd: " + str(inst_code)
+            print (ErrorString)
 
     # Memory preset (clear the viewable area + border)
-    def __cdgMemoryPreset (self, packd):
-        colour = packd.data[0] & 0x0F
-        repeat = packd.data[1] & 0x0F
+    def __cdgMemoryPreset (self, data_block):
+        colour = data_block[0] & 0x0F
+        repeat = data_block[1] & 0x0F
 
         # The "repeat" flag is nonzero if this is a repeat of a
         # previously-appearing preset command.  (Often a CDG will
@@ -280,6 +704,11 @@ class CdgPacketReader:
         # commands should also change the border
         self.__cdgPresetColourIndex = colour
         self.__cdgBorderColourIndex = self.__cdgPresetColourIndex
+
+        # Since every pixel is being set, this is a good time to put
+        # the scroll origin back where it started.
+        self.__hOrigin = 0
+        self.__vOrigin = 0
         
         # Note that this may be done before any load colour table
         # commands by some CDGs. So the load colour table itself
@@ -296,22 +725,22 @@ class CdgPacketReader:
         # screen, and the stripes of 12 pixels on the top and bottom
         # of the screen.
         
-        # The most efficient way of setting the values in a Numeric
-        # array, is to create a zero array and do addition on the
-        # the border and preset slices.
-        self.__cdgPixelColours = N.zeros([CDG_FULL_WIDTH, CDG_FULL_HEIGHT])
-        self.__cdgPixelColours[:,:] = self.__cdgPixelColours[:,:] + colour
+        # The arrays are filled in place; since a disc often sends a
+        # string of these commands, we don't want to allocate new
+        # arrays for each one.
+        self.__cdgPixelColours[:,:] = colour
         
         # Now set the border and preset colour in our local surfarray. 
         # This will be blitted next time there is a screen update.
-        self.__cdgSurfarray = N.zeros([CDG_FULL_WIDTH, CDG_FULL_HEIGHT])
-        self.__cdgSurfarray[:,:] = self.__cdgSurfarray[:,:] + self.__cdgColourTable[colour]
+        if not self.__usePalette and not self.__catchingUp:
+            self.__cdgSurfarray[:,:] = self.__cdgColourTable[colour]
 
-        self.__updatedTiles = 0xFFFFFFFFL
+        self.__dirtyBlocks[:,:] = 1
+        self.__blocksDirtied += CDG_NUM_BLOCKS
 
     # Border Preset (clear the border area only) 
-    def __cdgBorderPreset (self, packd):
-        colour = packd.data[0] & 0x0F
+    def __cdgBorderPreset (self, data_block):
+        colour = data_block[0] & 0x0F
         if colour == self.__cdgBorderColourIndex:
             return
         
@@ -320,38 +749,47 @@ class CdgPacketReader:
         # See cdgMemoryPreset() for a description of what's going on.
         # In this case we are only clearing the border area.
 
-        # Set up the border area of the pixel colours array
-        self.__cdgPixelColours[:,:12] = N.zeros([CDG_FULL_WIDTH, 12])
-        self.__cdgPixelColours[:,:12] = self.__cdgPixelColours[:,:12] + self.__cdgBorderColourIndex
-        self.__cdgPixelColours[:,-12:] = N.zeros([CDG_FULL_WIDTH, 12])
-        self.__cdgPixelColours[:,-12:] = self.__cdgPixelColours[:,-12:] + self.__cdgBorderColourIndex
-        self.__cdgPixelColours[:6,12:-12] = N.zeros([6, CDG_FULL_HEIGHT - 24]) 
-        self.__cdgPixelColours[:6,12:-12] = self.__cdgPixelColours[:6,12:-12] + self.__cdgBorderColourIndex
-        self.__cdgPixelColours[-6:,12:-12] = N.zeros([6, CDG_FULL_HEIGHT - 24]) 
-        self.__cdgPixelColours[-6:,12:-12] = self.__cdgPixelColours[-6:,12:-12] + self.__cdgBorderColourIndex
-
-        # Now that we have set the PixelColours, apply them to
-        # the Surfarray.
-        lookupTable = N.array(self.__cdgColourTable)
-        self.__cdgSurfarray.flat[:] = N.take(lookupTable, N.ravel(self.__cdgPixelColours))
-
+        # Set up the border area of the pixel colours array.  The
+        # border strips are found relative to the scroll origin; the
+        # left and right strips are set for the full height, which
+        # includes the corners already covered by the top and bottom
+        # strips.  Only these strips of the RGB surfarray need to
+        # change too.
+        top = self.__vOrigin
+        bottom = (self.__vOrigin + CDG_FULL_HEIGHT - 12) % CDG_FULL_HEIGHT
+        left = self.__hOrigin
+        right = (self.__hOrigin + CDG_FULL_WIDTH - 6) % CDG_FULL_WIDTH
+        strips = [(slice(None), slice(top, top + 12)),
+                  (slice(None), slice(bottom, bottom + 12)),
+                  (slice(left, left + 6), slice(None)),
+                  (slice(right, right + 6), slice(None))]
+        for strip in strips:
+            self.__cdgPixelColours[strip] = colour
+            if not self.__usePalette and not self.__catchingUp:
+                self.__cdgSurfarray[strip] = self.__cdgColourTable[colour]
+
+        # The strips are the outermost blocks of the screen.
+        self.__dirtyBlocks[0,:] = 1
+        self.__dirtyBlocks[-1,:] = 1
+        self.__dirtyBlocks[:,0] = 1
+        self.__dirtyBlocks[:,-1] = 1
+        self.__blocksDirtied += 2 * CDG_BLOCKS_WIDE + 2 * (CDG_BLOCKS_HIGH - 2)
         return
 
     # CDG Scroll Command - Set the scrolled in area with a fresh colour
-    def __cdgScrollPreset (self, packd):
-        self.__cdgScrollCommon (packd, copy = False)
+    def __cdgScrollPreset (self, data_block):
+        self.__cdgScrollCommon (data_block, copy = False)
         return
 
     # CDG Scroll Command - Wrap the scrolled out area into the opposite side
-    def __cdgScrollCopy (self, packd):
-        self.__cdgScrollCommon (packd, copy = True)
+    def __cdgScrollCopy (self, data_block):
+        self.__cdgScrollCommon (data_block, copy = True)
         return
 
     # Common function to handle the actual pixel scroll for Copy and Preset
-    def __cdgScrollCommon (self, packd, copy):
+    def __cdgScrollCommon (self, data_block, copy):
 
         # Decode the scroll command parameters
-        data_block = packd.data
         colour = data_block[0] & 0x0F
         hScroll = data_block[1] & 0x3F
         vScroll = data_block[2] & 0x3F
@@ -380,7 +818,7 @@ class CdgPacketReader:
             # Changing the screen shift.
             self.__hOffset = min(hOffset, 5)
             self.__vOffset = min(vOffset, 11)
-            self.__updatedTiles = 0xFFFFFFFFL
+            self.__redrawAll = True
 
         if hScrollLeftPixels == 0 and \
            hScrollRightPixels == 0 and \
@@ -389,69 +827,83 @@ class CdgPacketReader:
             # Never mind.
             return
 
-        # Perform the actual scroll. Use surfarray and slicing to make
-        # this efficient. A copy scroll (where the data scrolls round)
-        # can be achieved by slicing and concatenating again.
-        # For non-copy, the new slice is filled in with a new colour.
-        if (copy == True):
-            if (vScrollUpPixels > 0):
-                self.__cdgPixelColours = N.concatenate((self.__cdgPixelColours[:,vScrollUpPixels:], self.__cdgPixelColours[:,:vScrollUpPixels]), 1)
-            elif (vScrollDownPixels > 0):
-                self.__cdgPixelColours = N.concatenate((self.__cdgPixelColours[:,-vScrollDownPixels:], self.__cdgPixelColours[:,:-vScrollDownPixels]), 1)
-            elif (hScrollLeftPixels > 0):
-                self.__cdgPixelColours = N.concatenate((self.__cdgPixelColours[hScrollLeftPixels:,:], self.__cdgPixelColours[:hScrollLeftPixels,:]), 0)
-            elif (hScrollRightPixels > 0):
-                self.__cdgPixelColours = N.concatenate((self.__cdgPixelColours[-hScrollRightPixels:,:], self.__cdgPixelColours[:-hScrollRightPixels,:]), 0)
-        elif (copy == False):
-            if (vScrollUpPixels > 0):
-                copyBlockActualColour = N.zeros([CDG_FULL_WIDTH,vScrollUpPixels]) + self.__cdgColourTable[colour]
-                copyBlockColourIndex = N.zeros([CDG_FULL_WIDTH,vScrollUpPixels]) + colour
-                self.__cdgPixelColours = N.concatenate((self.__cdgPixelColours[:,vScrollUpPixels:], copyBlockColourIndex), 1)
-            elif (vScrollDownPixels > 0):
-                copyBlockActualColour = N.zeros([CDG_FULL_WIDTH,vScrollDownPixels]) + self.__cdgColourTable[colour]
-                copyBlockColourIndex = N.zeros([CDG_FULL_WIDTH,vScrollDownPixels]) + colour
-                self.__cdgPixelColours = N.concatenate((copyBlockColourIndex, self.__cdgPixelColours[:,:-vScrollDownPixels]), 1)
-            elif (hScrollLeftPixels > 0):
-                copyBlockActualColour = N.zeros([hScrollLeftPixels, CDG_FULL_HEIGHT]) + self.__cdgColourTable[colour]
-                copyBlockColourIndex = N.zeros([hScrollLeftPixels, CDG_FULL_HEIGHT]) + colour
-                self.__cdgPixelColours = N.concatenate((self.__cdgPixelColours[hScrollLeftPixels:,:], copyBlockColourIndex), 0)
-            elif (hScrollRightPixels > 0):
-                copyBlockActualColour = N.zeros([hScrollRightPixels, CDG_FULL_HEIGHT]) + self.__cdgColourTable[colour]
-                copyBlockColourIndex = N.zeros([hScrollRightPixels, CDG_FULL_HEIGHT]) + colour
-                self.__cdgPixelColours = N.concatenate((copyBlockColourIndex, self.__cdgPixelColours[:-hScrollRightPixels,:]), 0)
-
-        # Now that we have scrolled the PixelColours, apply them to
-        # the Surfarray.
-        
-        lookupTable = N.array(self.__cdgColourTable)
-        self.__cdgSurfarray.flat[:] = N.take(lookupTable, N.ravel(self.__cdgPixelColours))
-        
+        # Perform the actual scroll.  A copy scroll (where the data
+        # scrolls round) is just a move of the scroll origin.  For
+        # non-copy, the strip that has scrolled into view is then
+        # filled in with a new colour.  Since the origin moves in
+        # whole 6x12 blocks, that strip is always a contiguous slice
+        # of the pixel arrays.
+        if (vScrollUpPixels > 0):
+            self.__vOrigin = (self.__vOrigin + vScrollUpPixels) % CDG_FULL_HEIGHT
+            y = (self.__vOrigin - vScrollUpPixels) % CDG_FULL_HEIGHT
+            strip = (slice(None), slice(y, y + vScrollUpPixels))
+        elif (vScrollDownPixels > 0):
+            self.__vOrigin = (self.__vOrigin - vScrollDownPixels) % CDG_FULL_HEIGHT
+            y = self.__vOrigin
+            strip = (slice(None), slice(y, y + vScrollDownPixels))
+        elif (hScrollLeftPixels > 0):
+            self.__hOrigin = (self.__hOrigin + hScrollLeftPixels) % CDG_FULL_WIDTH
+            x = (self.__hOrigin - hScrollLeftPixels) % CDG_FULL_WIDTH
+            strip = (slice(x, x + hScrollLeftPixels), slice(None))
+        elif (hScrollRightPixels > 0):
+            self.__hOrigin = (self.__hOrigin - hScrollRightPixels) % CDG_FULL_WIDTH
+            x = self.__hOrigin
+            strip = (slice(x, x + hScrollRightPixels), slice(None))
+
+        if (copy == False):
+            self.__cdgPixelColours[strip] = colour
+            if not self.__usePalette and not self.__catchingUp:
+                self.__cdgSurfarray[strip] = self.__cdgColourTable[colour]
+
         # We have modified our local cdgSurfarray. This will be blitted to
         # the screen by cdgDisplayUpdate()
-        self.__updatedTiles = 0xFFFFFFFFL
+        self.__dirtyBlocks[:,:] = 1
+        self.__blocksDirtied += CDG_NUM_BLOCKS
 
     # Set one of the colour indeces as transparent. Don't actually do anything with this
     # at the moment, as there is currently no mechanism for overlaying onto a movie file.
-    def __cdgDefineTransparentColour (self, packd):
-        data_block = packd.data
+    def __cdgDefineTransparentColour (self, data_block):
         colour = data_block[0] & 0x0F
         self.__cdgTransparentColour = colour
         return
 
     # Load the RGB value for colours 0..7 or 8..15 in the lookup table
-    def __cdgLoadColourTableCommon (self, packd, table):
+    def __cdgLoadColourTableCommon (self, data_block, table):
         if table == 0:
             colourTableStart = 0
         else:
             colourTableStart = 8
+
+        # Streams typically load the same colours again and again.
+        # If none of them is actually changing, there is nothing to
+        # do.
+        colours = []
         for i in range(8):
-            colourEntry = ((packd.data[2 * i] & CDG_MASK) << 8)
-            colourEntry = colourEntry + (packd.data[(2 * i) + 1] & CDG_MASK)
+            colourEntry = ((data_block[2 * i] & CDG_MASK) << 8)
+            colourEntry = colourEntry + (data_block[(2 * i) + 1] & CDG_MASK)
             colourEntry = ((colourEntry & 0x3F00) >> 2) | (colourEntry & 0x003F)
             red = ((colourEntry & 0x0F00) >> 8) * 17
             green = ((colourEntry & 0x00F0) >> 4) * 17
             blue = ((colourEntry & 0x000F)) * 17
-            self.__cdgColourTable[i + colourTableStart] = self.__mapperSurface.map_rgb(red, green, blue)
+            colours.append((red, green, blue))
+        if colours == self.__cdgPalette[colourTableStart:colourTableStart + 8]:
+            return
+
+        for i in range(8):
+            red, green, blue = colours[i]
+            self.__cdgPalette[i + colourTableStart] = (red, green, blue)
+            if not self.__usePalette:
+                self.__cdgColourTable[i + colourTableStart] = self.__mapperSurface.map_rgb(red, green, blue)
+
+        if self.__usePalette or self.__catchingUp:
+            # In palette mode, that's all there is to do: the pixels
+            # themselves are unchanged, and the caller will pick up
+            # the new colours from GetPalette().  And CatchUp() will
+            # redraw the whole screen at the end anyway.
+            self.__dirtyBlocks[:,:] = 1
+            self.__blocksDirtied += CDG_NUM_BLOCKS
+            return
+
         # Redraw the entire screen using the new colour table. We still use the 
         # same colour indeces (0 to 15) at each pixel but these may translate to
         # new RGB colours. This handles CDGs that preset the screen before actually
@@ -464,18 +916,19 @@ class CdgPacketReader:
         # into an RGB colour and stores them in the RGB surfarray.
         lookupTable = N.array(self.__cdgColourTable)
         self.__cdgSurfarray.flat[:] = N.take(lookupTable, N.ravel(self.__cdgPixelColours))
+        self.__numRemaps += 1
 
         # An alternative way of doing the above - was found to be very slightly slower.
         #self.__cdgSurfarray.flat[:] =  map(self.__cdgColourTable.__getitem__, self.__cdgPixelColours.flat)
 
         # Update the screen for any colour changes
-        self.__updatedTiles = 0xFFFFFFFFL
+        self.__dirtyBlocks[:,:] = 1
+        self.__blocksDirtied += CDG_NUM_BLOCKS
         return
 
     # Set the colours for a 12x6 tile. The main CDG command for display data
-    def __cdgTileBlockCommon(self, packd, xor):
+    def __cdgTileBlockCommon(self, data_block, xor):
         # Decode the command parameters
-        data_block = packd.data
         if data_block[1] & 0x20:
             # I don't know why, but some disks seem to stick an extra
             # bit here to mean "ignore this command".
@@ -494,54 +947,41 @@ class CdgPacketReader:
         if (row_index > (CDG_FULL_WIDTH - 6)):
             row_index = (CDG_FULL_WIDTH - 6)
 
-        # Set the tile update bitmasks.
-        # Note that the screen update area only covers the non-border area
-        # excluding the left 6 columns, and top 12 rows. Therefore when
-        # calculating whether this block fits into a particular tile, we
-        # add 6 or 12 to the x,y positions. Note also that each tile is 6
-        # wide and 12 high, so if a block starts less than 6 columns to the
-        # left of a block, it will incorporate the adjacent block. Similarly
-        # any update starting less than 12 rows above a block, will also
-        # incorporate the block below.
-
-        firstRow = max((row_index - 6 - self.__hOffset) / TILE_WIDTH, 0)
-        lastRow = (row_index - 1 - self.__hOffset) / TILE_WIDTH
-
-        firstCol = max((column_index - 12 - self.__vOffset) / TILE_HEIGHT, 0)
-        lastCol = (column_index - 1 - self.__vOffset) / TILE_HEIGHT
-
-        for col in range(firstCol, lastCol + 1):
-            for row in range(firstRow, lastRow + 1):
-                self.__updatedTiles |= ((1 << row) << (col * 8))
+        # Mark just this block dirty.  GetDirtyRects() works out
+        # which part of it (if any) is visible.
+        if not self.__catchingUp:
+            self.__dirtyBlocks[column_index / BLOCK_HEIGHT, row_index / BLOCK_WIDTH] = 1
+            self.__blocksDirtied += 1
 
         # Set the pixel array for each of the pixels in the 12x6 tile.
         # Normal = Set the colour to either colour0 or colour1 depending
         #          on whether the pixel value is 0 or 1.
         # XOR    = XOR the colour with the colour index currently there.
-        for i in range (12):
-            byte = (data_block[4 + i] & 0x3F)
-            for j in range (6):
-                pixel = (byte >> (5 - j)) & 0x01
-                if xor:
-                    # Tile Block XOR
-                    if (pixel == 0):
-                        xor_col = colour0
-                    else:
-                        xor_col = colour1
-                    # Get the colour index currently at this location, and xor with it
-                    currentColourIndex = self.__cdgPixelColours[(row_index + j), (column_index + i)]
-                    new_col = currentColourIndex ^ xor_col
-                else:
-                    # Tile Block Normal
-                    if (pixel == 0):
-                        new_col = colour0
-                    else:
-                        new_col = colour1
-                # Set the pixel with the new colour. We set both the surfarray
-                # containing actual RGB values, as well as our array containing
-                # the colour indeces into our colour table.
-                self.__cdgSurfarray[(row_index + j), (column_index + i)] = self.__cdgColourTable[new_col]
-                self.__cdgPixelColours[(row_index + j), (column_index + i)] = new_col
+
+        # Unpack all 12 bytes into a 6x12 array of pixel bits in one
+        # step, then choose colour0 or colour1 for each pixel.  Doing
+        # this with whole-array operations is much faster than
+        # visiting the 72 pixels one at a time from Python.
+        pixelBytes = data_block[4:16] & 0x3F
+        pixels = (pixelBytes[N.NewAxis, :] >> TILE_PIXEL_SHIFTS) & 0x01
+        new_cols = N.where(pixels, colour1, colour0)
+
+        # Find the block within the circular pixel arrays.
+        x = (row_index + self.__hOrigin) % CDG_FULL_WIDTH
+        y = (column_index + self.__vOrigin) % CDG_FULL_HEIGHT
+
+        block = self.__cdgPixelColours[x:x + 6, y:y + 12]
+        if xor:
+            # Tile Block XOR: XOR with the colour indices currently there.
+            new_cols = block ^ new_cols
+
+        # Set the pixels with the new colours. We set both the surfarray
+        # containing actual RGB values, as well as our array containing
+        # the colour indeces into our colour table.
+        block[:,:] = new_cols
+        if not self.__usePalette and not self.__catchingUp:
+            lookupTable = N.array(self.__cdgColourTable)
+            self.__cdgSurfarray[x:x + 6, y:y + 12] = N.take(lookupTable, new_cols)
 
         # Now the screen has some data on it, so a subsequent clear
         # should be respected.
@@ -0,0 +1,769 @@
+#
+# Copyright (C) 2010 Kelvin Lawson (kelvinl@users.sourceforge.net)
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+""" This module is a third implementation of the auxiliary classes
+and functions in _pycdgAux, written against the current NumPy API.
+It has the same public interface as pycdgAux, but keeps its pixel
+arrays in compact integer types and updates them in place, so it is
+much faster than pycdgAux, and doesn't need the Numeric compatibility
+layer that has been dropped from recent versions of NumPy.  It is
+used when the C version is not available. """
+
+import pygame
+import struct
+import numpy as N
+from timeit import default_timer
+
+# This module can't do without numpy surfarrays.  Older versions of
+# pygame only support Numeric.
+if hasattr(pygame.surfarray, 'get_arraytypes') and \
+   'numpy' not in pygame.surfarray.get_arraytypes():
+    raise ImportError, "pygame.surfarray does not support numpy"
+
+# CDG Command Code
+CDG_COMMAND             = 0x09
+
+# CDG Instruction Codes
+CDG_INST_MEMORY_PRESET      = 1
+CDG_INST_BORDER_PRESET      = 2
+CDG_INST_TILE_BLOCK         = 6
+CDG_INST_SCROLL_PRESET      = 20
+CDG_INST_SCROLL_COPY        = 24
+CDG_INST_DEF_TRANSP_COL     = 28
+CDG_INST_LOAD_COL_TBL_0_7   = 30
+CDG_INST_LOAD_COL_TBL_8_15  = 31
+CDG_INST_TILE_BLOCK_XOR     = 38
+
+# The names of the instructions, as used by GetStats().
+CDG_INST_NAMES = {
+    CDG_INST_MEMORY_PRESET : 'MEMORY_PRESET',
+    CDG_INST_BORDER_PRESET : 'BORDER_PRESET',
+    CDG_INST_TILE_BLOCK : 'TILE_BLOCK',
+    CDG_INST_SCROLL_PRESET : 'SCROLL_PRESET',
+    CDG_INST_SCROLL_COPY : 'SCROLL_COPY',
+    CDG_INST_DEF_TRANSP_COL : 'DEF_TRANSP_COL',
+    CDG_INST_LOAD_COL_TBL_0_7 : 'LOAD_COL_TBL_0_7',
+    CDG_INST_LOAD_COL_TBL_8_15 : 'LOAD_COL_TBL_8_15',
+    CDG_INST_TILE_BLOCK_XOR : 'TILE_BLOCK_XOR',
+    }
+
+# Bitmask for all CDG fields
+CDG_MASK            = 0x3F
+
+# This is the size of the display as defined by the CDG specification.
+# The pixels in this region can be painted, and scrolling operations
+# rotate through this number of pixels.
+CDG_FULL_WIDTH      = 300
+CDG_FULL_HEIGHT     = 216
+
+# This is the size of the screen that is actually intended to be
+# visible.  It is the center area of CDG_FULL.  The remaining border
+# area surrounding it is not meant to be visible.
+CDG_DISPLAY_WIDTH   = 288
+CDG_DISPLAY_HEIGHT  = 192
+
+# Screen tile positions
+# The viewable area of the screen (288x192) is divided into
+# 24 tiles (6x4 of 49x51 each). This is used to only update
+# those tiles which have changed on every screen update,
+# thus reducing the CPU load of screen updates.
+TILES_PER_ROW           = 6
+TILES_PER_COL           = 4
+TILE_WIDTH              = CDG_DISPLAY_WIDTH / TILES_PER_ROW
+TILE_HEIGHT             = CDG_DISPLAY_HEIGHT / TILES_PER_COL
+
+# Changes to the screen are tracked at the granularity of the CDG's
+# own 6x12 blocks, of which there are 50x18 across the full area.
+BLOCK_WIDTH             = 6
+BLOCK_HEIGHT            = 12
+CDG_BLOCKS_WIDE         = CDG_FULL_WIDTH / BLOCK_WIDTH
+CDG_BLOCKS_HIGH         = CDG_FULL_HEIGHT / BLOCK_HEIGHT
+CDG_NUM_BLOCKS          = CDG_BLOCKS_WIDE * CDG_BLOCKS_HIGH
+
+COLOUR_TABLE_SIZE       = 16
+
+# The offset and size of the data field within each 24-byte packet.
+PACKET_SIZE             = 24
+PACKET_DATA_START       = 4
+PACKET_DATA_END         = 20
+
+# The header of a compiled CDG stream; see pycdgAux.
+COMPILED_MAGIC          = 'PYKCDGC1'
+COMPILED_HEADER         = '<8sI12x'
+
+# The six pixels of each possible byte of a tile block, most
+# significant bit first.
+TILE_PIXEL_BITS         = ((N.arange(64)[:, N.newaxis] >> N.arange(5, -1, -1)) & 1).astype(N.bool_)
+
+class CdgPacketReader:
+    """ This class does the all work of reading packets from the CDG
+    file, and evaluating them to fill in pixels in a numpy array.
+    Its public interface is the same as that of pycdgAux: DoPackets(),
+    CatchUp(), GetNextCommandPos(), Rewind(), GetState(), SetState(),
+    GetDirtyRects(), GetDirtyTiles(), FillRect(), FillTile(),
+    MarkTilesDirty(), GetBorderColour(), GetPalette() and
+    GetStats(). """
+
+    # The pixel arrays are the same shape as in pycdgAux: indexed
+    # [x][y], as pygame.surfarray expects.  The colour indices are
+    # kept as bytes, and the RGB values as 32-bit mapped colours, and
+    # all of the drawing operations write into them in place, so no
+    # array larger than a single 6x12 block is allocated while the
+    # stream plays.
+
+    def __init__(self, cdgData, mapperSurface, usePalette = False,
+                 keepStats = False):
+        self.__cdgData = cdgData
+        self.__cdgDataPos = 0
+
+        # View the whole stream as an array of 24-byte packets.  A
+        # partial packet at the end of the file is ignored.
+        numPackets = len(cdgData) / PACKET_SIZE
+        packets = N.frombuffer(cdgData, N.uint8, numPackets * PACKET_SIZE)
+        packets = packets.reshape((numPackets, PACKET_SIZE))
+
+        # Find the CDG commands up front, as pycdgAux does, or read
+        # them from a compiled stream.
+        if cdgData[:len(COMPILED_MAGIC)] == COMPILED_MAGIC:
+            magic, self.__cdgNumPackets = struct.unpack(COMPILED_HEADER, cdgData[:PACKET_SIZE])
+            packets = packets[1:]
+            position = packets[:, PACKET_DATA_END:].copy().view('<u4')
+            self.__cdgCommandPositions = position[:, 0].astype(N.intp)
+        else:
+            self.__cdgNumPackets = numPackets
+            isCommand = (packets[:, 0] & CDG_MASK) == CDG_COMMAND
+            self.__cdgCommandPositions = N.flatnonzero(isCommand)
+            packets = packets[self.__cdgCommandPositions]
+        instructions = packets[:, 1] & CDG_MASK
+        data = packets[:, PACKET_DATA_START:PACKET_DATA_END]
+
+        # The instructions and data fields are kept as lists of
+        # Python integers, which are much quicker to pick apart one
+        # at a time than numpy scalars.
+        self.__cdgInstructions = instructions.tolist()
+        self.__cdgPacketData = data.tolist()
+
+        # The colour indices of every tile block in the stream are
+        # worked out here, all at once, as a 6x12 array for each.
+        # __cdgTileNumber maps the index of each command to its entry
+        # in __cdgTileColours.
+        isTile = (instructions == CDG_INST_TILE_BLOCK) | \
+                 (instructions == CDG_INST_TILE_BLOCK_XOR)
+        self.__cdgTileNumber = (N.cumsum(isTile) - 1).tolist()
+        tiles = data[isTile]
+        bits = TILE_PIXEL_BITS[tiles[:, 4:16] & CDG_MASK].transpose(0, 2, 1)
+        colour0 = (tiles[:, 0] & 0x0F)[:, N.newaxis, N.newaxis]
+        colour1 = (tiles[:, 1] & 0x0F)[:, N.newaxis, N.newaxis]
+        self.__cdgTileColours = N.where(bits, colour1, colour0).astype(N.uint8)
+
+        # The index within __cdgCommandPositions of the next command
+        # to be processed.
+        self.__cdgCommandIndex = 0
+
+        # This is just for the purpose of mapping colors.
+        self.__mapperSurface = mapperSurface
+
+        # If usePalette is true, we keep only the array of colour
+        # indices, and the caller uses GetPalette(); see pycdgAux.
+        self.__usePalette = usePalette
+
+        # This is set during CatchUp(), which leaves __cdgSurfarray
+        # and __dirtyBlocks alone until the end.
+        self.__catchingUp = False
+
+        # If keepStats is true, __stats maps each instruction code to
+        # a list of the statistics returned by GetStats(); see
+        # __cdgPacketProcessCounted().  __numRemaps and
+        # __blocksDirtied count all of the re-maps of the whole screen
+        # and the blocks marked dirty so far.
+        self.__stats = None
+        if keepStats:
+            self.__stats = {}
+        self.__numRemaps = 0
+        self.__blocksDirtied = 0
+
+        # The arrays are allocated once, here; Rewind() and SetState()
+        # just fill them in again.
+        self.__cdgPixelColours = N.zeros((CDG_FULL_WIDTH, CDG_FULL_HEIGHT), N.uint8)
+        self.__cdgSurfarray = None
+        if not self.__usePalette:
+            self.__cdgSurfarray = N.zeros((CDG_FULL_WIDTH, CDG_FULL_HEIGHT), N.uint32)
+        self.__dirtyBlocks = N.ones((CDG_BLOCKS_HIGH, CDG_BLOCKS_WIDE), N.bool_)
+        self.__shownColours = N.zeros((CDG_FULL_WIDTH, CDG_FULL_HEIGHT), N.uint8)
+        self.__screenColours = N.zeros((CDG_FULL_WIDTH, CDG_FULL_HEIGHT), N.uint8)
+        self.__changedPixels = N.zeros((CDG_FULL_WIDTH, CDG_FULL_HEIGHT), N.bool_)
+
+        self.Rewind()
+
+    def Rewind(self):
+        """ Rewinds the stream to the beginning, and resets all
+        internal state in preparation for decoding the tiles
+        again. """
+
+        self.__cdgDataPos = 0
+        self.__cdgCommandIndex = 0
+
+        # Initialise the colour table. Set a default value for any
+        # CDG files that don't actually load the colour table
+        # before doing something with it.  The colour table is an
+        # array, so that it can be used to look up the RGB values of
+        # a whole array of colour indices at once.
+        self.__cdgColourTable = N.zeros(COLOUR_TABLE_SIZE, N.uint32)
+        self.__cdgPalette = [(0, 0, 0)] * COLOUR_TABLE_SIZE
+        if self.__usePalette:
+            # Each colour index maps to itself on a palettized surface.
+            self.__cdgColourTable = N.arange(COLOUR_TABLE_SIZE, dtype = N.uint32)
+
+        self.__justClearedColourIndex = -1
+        self.__cdgPresetColourIndex = -1
+        self.__cdgBorderColourIndex = -1
+        # Support only one transparent colour
+        self.__cdgTransparentColour = -1
+
+        # The screen shift and the scroll origin within the circular
+        # pixel arrays; see pycdgAux.
+        self.__hOffset = 0
+        self.__vOffset = 0
+        self.__hOrigin = 0
+        self.__vOrigin = 0
+
+        self.__cdgPixelColours.fill(0)
+        if not self.__usePalette:
+            self.__cdgSurfarray.fill(0)
+
+        # Start with everything requiring update.
+        self.__dirtyBlocks.fill(True)
+        self.__shownColours.fill(0)
+        self.__shownPalette = self.__cdgPalette[:]
+        self.__redrawAll = True
+
+    def MarkTilesDirty(self):
+        """ Marks the whole screen dirty, so that the next call to
+        GetDirtyRects() or GetDirtyTiles() will return all of it. """
+
+        self.__redrawAll = True
+
+    def GetDirtyRects(self):
+        """ Returns a list of (x, y, w, h) tuples, in pixels within
+        the visible CDG_DISPLAY_WIDTH x CDG_DISPLAY_HEIGHT area,
+        covering all of the parts of the screen that have changed.
+        Then resets the dirty area to empty. """
+
+        dirtyBlocks = self.__findChangedBlocks()
+
+        # The range of blocks that are at least partly visible.
+        firstX = (6 + self.__hOffset) / BLOCK_WIDTH
+        lastX = (6 + self.__hOffset + CDG_DISPLAY_WIDTH - 1) / BLOCK_WIDTH
+        firstY = (12 + self.__vOffset) / BLOCK_HEIGHT
+        lastY = (12 + self.__vOffset + CDG_DISPLAY_HEIGHT - 1) / BLOCK_HEIGHT
+
+        # Find the runs of dirty blocks along each row, and merge
+        # each run with the same run on the row above, if there is
+        # one.  openRuns maps (x0, x1) for each run on the previous
+        # row to the row its rectangle started on.
+        blocks = []
+        openRuns = {}
+        rows = dirtyBlocks[:, firstX:lastX + 1].any(1).tolist()
+        for by in range(firstY, lastY + 2):
+            runs = []
+            if by <= lastY and rows[by]:
+                row = dirtyBlocks[by].tolist()
+                bx = firstX
+                while bx <= lastX:
+                    if row[bx]:
+                        x0 = bx
+                        while bx <= lastX and row[bx]:
+                            bx += 1
+                        runs.append((x0, bx))
+                    else:
+                        bx += 1
+
+            for run, y0 in openRuns.items():
+                if run not in runs:
+                    blocks.append((run[0], y0, run[1], by))
+                    del openRuns[run]
+            for run in runs:
+                if run not in openRuns:
+                    openRuns[run] = by
+
+        self.__dirtyBlocks.fill(False)
+        self.__redrawAll = False
+
+        # Convert the blocks to pixels on the visible area.
+        rects = []
+        for x0, y0, x1, y1 in blocks:
+            x0 = max(x0 * BLOCK_WIDTH - 6 - self.__hOffset, 0)
+            x1 = min(x1 * BLOCK_WIDTH - 6 - self.__hOffset, CDG_DISPLAY_WIDTH)
+            y0 = max(y0 * BLOCK_HEIGHT - 12 - self.__vOffset, 0)
+            y1 = min(y1 * BLOCK_HEIGHT - 12 - self.__vOffset, CDG_DISPLAY_HEIGHT)
+            rects.append((x0, y0, x1 - x0, y1 - y0))
+
+        return rects
+
+    def GetDirtyTiles(self):
+        """ Returns a list of (row, col) tuples, corresponding to all
+        of the currently-dirty tiles.  Then resets the list of dirty
+        tiles to empty. """
+
+        updatedTiles = 0
+        for x, y, w, h in self.GetDirtyRects():
+            for col in range(y / TILE_HEIGHT, (y + h - 1) / TILE_HEIGHT + 1):
+                for row in range(x / TILE_WIDTH, (x + w - 1) / TILE_WIDTH + 1):
+                    updatedTiles |= ((1 << row) << (col * 8))
+
+        tiles = []
+        if updatedTiles != 0:
+            for col in range(TILES_PER_COL):
+                for row in range(TILES_PER_ROW):
+                    if (updatedTiles & ((1 << row) << (col * 8))):
+                        tiles.append((row, col))
+
+        return tiles
+
+    def GetBorderColour(self):
+        """ Returns the current border colour, as a mapped integer
+        ready to apply to the surface (or, in palette mode, as a colour
+        index).  Returns None if the border colour has not yet been
+        specified by the CDG stream. """
+
+        if self.__cdgBorderColourIndex == -1:
+            return None
+        return int(self.__cdgColourTable[self.__cdgBorderColourIndex])
+
+    def GetPalette(self):
+        """ Returns the current colour table, as a list of 16 (r, g,
+        b) tuples suitable for passing to Surface.set_palette(). """
+
+        return self.__cdgPalette[:]
+
+    def GetState(self):
+        """ Returns a snapshot of the decoder's current state, which
+        may later be passed to SetState() to return to this point in
+        the stream.  Only the colour indices are saved; the RGB
+        values are recomputed from them when the snapshot is
+        restored. """
+
+        return (self.__cdgDataPos, self.__cdgCommandIndex,
+                self.__cdgColourTable.tolist(), self.__cdgPalette[:],
+                self.__justClearedColourIndex, self.__cdgPresetColourIndex,
+                self.__cdgBorderColourIndex, self.__cdgTransparentColour,
+                self.__hOffset, self.__vOffset,
+                self.__hOrigin, self.__vOrigin,
+                self.__cdgPixelColours.copy())
+
+    def SetState(self, state):
+        """ Restores the decoder to a state previously returned by
+        GetState(), and marks all the tiles dirty. """
+
+        (self.__cdgDataPos, self.__cdgCommandIndex,
+         colourTable, palette,
+         self.__justClearedColourIndex, self.__cdgPresetColourIndex,
+         self.__cdgBorderColourIndex, self.__cdgTransparentColour,
+         self.__hOffset, self.__vOffset,
+         self.__hOrigin, self.__vOrigin,
+         pixelColours) = state
+        self.__cdgColourTable = N.array(colourTable, N.uint32)
+        self.__cdgPalette = palette[:]
+        self.__cdgPixelColours[:,:] = pixelColours
+
+        if not self.__usePalette:
+            N.take(self.__cdgColourTable, self.__cdgPixelColours, out = self.__cdgSurfarray)
+
+        self.__redrawAll = True
+
+    def DoPackets(self, numPackets):
+        """ Reads numPackets 24-byte packets from the CDG stream, and
+        processes their instructions on the internal tables stored
+        within this object.  Returns True on success, or False when
+        the end-of-file has been reached and no more packets can be
+        processed."""
+
+        if numPackets <= 0:
+            return True
+        if self.__cdgDataPos >= self.__cdgNumPackets:
+            # No more packets.
+            return False
+
+        # Process all of the CDG commands that fall within the next
+        # numPackets packets of the stream.
+        endPos = min(self.__cdgDataPos + numPackets, self.__cdgNumPackets)
+        endIndex = int(self.__cdgCommandPositions.searchsorted(endPos))
+        process = self.__cdgPacketProcess
+        if self.__stats != None:
+            process = self.__cdgPacketProcessCounted
+        for i in xrange(self.__cdgCommandIndex, endIndex):
+            process(self.__cdgInstructions[i], i)
+
+        self.__cdgCommandIndex = endIndex
+        self.__cdgDataPos = endPos
+        return True
+
+    def CatchUp(self, numPackets):
+        """ Does the same as DoPackets(), more quickly, for a long run
+        of packets with no screen update in between.  The RGB values
+        of the pixels and the dirty area are not kept up to date as
+        each command is processed; the RGB values are worked out once
+        at the end, and the whole screen is marked dirty. """
+
+        self.__catchingUp = True
+        try:
+            result = self.DoPackets(numPackets)
+        finally:
+            self.__catchingUp = False
+
+        if not self.__usePalette:
+            N.take(self.__cdgColourTable, self.__cdgPixelColours, out = self.__cdgSurfarray)
+        self.__redrawAll = True
+        return result
+
+    def GetNextCommandPos(self):
+        """ Returns the position in the stream (in packets) of the
+        next CDG command that DoPackets() will process, or None if
+        there are no more. """
+
+        if self.__cdgCommandIndex >= len(self.__cdgCommandPositions):
+            return None
+        return int(self.__cdgCommandPositions[self.__cdgCommandIndex])
+
+    def GetStats(self):
+        """ If the reader was made with keepStats true, returns a
+        dictionary with an entry for each type of CDG instruction
+        processed so far, mapping its name to a tuple of (count,
+        total seconds, re-maps of the whole screen, 6x12 blocks
+        marked dirty).  (The C version gives the re-maps as None,
+        since it never does one.)  Otherwise, returns None. """
+
+        if self.__stats == None:
+            return None
+
+        stats = {}
+        for inst_code, (count, seconds, remaps, dirtied) in self.__stats.items():
+            name = CDG_INST_NAMES.get(inst_code, 'UNKNOWN_%d' % (inst_code))
+            stats[name] = (count, seconds, remaps, dirtied)
+        return stats
+
+    def FillTile(self, surface, row, col):
+        """ Fills in the pixels on the indicated one-tile surface
+        (which must be a TILE_WIDTH x TILE_HEIGHT sized surface) with
+        the pixels from the indicated tile. """
+
+        tile = self.__getArea(row * TILE_WIDTH, col * TILE_HEIGHT,
+                              TILE_WIDTH, TILE_HEIGHT)
+        pygame.surfarray.blit_array(surface, tile)
+
+    def FillRect(self, surface, rect, pos = None):
+        """ Fills in the pixels within the indicated (x, y, w, h)
+        rectangle of the visible area, as returned by GetDirtyRects(),
+        onto the indicated surface, with its top-left corner at pos.
+        If pos is omitted, the pixels go at the same position on the
+        surface (which then must be a CDG_DISPLAY_WIDTH x
+        CDG_DISPLAY_HEIGHT sized surface). """
+
+        x, y, w, h = rect
+        if pos is None:
+            pos = (x, y)
+        area = self.__getArea(x, y, w, h)
+        pygame.surfarray.blit_array(surface.subsurface(pos, (w, h)), area)
+
+
+    # The remaining methods are all private; they are not part of the
+    # public interface.
+
+    # Returns an array of flags, like __dirtyBlocks, for the blocks
+    # that must be redrawn: the dirty blocks whose colours are not the
+    # same as when they were last shown.  Then brings __shownColours
+    # and __shownPalette up to date.
+    def __findChangedBlocks(self):
+        if not self.__redrawAll and not self.__dirtyBlocks.any():
+            return self.__dirtyBlocks
+
+        # Lay out the circular pixel array in screen order, in a
+        # scratch array of our own.
+        colours = self.__screenColours
+        h = CDG_FULL_WIDTH - self.__hOrigin
+        v = CDG_FULL_HEIGHT - self.__vOrigin
+        pixels = self.__cdgPixelColours
+        colours[:h, :v] = pixels[self.__hOrigin:, self.__vOrigin:]
+        colours[:h, v:] = pixels[self.__hOrigin:, :self.__vOrigin]
+        colours[h:, :v] = pixels[:self.__hOrigin, self.__vOrigin:]
+        colours[h:, v:] = pixels[:self.__hOrigin, :self.__vOrigin]
+
+        if self.__redrawAll:
+            changed = N.ones((CDG_BLOCKS_HIGH, CDG_BLOCKS_WIDE), N.bool_)
+        else:
+            # Find the pixels with a different colour index, or whose
+            # colour index now has a different colour.
+            changed = N.not_equal(colours, self.__shownColours, out = self.__changedPixels)
+            if self.__cdgPalette != self.__shownPalette:
+                changedPalette = N.array([self.__cdgPalette[i] != self.__shownPalette[i]
+                                          for i in range(COLOUR_TABLE_SIZE)])
+                changed |= changedPalette[colours]
+
+            # Then the blocks with any such pixels.
+            changed = changed.reshape((CDG_BLOCKS_WIDE, BLOCK_WIDTH,
+                                       CDG_BLOCKS_HIGH, BLOCK_HEIGHT))
+            changed = changed.any(3).any(1).T & self.__dirtyBlocks
+
+        # The arrays are swapped, rather than copied; the old one
+        # becomes the scratch array for next time.
+        self.__shownColours, self.__screenColours = colours, self.__shownColours
+        self.__shownPalette = self.__cdgPalette[:]
+        return changed
+
+    # Returns the array of pixels (RGB values, or colour indices in
+    # palette mode) for the indicated rectangle of the visible area.
+    def __getArea(self, x, y, w, h):
+        # Calculate the row & column starts/ends
+        row_start = 6 + self.__hOffset + x
+        col_start = 12 + self.__vOffset + y
+        pixels = self.__cdgSurfarray
+        if self.__usePalette:
+            pixels = self.__cdgPixelColours
+
+        # Find the area within the circular pixel array.  Usually it
+        # is a simple slice (a view, not a copy); if it wraps around
+        # the edge of the array, we have to gather its rows and
+        # columns instead.
+        x = (row_start + self.__hOrigin) % CDG_FULL_WIDTH
+        y = (col_start + self.__vOrigin) % CDG_FULL_HEIGHT
+        if x + w <= CDG_FULL_WIDTH and y + h <= CDG_FULL_HEIGHT:
+            return pixels[x:x + w, y:y + h]
+
+        xs = N.arange(x, x + w) % CDG_FULL_WIDTH
+        ys = N.arange(y, y + h) % CDG_FULL_HEIGHT
+        return pixels[xs[:, N.newaxis], ys]
+
+    # Does the same as __cdgPacketProcess(), and adds to the
+    # statistics for the instruction.
+    def __cdgPacketProcessCounted (self, inst_code, i):
+        remaps = self.__numRemaps
+        dirtied = self.__blocksDirtied
+        start = default_timer()
+        self.__cdgPacketProcess(inst_code, i)
+        stats = self.__stats.setdefault(inst_code, [0, 0.0, 0, 0])
+        stats[0] += 1
+        stats[1] += default_timer() - start
+        stats[2] += self.__numRemaps - remaps
+        stats[3] += self.__blocksDirtied - dirtied
+
+    # Perform the instruction of the indicated CDG command.
+    def __cdgPacketProcess (self, inst_code, i):
+        if inst_code == CDG_INST_TILE_BLOCK:
+            self.__cdgTileBlockCommon(i, xor = 0)
+        elif inst_code == CDG_INST_TILE_BLOCK_XOR:
+            self.__cdgTileBlockCommon(i, xor = 1)
+        elif inst_code == CDG_INST_MEMORY_PRESET:
+            self.__cdgMemoryPreset (self.__cdgPacketData[i])
+        elif inst_code == CDG_INST_BORDER_PRESET:
+            self.__cdgBorderPreset (self.__cdgPacketData[i])
+        elif inst_code == CDG_INST_SCROLL_PRESET:
+            self.__cdgScrollCommon (self.__cdgPacketData[i], copy = False)
+        elif inst_code == CDG_INST_SCROLL_COPY:
+            self.__cdgScrollCommon (self.__cdgPacketData[i], copy = True)
+        elif inst_code == CDG_INST_DEF_TRANSP_COL:
+            self.__cdgTransparentColour = self.__cdgPacketData[i][0] & 0x0F
+        elif inst_code == CDG_INST_LOAD_COL_TBL_0_7:
+            self.__cdgLoadColourTableCommon (self.__cdgPacketData[i], 0)
+        elif inst_code == CDG_INST_LOAD_COL_TBL_8_15:
+            self.__cdgLoadColourTableCommon (self.__cdgPacketData[i], 8)
+        else:
+            # Don't use the error popup, ignore the unsupported command
+            ErrorString = "CDG file may be corrupt, cmd: " + str(inst_code)
+            print (ErrorString)
+
+    # Memory preset (clear the viewable area + border)
+    def __cdgMemoryPreset (self, data_block):
+        colour = data_block[0] & 0x0F
+
+        # Repeated presets to the colour we have just cleared to are
+        # ignored; see pycdgAux.
+        if colour == self.__justClearedColourIndex:
+            return
+        self.__justClearedColourIndex = colour
+
+        # Memory preset commands also change the border
+        self.__cdgPresetColourIndex = colour
+        self.__cdgBorderColourIndex = colour
+
+        # Since every pixel is being set, this is a good time to put
+        # the scroll origin back where it started.
+        self.__hOrigin = 0
+        self.__vOrigin = 0
+
+        self.__cdgPixelColours.fill(colour)
+        if not self.__usePalette and not self.__catchingUp:
+            self.__cdgSurfarray.fill(self.__cdgColourTable[colour])
+
+        self.__dirtyBlocks.fill(True)
+        self.__blocksDirtied += CDG_NUM_BLOCKS
+
+    # Border Preset (clear the border area only)
+    def __cdgBorderPreset (self, data_block):
+        colour = data_block[0] & 0x0F
+        if colour == self.__cdgBorderColourIndex:
+            return
+
+        self.__cdgBorderColourIndex = colour
+
+        # The border strips are found relative to the scroll origin.
+        top = self.__vOrigin
+        bottom = (self.__vOrigin + CDG_FULL_HEIGHT - 12) % CDG_FULL_HEIGHT
+        left = self.__hOrigin
+        right = (self.__hOrigin + CDG_FULL_WIDTH - 6) % CDG_FULL_WIDTH
+        strips = [(slice(None), slice(top, top + 12)),
+                  (slice(None), slice(bottom, bottom + 12)),
+                  (slice(left, left + 6), slice(None)),
+                  (slice(right, right + 6), slice(None))]
+        for strip in strips:
+            self.__cdgPixelColours[strip] = colour
+            if not self.__usePalette and not self.__catchingUp:
+                self.__cdgSurfarray[strip] = self.__cdgColourTable[colour]
+
+        # The strips are the outermost blocks of the screen.
+        self.__dirtyBlocks[0,:] = True
+        self.__dirtyBlocks[-1,:] = True
+        self.__dirtyBlocks[:,0] = True
+        self.__dirtyBlocks[:,-1] = True
+        self.__blocksDirtied += 2 * CDG_BLOCKS_WIDE + 2 * (CDG_BLOCKS_HIGH - 2)
+
+    # Common function to handle the actual pixel scroll for Copy and Preset
+    def __cdgScrollCommon (self, data_block, copy):
+
+        # Decode the scroll command parameters
+        colour = data_block[0] & 0x0F
+        hScroll = data_block[1] & 0x3F
+        vScroll = data_block[2] & 0x3F
+        hSCmd = (hScroll & 0x30) >> 4
+        hOffset = (hScroll & 0x07)
+        vSCmd = (vScroll & 0x30) >> 4
+        vOffset = (vScroll & 0x0F)
+
+        if hOffset != self.__hOffset or vOffset != self.__vOffset:
+            # Changing the screen shift.
+            self.__hOffset = min(hOffset, 5)
+            self.__vOffset = min(vOffset, 11)
+            self.__redrawAll = True
+
+        # Scrolling just moves the origin of the circular pixel
+        # arrays; for a preset scroll, the strip that has scrolled
+        # into view is then filled in with the new colour.
+        if vSCmd == 2:
+            self.__vOrigin = (self.__vOrigin + 12) % CDG_FULL_HEIGHT
+            y = (self.__vOrigin - 12) % CDG_FULL_HEIGHT
+            strip = (slice(None), slice(y, y + 12))
+        elif vSCmd == 1:
+            self.__vOrigin = (self.__vOrigin - 12) % CDG_FULL_HEIGHT
+            y = self.__vOrigin
+            strip = (slice(None), slice(y, y + 12))
+        elif hSCmd == 2:
+            self.__hOrigin = (self.__hOrigin + 6) % CDG_FULL_WIDTH
+            x = (self.__hOrigin - 6) % CDG_FULL_WIDTH
+            strip = (slice(x, x + 6), slice(None))
+        elif hSCmd == 1:
+            self.__hOrigin = (self.__hOrigin - 6) % CDG_FULL_WIDTH
+            x = self.__hOrigin
+            strip = (slice(x, x + 6), slice(None))
+        else:
+            # Never mind.
+            return
+
+        if not copy:
+            self.__cdgPixelColours[strip] = colour
+            if not self.__usePalette and not self.__catchingUp:
+                self.__cdgSurfarray[strip] = self.__cdgColourTable[colour]
+
+        self.__dirtyBlocks.fill(True)
+        self.__blocksDirtied += CDG_NUM_BLOCKS
+
+    # Load the RGB value for colours 0..7 or 8..15 in the lookup table
+    def __cdgLoadColourTableCommon (self, data_block, colourTableStart):
+        # Streams typically load the same colours again and again.
+        # If none of them is actually changing, there is nothing to
+        # do.
+        colours = []
+        for i in range(8):
+            colourEntry = ((data_block[2 * i] & CDG_MASK) << 8)
+            colourEntry = colourEntry + (data_block[(2 * i) + 1] & CDG_MASK)
+            colourEntry = ((colourEntry & 0x3F00) >> 2) | (colourEntry & 0x003F)
+            red = ((colourEntry & 0x0F00) >> 8) * 17
+            green = ((colourEntry & 0x00F0) >> 4) * 17
+            blue = ((colourEntry & 0x000F)) * 17
+            colours.append((red, green, blue))
+        if colours == self.__cdgPalette[colourTableStart:colourTableStart + 8]:
+            return
+
+        self.__cdgPalette[colourTableStart:colourTableStart + 8] = colours
+        self.__dirtyBlocks.fill(True)
+        self.__blocksDirtied += CDG_NUM_BLOCKS
+        if self.__usePalette:
+            # In palette mode, that's all there is to do.
+            return
+
+        for i in range(8):
+            red, green, blue = colours[i]
+            self.__cdgColourTable[i + colourTableStart] = \
+                self.__mapperSurface.map_rgb(red, green, blue) & 0xffffffffL
+
+        # Look up the new RGB value of every pixel, in place (unless
+        # CatchUp() is going to do that at the end anyway).
+        if self.__catchingUp:
+            return
+        N.take(self.__cdgColourTable, self.__cdgPixelColours, out = self.__cdgSurfarray)
+        self.__numRemaps += 1
+
+    # Set the colours for a 12x6 tile. The main CDG command for display data
+    def __cdgTileBlockCommon(self, i, xor):
+        data_block = self.__cdgPacketData[i]
+        if data_block[1] & 0x20:
+            # I don't know why, but some disks seem to stick an extra
+            # bit here to mean "ignore this command".
+            return
+
+        column_index = ((data_block[2] & 0x1F) * 12)
+        row_index = ((data_block[3] & 0x3F) * 6)
+
+        # Sanity check the x,y offset read from the CDG in case a
+        # corrupted CDG sends us outside of our array bounds
+        if (column_index > (CDG_FULL_HEIGHT - 12)):
+            column_index = (CDG_FULL_HEIGHT - 12)
+        if (row_index > (CDG_FULL_WIDTH - 6)):
+            row_index = (CDG_FULL_WIDTH - 6)
+
+        # Mark just this block dirty.
+        if not self.__catchingUp:
+            self.__dirtyBlocks[column_index / BLOCK_HEIGHT, row_index / BLOCK_WIDTH] = True
+            self.__blocksDirtied += 1
+
+        # Find the block within the circular pixel arrays.
+        x = (row_index + self.__hOrigin) % CDG_FULL_WIDTH
+        y = (column_index + self.__vOrigin) % CDG_FULL_HEIGHT
+
+        # The colour indices of the block were worked out in
+        # __init__(); either store them, or XOR them with the colour
+        # indices currently there.
+        block = self.__cdgPixelColours[x:x + 6, y:y + 12]
+        tileColours = self.__cdgTileColours[self.__cdgTileNumber[i]]
+        if xor:
+            block ^= tileColours
+        else:
+            block[:,:] = tileColours
+        if not self.__usePalette and not self.__catchingUp:
+            N.take(self.__cdgColourTable, block, out = self.__cdgSurfarray[x:x + 6, y:y + 12])
+
+        # Now the screen has some data on it, so a subsequent clear
+        # should be respected.
+        self.__justClearedColourIndex = -1
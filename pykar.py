@@ -1074,6 +1074,8 @@ class midPlayer(pykPlayer):
 
         # Remove irrelevant options.
         parser.remove_option('--fps')
+        parser.remove_option('--idle-fps')
+        parser.remove_option('--cdg-stats')
         parser.remove_option('--zoom')
 
         return parser
@@ -1142,6 +1144,7 @@ class midPlayer(pykPlayer):
 
         manager.Flip()
         self.screenDirty = False
+        self.frameDirty = True
 
     def drawSyllable(self, syllable, row, x):
         """Draws a new syllable on the screen in the appropriate
@@ -1151,12 +1154,13 @@ class midPlayer(pykPlayer):
         position of the end of the previous syllable, which is used to
         fill in the syllable's x position if it is not already known.
         x may be none if the syllable's x position is already
-        known."""
+        known.  Returns the rectangle that was drawn, or None if
+        nothing was. """
 
         if syllable.left == None:
             syllable.left = x
             if syllable.left == None:
-                return
+                return None
 
         y = Y_BORDER + row * self.lineSize
 
@@ -1180,7 +1184,9 @@ class midPlayer(pykPlayer):
         width, height = text.get_size()
         syllable.right = syllable.left + width
 
-        manager.surface.blit(text, (syllable.left, y, width, height))
+        rect = pygame.Rect(syllable.left, y, width, height)
+        manager.surface.blit(text, rect)
+        return rect
 
     def __hasLyrics(self):
         """ Returns true if the midi file contains any lyrics at all,
@@ -1251,6 +1257,17 @@ class midPlayer(pykPlayer):
             if self.currentMs > self.midifile.lastNoteMS:
                 self.Close()
 
+    def getWaitTime(self):
+        if self.State != STATE_PLAYING:
+            return pykPlayer.getWaitTime(self)
+
+        # Sleep until the next syllable changes colour or the screen
+        # scrolls, or else until the end of the song.
+        nextMs = self.midifile.lastNoteMS + 1
+        if self.nextChangeMs != None:
+            nextMs = min(nextMs, self.nextChangeMs)
+        return max(nextMs - self.currentMs, 0)
+
     def handleEvent(self, event):
         if event.type == pygame.KEYDOWN and event.key == pygame.K_RETURN and (event.mod & (pygame.KMOD_LSHIFT | pygame.KMOD_RSHIFT | pygame.KMOD_LMETA | pygame.KMOD_RMETA)):
             # Shift/meta return: start/stop song.  Useful for keybinding apps.
@@ -1287,7 +1304,9 @@ class midPlayer(pykPlayer):
         self.nextChangeMs = self.nextColourMs
 
         # Is it time to scroll?
+        topLine = self.topLine
         syllables = self.considerScroll(syllables)
+        self.frameDirty = True
 
         if self.screenDirty:
             # If the whole screen needs to be redrawn anyway, just do
@@ -1297,11 +1316,21 @@ class midPlayer(pykPlayer):
         else:
             # Otherwise, draw only the syllables that have changed.
             x = None
+            rect_list = []
             for syllable, line in syllables:
-                self.drawSyllable(syllable, line - self.topLine, x)
+                rect = self.drawSyllable(syllable, line - self.topLine, x)
+                if rect:
+                    rect_list.append(rect)
                 x = syllable.right
 
-            manager.Flip()
+            if self.topLine != topLine:
+                # The screen has scrolled, so all of it has changed.
+                manager.Flip()
+            elif rect_list:
+                # Only update the syllables on the display, rather
+                # than flipping the whole thing for each one.
+                if manager.display:
+                    pygame.display.update(rect_list)
 
         return True
 
@@ -143,7 +143,7 @@ from pykenv import env
 import pycdg, pympg, pykar, pykversion, pykdb
 import codecs
 import cPickle
-from pykmanager import manager
+from pykmanager import manager, POLL_MAX_WAIT, POLL_EVENT_INTERVAL
 import random
 import performer_prompt as PerformerPrompt
 
@@ -265,6 +265,11 @@ class DatabaseSetupWindow (wx.Frame):
         self.deleteIdenticalCheckBox.Enable(self.KaraokeMgr.SongDB.Settings.CheckHashes)
         self.Bind(wx.EVT_CHECKBOX, self.OnDeleteIdenticalChanged, self.deleteIdenticalCheckBox)
 
+        # Create the CDG thumbnails option
+        self.thumbnailsCheckBox = wx.CheckBox(self.panel, -1, "Make preview thumbnails of CDG files")
+        self.thumbnailsCheckBox.SetValue(self.KaraokeMgr.SongDB.Settings.CdgThumbnailsOnScan)
+        self.Bind(wx.EVT_CHECKBOX, self.OnThumbnailsChanged, self.thumbnailsCheckBox)
+
         # Create the scan folders button
         self.ScanText = wx.StaticText (self.panel, wx.ID_ANY, "Rescan all folders: ")
         self.ScanFoldersButtonID = wx.NewId()
@@ -293,6 +298,8 @@ class DatabaseSetupWindow (wx.Frame):
         self.LowerSizer.Add(self.hashCheckBox, 1, wx.LEFT | wx.RIGHT | wx.TOP, 3)
         self.LowerSizer.Add((0, 0))
         self.LowerSizer.Add(self.deleteIdenticalCheckBox, 1, wx.LEFT | wx.RIGHT | wx.BOTTOM, 3)
+        self.LowerSizer.Add((0, 0))
+        self.LowerSizer.Add(self.thumbnailsCheckBox, 1, wx.ALL, 3)
         self.LowerSizer.Add(self.ScanText, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 3)
         self.LowerSizer.Add(self.ScanFoldersButton, 1, wx.ALL, 3)
         self.LowerSizer.Add(self.SaveText, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 3)
@@ -432,6 +439,12 @@ class DatabaseSetupWindow (wx.Frame):
         self.ScanNeeded = True
         self.SaveNeeded = True
 
+    # User changed the CDG thumbnails checkbox, enable it
+    def OnThumbnailsChanged(self, event):
+        self.KaraokeMgr.SongDB.Settings.CdgThumbnailsOnScan = self.thumbnailsCheckBox.IsChecked()
+        self.ScanNeeded = True
+        self.SaveNeeded = True
+
     # Popup asking if want to rescan the database after changing settings
     def ExitHandler(self, event):
         self.__getCodings()
@@ -737,6 +750,25 @@ class ConfigWindow (wx.Frame):
             self.CdgUseCCheckBox.Enable(False)
         cdgsizer.Add(self.CdgUseCCheckBox, flag = wx.LEFT | wx.RIGHT | wx.TOP, border = 10)
 
+        # Enable/disable the NumPy implementation, used when the C one isn't
+        self.CdgUseNumpyCheckBox = wx.CheckBox(panel, -1, "Otherwise use NumPy-based implementation")
+        self.CdgUseNumpyCheckBox.SetValue(settings.CdgUseNumpy)
+        # Check that the NumPy implementation is available.
+        if not pycdg.aux_numpy:
+            self.CdgUseNumpyCheckBox.SetValue(False)
+            self.CdgUseNumpyCheckBox.Enable(False)
+        cdgsizer.Add(self.CdgUseNumpyCheckBox, flag = wx.LEFT | wx.RIGHT | wx.TOP, border = 10)
+
+        # Enable/disable rendering through an 8-bit palette
+        self.CdgUsePaletteCheckBox = wx.CheckBox(panel, -1, "Render using 8-bit palette")
+        self.CdgUsePaletteCheckBox.SetValue(settings.CdgUsePalette)
+        cdgsizer.Add(self.CdgUsePaletteCheckBox, flag = wx.LEFT | wx.RIGHT | wx.TOP, border = 10)
+
+        # Enable/disable decoding ahead of the music in another thread
+        self.CdgDecodeAheadCheckBox = wx.CheckBox(panel, -1, "Decode ahead in a separate thread")
+        self.CdgDecodeAheadCheckBox.SetValue(settings.CdgDecodeAhead)
+        cdgsizer.Add(self.CdgDecodeAheadCheckBox, flag = wx.LEFT | wx.RIGHT | wx.TOP, border = 10)
+
         # Scan song information from the file names.
         infoSizer = wx.BoxSizer(wx.VERTICAL)
         # Add checkbox for song-derivation enable/disable
@@ -1067,6 +1099,9 @@ class ConfigWindow (wx.Frame):
         selection = self.CdgZoom.GetSelection()
         settings.CdgZoom = settings.Zoom[selection]
         settings.CdgUseC = self.CdgUseCCheckBox.IsChecked()
+        settings.CdgUseNumpy = self.CdgUseNumpyCheckBox.IsChecked()
+        settings.CdgUsePalette = self.CdgUsePaletteCheckBox.IsChecked()
+        settings.CdgDecodeAhead = self.CdgDecodeAheadCheckBox.IsChecked()
         # Check to see if we will need to update the database
         if ((self.SongInfoCheckBox.IsChecked() == settings.CdgDeriveSongInformation) 
             and (settings.CdgFileNameType == self.FileNameStyles.GetCurrentSelection())
@@ -1880,15 +1915,22 @@ class SearchResultsPanel (wx.Panel):
         self.StatusBar = wx.StatusBar(self, -1)
         self.StatusBar.SetStatusText ("No Search Performed")
 
+        # The preview thumbnail of the selected song, if it has one
+        # (see SongDB.makeCdgThumbnails()).  Hidden when it hasn't.
+        self.Thumbnail = wx.StaticBitmap(self, -1, wx.EmptyBitmap(*pycdg.CDG_THUMBNAIL_SIZE))
+        self.Thumbnail.Show(False)
+
         self.VertSizer = wx.BoxSizer(wx.VERTICAL)
         self.InterGap = 0
         self.VertSizer.Add(self.SearchSizer, 0, wx.EXPAND, self.InterGap)
         self.VertSizer.Add(self.ListPanel, 1, wx.EXPAND, self.InterGap)
+        self.VertSizer.Add(self.Thumbnail, 0, wx.ALIGN_CENTER | wx.ALL, 3)
         self.VertSizer.Add(self.StatusBar, 0, wx.EXPAND, self.InterGap)
         self.SetSizer(self.VertSizer)
         self.Show(True)
 
         wx.EVT_LIST_ITEM_ACTIVATED(self, wx.ID_ANY, self.OnFileSelected)
+        wx.EVT_LIST_ITEM_SELECTED(self.ListPanel, wx.ID_ANY, self.OnItemSelected)
         wx.EVT_BUTTON(self, wx.ID_ANY, self.OnSearchClicked)
         wx.EVT_TEXT_ENTER(self, wx.ID_ANY, self.OnSearchClicked)
 
@@ -1944,6 +1986,20 @@ class SearchResultsPanel (wx.Panel):
             for song in self.getSelectedSongs():
                 self.KaraokeMgr.AddToPlaylist(song, self)
 
+    def OnItemSelected(self, event):
+        """ Shows the preview thumbnail of the selected song, if there
+        is one. """
+        filename = None
+        if self.KaraokeMgr.SongDB.Settings.CdgThumbnailsOnScan:
+            song = self.SongStructList[self.ListPanel.GetItemData(event.GetIndex())]
+            filename = self.KaraokeMgr.SongDB.getCdgThumbnail(song)
+        if filename:
+            self.Thumbnail.SetBitmap(wx.Bitmap(filename))
+        if self.Thumbnail.IsShown() != bool(filename):
+            self.Thumbnail.Show(bool(filename))
+            self.Layout()
+        event.Skip()
+
     def OnSearchClicked(self, event):
         """ Handle the search button clicked event """
         # Check to see if it will load the entire database
@@ -3672,6 +3728,7 @@ class PyKaraokeManager:
                 sys.exit(0)
             else:
                 self.EVT_ERROR_POPUP = wx.NewId()
+                self.PollTimer = PollTimer()
                 self.Frame = PyKaraokeWindow(None, -1, "PyKaraoke " + pykversion.PYKARAOKE_VERSION_STRING, self)
                 self.Frame.Connect(-1, -1, self.EVT_ERROR_POPUP, self.ErrorPopupEventHandler)
                 self.SongDB.LoadDatabase(self.ErrorPopupCallback)
@@ -3811,10 +3868,13 @@ class PyKaraokeManager:
             self.Frame.playlistButton.SetLabel("Stop")
 
     def handleIdle(self, event):
-        manager.Poll()
+        # Never sleep in Poll() here, since that would hold up the wx
+        # events; instead, have PollTimer wake us up again when the
+        # player next has something to do.
+        manager.Poll(maxWait = 0)
+        self.schedulePoll()
 
         if self.Player:
-            wx.WakeUpIdle()
             if self.gui:
                 # Display the time played and the time remaining
                 position = self.Player.GetPos()
@@ -3830,6 +3890,35 @@ class PyKaraokeManager:
                     self.Frame.PlaylistPanel.StatusBar.SetStatusText("[%02d:%02d/%02d:%02d] %s - %s" % (minutes, seconds, minutesRemaining, secondsRemaining, self.Player.Song.Artist, self.Player.Song.Title))
 
 
+    def schedulePoll(self):
+        """ Starts PollTimer, to wake up the wx event loop when the
+        player next has something to do, or when it is time to check
+        for events in the pygame window. """
+
+        if not manager.player and not manager.display:
+            # Nothing to do until the next wx event.
+            return
+
+        waitTime = POLL_MAX_WAIT
+        if manager.player:
+            playerWait = manager.player.getWaitTime()
+            if playerWait is not None:
+                waitTime = min(waitTime, playerWait)
+        if manager.display:
+            # pygame can't wake up the wx event loop when an event
+            # arrives in its window, so check for them this often.
+            waitTime = min(waitTime, POLL_EVENT_INTERVAL)
+        self.PollTimer.Start(max(waitTime, 1), wx.TIMER_ONE_SHOT)
+
+
+# A one-shot timer that wakes up the wx event loop, so that its idle
+# handler calls manager.Poll() again; see
+# PyKaraokeManager.schedulePoll().
+class PollTimer(wx.Timer):
+    def Notify(self):
+        wx.WakeUpIdle()
+
+
 # Decide whether only WxPython v2.6 is available (and no later version).
 def HasWx26Only ():
     # Don't do this for py2exe builds, for which we cannot use wxversion
@@ -3872,13 +3961,17 @@ class PyKaraokeApp(wx.App):
             # any time spent in sleep() can steal time away from
             # pygame, especially on slower computers.
             time.sleep(0)
-            self.ProcessIdle()
+            if not self.ProcessIdle():
+                # No handler wants more idle time, so wait for the
+                # next event.  While a song plays, that is at most
+                # PollTimer's interval away.
+                evtloop.Dispatch()
 
     def OnInit(self):
         # On OSX, it's important to initialize pygame first, *before*
         # we create the main menu, since initializing pygame seems to
         # replace whatever menu we've already created.
-        manager.Poll()
+        manager.Poll(maxWait = 0)
         
         Mgr = PyKaraokeManager()
         if Mgr.gui:
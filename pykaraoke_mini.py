@@ -108,6 +108,12 @@ class App(pykPlayer):
         self.SupportsFontZoom = True
         self.selectedSong = None
 
+        # The filename of the preview thumbnail shown in the song
+        # window, and the thumbnail itself, so that it isn't loaded
+        # again each time the window is painted.
+        self.thumbnailFilename = None
+        self.thumbnail = None
+
     def SetupOptions(self):
         """ Initialise and return optparse OptionParser object,
         suitable for parsing the command line options to this
@@ -255,8 +261,35 @@ class App(pykPlayer):
         text = self.boldFont.render(filename, True, fg, bg)
         manager.display.blit(text, (self.xMargin, y))
 
+        # Show the highlighted version's preview thumbnail, if it has
+        # one, in the bottom right corner, so the user can see which
+        # disc it came from.
+        thumbnail = self.getThumbnail(file)
+        if thumbnail:
+            winWidth, winHeight = manager.displaySize
+            w, h = thumbnail.get_size()
+            manager.display.blit(thumbnail, (winWidth - w - self.xMargin,
+                                             winHeight - h - self.xMargin))
+
         pygame.display.flip()
 
+    def getThumbnail(self, file):
+        """ Returns the preview thumbnail of the indicated song file
+        as a surface, or None if it doesn't have one. """
+
+        filename = None
+        if self.songDb.Settings.CdgThumbnailsOnScan:
+            filename = self.songDb.getCdgThumbnail(file)
+        if filename != self.thumbnailFilename:
+            self.thumbnailFilename = filename
+            self.thumbnail = None
+            if filename:
+                try:
+                    self.thumbnail = pygame.image.load(filename)
+                except pygame.error:
+                    print "Couldn't load %s" % (filename)
+        return self.thumbnail
+
     def paintMainWindow(self):
         """ Paints the main 'select a song' index. """
 
@@ -445,7 +478,7 @@ class App(pykPlayer):
         self.heldStartTicks = pygame.time.get_ticks()
         
         while self.running:
-            manager.Poll()
+            manager.Poll(maxWait = None)
 
         self.writeMarkedSongs()
         manager.CloseDisplay()
@@ -810,6 +843,23 @@ class App(pykPlayer):
             elif elapsed > 2000:
                 manager.setCpuSpeed('menu_slow')
 
+    def getWaitTime(self):
+        if self.State == STATE_CLOSING or self.State == STATE_CLOSED:
+            return 0
+        if self.screenDirty or self.heldKey:
+            # Repaint, or repeat the held key, as soon as possible.
+            return 1
+
+        # Otherwise, the only thing left to do is to slow the CPU down
+        # after 2 and 20 seconds; after that, there's nothing to do
+        # until the next keypress.
+        elapsed = pygame.time.get_ticks() - self.heldStartTicks
+        if elapsed <= 2000:
+            return 2001 - elapsed
+        elif elapsed <= 20000:
+            return 20001 - elapsed
+        return None
+
     def handleEvent(self, event):
         if self.selectedSong:
             self.handleSongEvent(event)
@@ -167,6 +167,14 @@ class SongStruct:
     T_CDG = 1
     T_MPG = 2
 
+    # The name of the preview thumbnail of a CDG file, within
+    # SongDB.getCdgThumbnailDirectory(), once makeCdgThumbnails() has
+    # found or made one, and the (modification time, size) of the
+    # song's file at the time.  These are class attributes so that
+    # songs pickled before they existed have them too.
+    CdgThumbnail = None
+    CdgThumbnailStamp = None
+
     def __init__(self, Filepath, settings,
                  Title = None, Artist = None, ZipStoredName = None, DatabaseAdd = False):
         self.Filepath = Filepath    # Full path to file or ZIP file
@@ -897,6 +905,15 @@ class SettingsStruct:
         # CDG options
         self.CdgZoom = 'int'
         self.CdgUseC = True
+        self.CdgIdleFps = 5 # Frames per second to update the CDG screen at while nothing on it is changing
+        self.CdgUseNumpy = True # Use the NumPy CDG interpreter, rather than the Numeric one, when the C one is not used
+        self.CdgUsePalette = False # Render through 8-bit palettized surfaces
+        self.CdgWholeFrameFraction = 0.8 # Scale the whole CDG screen at once when this much of it changes
+        self.CdgDecodeAhead = False # Decode and draw the CDG graphics a few frames ahead, in another thread
+        self.CdgCompiledCache = True # Keep compiled copies of CDG files in the cdgcache directory
+        self.CdgCompileOnScan = False # Compile all the CDG files when scanning for songs
+        self.CdgThumbnailsOnScan = False # Make preview thumbnails of new CDG files when scanning for songs
+        self.CdgThumbnailJobs = 0 # Worker processes for making thumbnails; 0 means one for each CPU
         self.CdgDeriveSongInformation = False # Determines if we should parse file names for song information
         self.CdgFileNameType = -1 # The style index we are using for the file name parsing
         self.ExcludeNonMatchingFilenames = False # Exclude songs from database if can't derive song info
@@ -963,6 +980,10 @@ class SongDB:
         # A cache of zip files.
         self.ZipFiles = []
 
+        # The thumbnails of the songs before the current scan, by
+        # getMarkKey(); see BuildSearchDatabase().
+        self.previousThumbnails = {}
+
         # Set true if there are local changes to the database that
         # need to be saved to disk.
         self.databaseDirty = False
@@ -1027,6 +1048,16 @@ class SongDB:
         # If we can't find a good temp directory, use our save directory.
         return self.getSaveDirectory()
 
+    def getCdgCacheDirectory(self):
+        """ Returns the directory in which compiled CDG files should
+        be saved. """
+        return os.path.join(self.SaveDir, "cdgcache")
+
+    def getCdgThumbnailDirectory(self):
+        """ Returns the directory in which preview thumbnails of CDG
+        files should be saved. """
+        return os.path.join(self.SaveDir, "cdgthumbs")
+
     def getHomeDirectory(self):
         """ Returns the user's home directory, if we can figure that
         out. """
@@ -1284,6 +1315,15 @@ class SongDB:
     def BuildSearchDatabase(self, yielder, busyDlg):
         # Zap the database and build again from scratch. Return True
         # if was cancelled.
+
+        # Remember the thumbnails found on the last scan, so that
+        # makeCdgThumbnails() needn't read those files again.
+        self.previousThumbnails = {}
+        for song in self.FullSongList:
+            if song.CdgThumbnail:
+                self.previousThumbnails[song.getMarkKey()] = \
+                    (song.CdgThumbnail, song.CdgThumbnailStamp)
+
         self.FullSongList = []
         self.TitlesFiles = []
 
@@ -1378,6 +1418,12 @@ class SongDB:
         if self.Settings.CheckHashes:
             self.checkFileHashes(yielder)
 
+        if self.Settings.CdgCompiledCache and self.Settings.CdgCompileOnScan:
+            self.compileCdgFiles(yielder)
+
+        if self.Settings.CdgThumbnailsOnScan:
+            self.makeCdgThumbnails(yielder)
+
         self.BusyDlg.SetProgress("Finalizing", 1.0)
         yielder.Yield()
 
@@ -1845,6 +1891,166 @@ class SongDB:
                 newSongList.append(self.FullSongList[i])
         self.FullSongList = newSongList
 
+    def compileCdgFiles(self, yielder):
+        """ Walks through self.FullSongList, making sure that each
+        CDG file has a compiled copy in the cache, so that it is ready
+        to play without compiling it first. """
+
+        self.BusyDlg.SetProgress("Compiling CDG files", 0.0)
+        yielder.Yield()
+        self.lastBusyUpdate = time.time()
+
+        cacheDir = self.getCdgCacheDirectory()
+        numFiles = len(self.FullSongList)
+        for i in range(numFiles):
+            now = time.time()
+            if now - self.lastBusyUpdate > 0.1:
+                # Every so often, update the progress bar.
+                self.BusyDlg.SetProgress(
+                    "Compiling CDG files", float(i) / float(numFiles))
+                yielder.Yield()
+                self.lastBusyUpdate = now
+
+            if self.BusyDlg.Clicked:
+                return
+
+            song = self.FullSongList[i]
+            if song.Type != song.T_CDG:
+                continue
+            try:
+                datas = song.GetSongDatas()
+                if datas:
+                    pycdg.getCompiledCdg(datas[0].GetData(), cacheDir)
+            except (IOError, ValueError):
+                print "Couldn't compile %s" % (repr(song.DisplayFilename))
+
+    def makeCdgThumbnails(self, yielder):
+        """ Walks through self.FullSongList, making sure that each
+        CDG file has a preview thumbnail in the cache.  The thumbnails
+        are named for the contents of the files, so only the new (or
+        changed) files need one made; they are drawn by a pool of
+        worker processes, which is started only if there are any. """
+
+        import multiprocessing
+
+        self.BusyDlg.SetProgress("Making CDG thumbnails", 0.0)
+        yielder.Yield()
+        self.lastBusyUpdate = time.time()
+
+        thumbDir = self.getCdgThumbnailDirectory()
+        numJobs = self.Settings.CdgThumbnailJobs
+        if numJobs <= 0:
+            numJobs = multiprocessing.cpu_count()
+        pool = None
+
+        # Only a few files are kept outstanding at a time, so that the
+        # CDG data waiting to be drawn doesn't pile up in memory.
+        pending = []
+        numFiles = len(self.FullSongList)
+        for i in range(numFiles):
+            now = time.time()
+            if now - self.lastBusyUpdate > 0.1:
+                # Every so often, update the progress bar.
+                self.BusyDlg.SetProgress(
+                    "Making CDG thumbnails", float(i) / float(numFiles))
+                yielder.Yield()
+                self.lastBusyUpdate = now
+
+            if self.BusyDlg.Clicked:
+                break
+
+            song = self.FullSongList[i]
+            if song.Type != song.T_CDG:
+                continue
+            # If the thumbnail was found on an earlier scan, and the
+            # file hasn't changed since, there's no need to read it.
+            stamp = self.__getFileStamp(song)
+            previous = self.previousThumbnails.get(song.getMarkKey())
+            if previous and previous[1] == stamp:
+                song.CdgThumbnail, song.CdgThumbnailStamp = previous
+            if song.CdgThumbnailStamp == stamp and self.getCdgThumbnail(song):
+                continue
+            try:
+                datas = song.GetSongDatas()
+                if not datas:
+                    continue
+                cdgData = datas[0].GetData()
+            except (IOError, ValueError):
+                print "Couldn't read %s" % (repr(song.DisplayFilename))
+                continue
+            song.CdgThumbnail = None
+            song.CdgThumbnailStamp = stamp
+            filename = pycdg.findCdgThumbnail(cdgData, thumbDir)
+            if filename:
+                song.CdgThumbnail = os.path.basename(filename)
+                continue
+
+            if not pool:
+                pool = multiprocessing.Pool(numJobs)
+            pending.append((song, pool.apply_async(pycdg.makeCdgThumbnail,
+                                                   (cdgData, thumbDir))))
+            while len(pending) >= numJobs * 2 and not self.BusyDlg.Clicked:
+                self.__waitThumbnail(pending, yielder,
+                                     float(i) / float(numFiles))
+
+        while pending and not self.BusyDlg.Clicked:
+            self.__waitThumbnail(pending, yielder, 1.0)
+
+        if not pool:
+            return
+        if self.BusyDlg.Clicked:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+
+    def __getFileStamp(self, song):
+        """ Returns the (modification time, size) of the indicated
+        song's file (or the zip file it is in), or None if it can't
+        be found. """
+
+        try:
+            st = os.stat(song.Filepath)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def __waitThumbnail(self, pending, yielder, progress):
+        """ Waits for the first of the pending thumbnails to be made,
+        keeping the busy dialog up to date meanwhile, and then removes
+        it from the list and records it on its song. """
+
+        song, result = pending[0]
+        while not result.ready():
+            result.wait(0.1)
+            self.BusyDlg.SetProgress("Making CDG thumbnails", progress)
+            yielder.Yield()
+            if self.BusyDlg.Clicked:
+                return
+        pending.pop(0)
+
+        try:
+            filename = result.get()
+        except Exception, e:
+            print "Couldn't make a thumbnail for %s: %s" % (repr(song.DisplayFilename), e)
+            return
+        if filename:
+            song.CdgThumbnail = os.path.basename(filename)
+
+    def getCdgThumbnail(self, song):
+        """ Returns the filename of the preview thumbnail of the
+        indicated song, or None if it is not a CDG file, or hasn't had
+        a thumbnail made.  This doesn't read the song itself; the
+        thumbnail is found when the database is built (see
+        makeCdgThumbnails()). """
+
+        if not song.CdgThumbnail:
+            return None
+        filename = os.path.join(self.getCdgThumbnailDirectory(), song.CdgThumbnail)
+        if not os.path.exists(filename):
+            return None
+        return filename
+
     def makeUniqueSongs(self):
         """ Walks through self.FullSongList, and builds up
         self.UniqueSongList, which collects only those songs who have
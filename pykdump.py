@@ -0,0 +1,421 @@
+#
+# Copyright (C) 2010  Kelvin Lawson (kelvinl@users.sourceforge.net)
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""This module writes out the frames captured by the --dump option.
+A player hands each frame, as a copy of its surface, to a FrameDumper,
+which passes it through a bounded queue to a thread that writes it to
+a FrameSink.  The player can then get on with rendering the next frame
+while the last one is converted and written to disk, or to an
+encoder.
+
+For most of a karaoke song, nothing changes on the screen from one
+frame to the next.  A player that knows its frame hasn't changed
+calls FrameDumper.repeat() instead of put(), and the writer thread
+also compares each frame put() with the one before it; either way, an
+unchanged frame is handed to FrameSink.repeat(), which writes it out
+again without converting it a second time."""
+
+import pygame
+import os
+import sys
+import shutil
+import subprocess
+import threading
+import Queue
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+# The number of frames that may be waiting to be written before the
+# player has to wait for the writer thread to catch up.
+DUMP_QUEUE_FRAMES = 16
+
+class FrameSink:
+    """ The base class for the destinations of --dump frames.  Each
+    frame is a pygame.Surface; write() is called with them in order,
+    always from the same thread, and close() is called after the last
+    one.  repeat() is called instead of write() for a frame that is
+    the same as the one before. """
+
+    def __init__(self, size, frameRate):
+        self.size = size
+        self.frameRate = frameRate
+
+    def write(self, surface):
+        """ Writes the frame surface.  Each sink overrides this; the
+        base class discards the frame. """
+        pass
+
+    def repeat(self, surface):
+        """ Writes the previous frame, surface, once more.  Sinks
+        override this to reuse the work they did for it the first
+        time. """
+        self.write(surface)
+
+    def close(self):
+        pass
+
+class ImageFileSink(FrameSink):
+    """ Writes each frame to a numbered image file.  filename is a
+    pattern containing a %d conversion for the frame number; the
+    filename extension determines the type of image written. """
+
+    def __init__(self, size, frameRate, filename):
+        FrameSink.__init__(self, size, frameRate)
+        self.filename = filename
+        ext = os.path.splitext(filename)[1].lower()
+        self.ppm = (ext == '.ppm' or ext == '.pnm')
+        self.frame = 0
+        self.lastFilename = None
+
+    def write(self, surface):
+        filename = self.__nextFilename()
+
+        if self.ppm:
+            # pygame doesn't support PPM directly, but it's so easy
+            # and useful that we do it by hand.
+            f = open(filename, 'wb')
+            writePPM(f, surface)
+            f.close()
+        else:
+            # Ask pygame to dump the file.  We trust that pygame knows
+            # how to store an image in the requested format.
+            pygame.image.save(surface, filename)
+        self.lastFilename = filename
+
+    def repeat(self, surface):
+        # Make the new file a hard link to the previous one, so that
+        # it takes up no more space, if the filesystem allows it.
+        filename = self.__nextFilename()
+        if os.path.exists(filename):
+            os.remove(filename)
+        try:
+            os.link(self.lastFilename, filename)
+        except (AttributeError, OSError):
+            shutil.copyfile(self.lastFilename, filename)
+
+    def __nextFilename(self):
+        filename = self.filename % self.frame
+        print filename
+        self.frame += 1
+        return filename
+
+class AppendPPMSink(FrameSink):
+    """ Appends all of the frames to one PPM file.  Mjpegtools likes
+    this. """
+
+    def __init__(self, size, frameRate, filename):
+        FrameSink.__init__(self, size, frameRate)
+        self.file = open(filename, 'wb')
+        self.lastFrame = None
+
+    def write(self, surface):
+        self.lastFrame = ppmString(surface)
+        self.file.write(self.lastFrame)
+
+    def repeat(self, surface):
+        self.file.write(self.lastFrame)
+
+    def close(self):
+        self.file.close()
+
+class PipeSink(FrameSink):
+    """ Writes the raw RGB pixels of each frame, 3 bytes per pixel
+    with no header, to the standard input of a subprocess, such as
+    a video encoder.  command is a shell command, in which
+    %(width)d, %(height)d and %(fps)s are replaced with the frame
+    size and rate.  Nothing else in the command is touched, so it
+    may contain other % signs, such as an ffmpeg filename pattern. """
+
+    def __init__(self, size, frameRate, command):
+        FrameSink.__init__(self, size, frameRate)
+        command = command.replace('%(width)d', str(size[0]))
+        command = command.replace('%(height)d', str(size[1]))
+        command = command.replace('%(fps)s', str(frameRate))
+        self.proc = subprocess.Popen(command, shell = True,
+                                     stdin = subprocess.PIPE)
+        self.lastFrame = None
+
+    def write(self, surface):
+        self.lastFrame = pygame.image.tostring(surface, 'RGB')
+        self.proc.stdin.write(self.lastFrame)
+
+    def repeat(self, surface):
+        self.proc.stdin.write(self.lastFrame)
+
+    def close(self):
+        self.proc.stdin.close()
+        returnCode = self.proc.wait()
+        if returnCode != 0:
+            raise IOError, "Dump command exited with status %s" % (returnCode)
+
+class MpegSink(FrameSink):
+    """ Uses pymedia to encode the frames as an MPEG2 stream
+    on-the-fly.  pymedia needs the frame rate in hundredths of a
+    frame per second, so the frame rate is rounded to match. """
+
+    def __init__(self, size, frameRate, filename):
+        import pymedia
+        import pymedia.video.vcodec as vcodec
+
+        frameRate = int(frameRate * 100 + 0.5)
+        FrameSink.__init__(self, size, float(frameRate) / 100.0)
+
+        self.file = open(filename, 'wb')
+        params= { \
+          'type': 0,
+          'gop_size': 12,
+          'frame_rate_base': 125,
+          'max_b_frames': 0,
+          'height': size[1],
+          'width': size[0],
+          'frame_rate': frameRate,
+          'deinterlace': 0,
+          'bitrate': 9800000,
+          'id': vcodec.getCodecID('mpeg2video')
+        }
+        self.encoder = vcodec.Encoder( params )
+        self.lastYuvFrame = None
+
+    def write(self, surface):
+        import pymedia.video.vcodec as vcodec
+
+        ss = pygame.image.tostring(surface, "RGB")
+        bmpFrame = vcodec.VFrame(
+            vcodec.formats.PIX_FMT_RGB24,
+            surface.get_size(), (ss,None,None))
+        self.lastYuvFrame = bmpFrame.convert(vcodec.formats.PIX_FMT_YUV420P)
+        self.__encode()
+
+    def repeat(self, surface):
+        # The encoder still has to be given every frame, but the
+        # colour conversion need not be done again.
+        self.__encode()
+
+    def __encode(self):
+        d = self.encoder.encode(self.lastYuvFrame)
+        self.file.write(d.data)
+
+    def close(self):
+        self.file.close()
+
+class Y4mSink(FrameSink):
+    """ Writes the frames as a single YUV4MPEG2 stream, the format
+    read by mjpegtools and most other video encoders.  The frames are
+    converted from RGB to 4:2:0 Y'CbCr, with the BT.601 coefficients
+    and ranges that ppmtoy4m uses.  The file may be a named pipe, so
+    that the encoder can read the stream as it is written. """
+
+    def __init__(self, size, frameRate, filename):
+        # Only this sink needs numpy.
+        import numpy
+        self.numpy = numpy
+
+        FrameSink.__init__(self, size, frameRate)
+        self.file = open(filename, 'wb')
+        num, den = y4mFrameRate(frameRate)
+        self.file.write('YUV4MPEG2 W%d H%d F%d:%d Ip A1:1 C420jpeg\n' % (
+            size[0], size[1], num, den))
+        self.lastFrame = None
+
+    def write(self, surface):
+        N = self.numpy
+
+        # Work with integer arrays in the order the planes are
+        # written, row by row.
+        rgb = pygame.surfarray.array3d(surface).transpose(1, 0, 2).astype(N.int32)
+        r = rgb[:, :, 0]
+        g = rgb[:, :, 1]
+        b = rgb[:, :, 2]
+        y = ((66 * r + 129 * g + 25 * b + 128) >> 8) + 16
+
+        # Each chroma sample is centred on a 2x2 block of pixels, so
+        # it is computed from their average.  If the frame has an odd
+        # size, the last row or column is repeated.
+        height, width = y.shape
+        if height % 2 or width % 2:
+            rows = N.minimum(N.arange(height + height % 2), height - 1)
+            columns = N.minimum(N.arange(width + width % 2), width - 1)
+            rgb = rgb[rows][:, columns]
+        rgb = (rgb[0::2, 0::2] + rgb[1::2, 0::2] +
+               rgb[0::2, 1::2] + rgb[1::2, 1::2] + 2) >> 2
+        r = rgb[:, :, 0]
+        g = rgb[:, :, 1]
+        b = rgb[:, :, 2]
+        cb = ((-38 * r - 74 * g + 112 * b + 128) >> 8) + 128
+        cr = ((112 * r - 94 * g - 18 * b + 128) >> 8) + 128
+
+        planes = [plane.astype(N.uint8).tostring() for plane in (y, cb, cr)]
+        self.lastFrame = 'FRAME\n' + ''.join(planes)
+        self.file.write(self.lastFrame)
+
+    def repeat(self, surface):
+        self.file.write(self.lastFrame)
+
+    def close(self):
+        self.file.close()
+
+def y4mFrameRate(frameRate):
+    """ Returns the frame rate as a (numerator, denominator) pair, as
+    a YUV4MPEG2 header needs it.  The NTSC rates, such as 29.97, are
+    given exactly, as 30000:1001 and so on. """
+
+    ntsc = int(frameRate * 1.001 + 0.5)
+    if abs(frameRate - int(frameRate + 0.5)) > 0.001 and \
+       abs(ntsc * 1000.0 / 1001.0 - frameRate) < 0.005:
+        return ntsc * 1000, 1001
+
+    num = int(frameRate * 1000 + 0.5)
+    den = 1000
+    a, b = num, den
+    while b:
+        a, b = b, a % b
+    return num / a, den / a
+
+def ppmString(surface):
+    """ Returns the surface as a PPM image, in a string. """
+    w, h = surface.get_size()
+    return 'P6\n%s %s 255\n' % (w, h) + pygame.image.tostring(surface, 'RGB')
+
+def writePPM(file, surface):
+    """ Writes the surface to the open file as a PPM image. """
+    file.write(ppmString(surface))
+
+def makeFrameSink(filename, size, frameRate):
+    """ Returns the FrameSink for the indicated --dump parameter.  The
+    sink's frameRate may differ slightly from the one requested, if
+    that is all the sink supports. """
+
+    if filename.startswith('|'):
+        # Pipe the frames to a command.
+        return PipeSink(size, frameRate, filename[1:])
+
+    base, ext = os.path.splitext(filename)
+    ext_lower = ext.lower()
+    if ext_lower == '.mpg':
+        return MpegSink(size, frameRate, filename)
+    if ext_lower == '.y4m':
+        return Y4mSink(size, frameRate, filename)
+
+    # Don't dump a video file; dump a sequence of frames instead.
+    ppm = (ext_lower == '.ppm' or ext_lower == '.pnm')
+
+    # Convert the filename to a pattern.
+    if '#' in filename:
+        hash = filename.index('#')
+        end = hash
+        while end < len(filename) and filename[end] == '#':
+            end += 1
+        count = end - hash
+        filename = filename[:hash] + '%0' + str(count) + 'd' + filename[end:]
+    elif ppm:
+        # There's no hash in the filename.  We can dump a series of
+        # frames all to the same file, if we're dumping ppm frames.
+        return AppendPPMSink(size, frameRate, filename)
+    else:
+        # Implicitly append a frame number.
+        filename = base + '%04d' + ext
+
+    return ImageFileSink(size, frameRate, filename)
+
+class FrameDumper:
+    """ Passes frames to a FrameSink in a separate thread.  put()
+    only blocks if DUMP_QUEUE_FRAMES frames are already waiting to
+    be written.  An exception raised by the sink is raised again by
+    the next call to put(), repeat() or close(). """
+
+    def __init__(self, sink, queueFrames = DUMP_QUEUE_FRAMES):
+        self.sink = sink
+        self.frameRate = sink.frameRate
+        self.queue = Queue.Queue(queueFrames)
+        self.error = None
+
+        # The last surface passed to put().  Queuing the same surface
+        # object again marks a repeated frame.
+        self.lastSurface = None
+
+        # The number of frames written, and how many of those were
+        # repeats.
+        self.numFrames = 0
+        self.numRepeats = 0
+
+        self.thread = threading.Thread(target = self.__writeFrames)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def put(self, surface):
+        """ Queues the surface to be written as the next frame.  The
+        surface must not be drawn on again afterwards; pass a copy. """
+        self.__checkError()
+        self.lastSurface = surface
+        self.queue.put(surface)
+
+    def repeat(self):
+        """ Queues the previous frame to be written again.  The player
+        calls this when it knows that nothing has been drawn since. """
+        self.__checkError()
+        assert self.lastSurface
+        self.queue.put(self.lastSurface)
+
+    def close(self):
+        """ Waits for all of the queued frames to be written, and then
+        closes the sink. """
+        self.queue.put(None)
+        self.thread.join()
+        if not self.error:
+            try:
+                self.sink.close()
+            except:
+                self.error = sys.exc_info()
+        self.__checkError()
+
+    def __checkError(self):
+        if self.error:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+
+    def __writeFrames(self):
+        lastSurface = None
+        lastDigest = None
+        while True:
+            surface = self.queue.get()
+            if surface is None:
+                break
+            if self.error:
+                # Keep emptying the queue, so the player doesn't
+                # block, until it finds out about the error.
+                continue
+            try:
+                if surface is lastSurface:
+                    self.sink.repeat(surface)
+                    self.numRepeats += 1
+                else:
+                    # The player may have drawn something without
+                    # changing the picture, so compare the pixels
+                    # with those of the previous frame.
+                    digest = md5(surface.get_buffer().raw).digest()
+                    if digest == lastDigest:
+                        self.sink.repeat(surface)
+                        self.numRepeats += 1
+                    else:
+                        self.sink.write(surface)
+                        lastDigest = digest
+                    lastSurface = surface
+                self.numFrames += 1
+            except:
+                self.error = sys.exc_info()
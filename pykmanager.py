@@ -37,6 +37,15 @@ except:
 if env == ENV_GP2X:
     import _cpuctrl as cpuctrl
 
+# While Poll() is waiting for the player's next deadline, it checks
+# for input events at least this often, in milliseconds.
+POLL_EVENT_INTERVAL = 10
+
+# By default, Poll() returns to its caller after at most this many
+# milliseconds, even if the player has nothing to do until the next
+# event (for instance, while it is paused).
+POLL_MAX_WAIT = 100
+
 class pykManager:
 
     """ There is only one instance of this class in existence during
@@ -189,9 +198,12 @@ class pykManager:
 
         if self.options.dump:
             # We're just capturing frames offscreen.  In that case,
-            # just open an offscreen buffer as the "display".
+            # just open an offscreen buffer as the "display".  Ask
+            # for 32 bits explicitly; without a display mode to copy,
+            # pygame would otherwise give us an unpaletted 8-bit
+            # surface.
             self.display = None
-            self.surface = pygame.Surface(self.displaySize)
+            self.surface = pygame.Surface(self.displaySize, 0, 32)
             self.mouseVisible = False
             self.displaySize = self.surface.get_size()
             self.displayFlags = self.surface.get_flags()
@@ -344,26 +356,39 @@ class pykManager:
                 print >> invalidFile, '%s\t%s' % (song.Filepath, song.ZipStoredName)
                 invalidFile.flush()
 
-    def Poll(self):
+    def Poll(self, maxWait = POLL_MAX_WAIT):
         """ Your application must call this method from time to
         time--ideally, within a hundred milliseconds or so--to perform
         the next quantum of activity. Alternatively, if the
         application does not require any cycles, you may just call
-        WaitForPlayer() instead. """
+        WaitForPlayer() instead.
+
+        Having done that, Poll() sleeps until the player next has
+        something to do, or until the next input event arrives, but for
+        no more than maxWait milliseconds; an application with its own
+        events to handle may want to specify a shorter time.  If
+        maxWait is None, it may sleep until the next input event, with
+        no limit; only a loop that does nothing but call Poll() should
+        ask for that. """
 
         if not self.initialized:
             self.pygame_init()
 
         self.handleEvents()
 
+        # Without a player, there's nothing to wait for; just wait a
+        # bit to save on wasteful CPU usage.
+        waitTime = 1
         if self.player:
             if self.player.State == STATE_CLOSED:
                 self.player = None
             else:
                 self.player.doStuff()
+                waitTime = self.player.getWaitTime()
 
-        # Wait a bit to save on wasteful CPU usage.
-        pygame.time.wait(1)
+        if maxWait is not None and (waitTime is None or waitTime > maxWait):
+            waitTime = maxWait
+        self.waitForDeadline(waitTime)
 
     def WaitForPlayer(self):
         """ The interface may choose to call this method in lieu of
@@ -371,7 +396,7 @@ class pykManager:
         active player has finished, and then return. """
 
         while self.player and self.player.State != STATE_CLOSED:
-            self.Poll()
+            self.Poll(maxWait = None)
 
     def SetupOptions(self, usage, songDb):
         """ Initialise and return optparse OptionParser object,
@@ -411,6 +436,9 @@ class pykManager:
         parser.add_option('-s', '--fps', dest = 'fps', metavar='N', type = 'int',
                           help = 'restrict visual updates to N frames per second',
                           default = 30)
+        parser.add_option('', '--idle-fps', dest = 'idle_fps', metavar='N', type = 'int',
+                          help = 'update the screen only N times per second while nothing on it is changing (CDG files only)',
+                          default = settings.CdgIdleFps)
         parser.add_option('-r', '--sample-rate', dest = 'sample_rate', type = 'int',
                           help = 'specify the audio sample rate.  Ideally, this should match the recording.  For MIDI files, higher is better but consumes more CPU.',
                           default = settings.SampleRate)
@@ -433,11 +461,17 @@ class pykManager:
                           help = 'disable music playback, just display graphics', default = False)
 
         parser.add_option('', '--dump', dest = 'dump',
-                          help = 'dump output as a sequence of frame images, for converting to video',
+                          help = 'dump output as a sequence of frame images, for converting to video, as a .y4m stream, or as raw RGB frames piped to "|COMMAND"',
                           default = '')
         parser.add_option('', '--dump-fps', dest = 'dump_fps', type = 'float',
                           help = 'specify the number of frames per second of the sequence output by --dump',
                           default = 29.97)
+        parser.add_option('', '--dump-jobs', dest = 'dump_jobs', metavar = 'N', type = 'int',
+                          help = 'render the frames for --dump in N parallel processes (CDG files only)',
+                          default = 1)
+        parser.add_option('', '--cdg-stats', dest = 'cdg_stats', action = 'store_true',
+                          help = 'print how much time the CDG interpreter spends on each type of instruction when the song ends (CDG files only)',
+                          default = False)
 
         parser.add_option('', '--validate', dest = 'validate', action = 'store_true',
                           help = 'validate that all songs contain lyrics and are playable')
@@ -462,6 +496,7 @@ class pykManager:
         self.settings.NumChannels = self.options.num_channels
         self.settings.SampleRate = self.options.sample_rate
         self.settings.BufferMs = self.options.buffer
+        self.settings.CdgIdleFps = self.options.idle_fps
 
     def WordWrapText(self, text, font, maxWidth):
         """Folds the line (or lines) of text into as many lines as
@@ -527,6 +562,32 @@ class pykManager:
                 self.handleEvent(event)
 
 
+    def waitForDeadline(self, waitTime):
+        """ Sleeps for waitTime milliseconds, or until a pygame event
+        arrives, whichever is sooner.  If waitTime is None, sleeps
+        until the next event. """
+
+        if waitTime is None:
+            if self.display:
+                # Nothing happens until an event arrives, so block
+                # until one does, and handle it here.
+                self.handleEvent(pygame.event.wait())
+                return
+            waitTime = POLL_EVENT_INTERVAL
+
+        # pygame can't wait for an event with a timeout, so we sleep
+        # in short slices, checking for events in between.
+        deadline = pygame.time.get_ticks() + waitTime
+        while True:
+            remaining = deadline - pygame.time.get_ticks()
+            if remaining <= 0:
+                break
+            if self.display:
+                pygame.event.pump()
+                if pygame.event.peek():
+                    break
+            pygame.time.wait(min(remaining, POLL_EVENT_INTERVAL))
+
     def handleEvent(self, event):
         # Only handle resize events 250ms after opening the
         # window. This is to handle the bizarre problem of SDL making
@@ -23,6 +23,7 @@ implementations for different types of Karaoke files."""
 from pykconstants import *
 from pykmanager import manager
 from pykenv import env
+import pykdump
 import pygame
 import sys
 import types
@@ -124,6 +125,18 @@ class pykPlayer:
         # Set this true if the player can zoom font sizes.
         self.SupportsFontZoom = False
 
+        # The pykdump.FrameDumper that writes out the frames, while
+        # capturing.
+        self.dumper = None
+
+        # A derived class that knows when it has drawn on
+        # manager.surface sets this true whenever it does, and
+        # doFrameDump() sets it false again; a frame dumped while it
+        # is false is a repeat of the one before.  It is left None by
+        # players that don't keep track, and then the dumper compares
+        # the frames itself.
+        self.frameDirty = None
+
     # The following methods are part of the public API and intended to
     # be exported from this class.
 
@@ -184,6 +197,11 @@ class pykPlayer:
         else:
             return self.PlayTime
 
+    # Jump to the indicated time (in milliseconds).
+    def SetPos(self, ms):
+        ErrorString = "SetPos() not supported"
+        self.ErrorNotifyCallback (ErrorString)
+
     def SetupOptions(self, usage = None):
         """ Initialise and return optparse OptionParser object,
         suitable for parsing the command line options to this
@@ -197,110 +215,37 @@ class pykPlayer:
     # Below methods are internal.
 
     def setupDump(self):
-        # Capture the output as a sequence of numbered frame images.
+        # Capture the output as a sequence of numbered frame images,
+        # or one of the other kinds of output supported by pykdump.
         self.PlayTime = 0
         self.PlayStartTime = 0
         self.PlayFrame = 0
         self.State = STATE_CAPTURING
 
-        self.dumpFrameRate = manager.options.dump_fps
-        assert self.dumpFrameRate
-
-        filename = manager.options.dump
-        base, ext = os.path.splitext(filename)
-        ext_lower = ext.lower()
-
-        self.dumpEncoder = None
-        if ext_lower == '.mpg':
-            # Use pymedia to convert frames to an mpeg2 stream
-            # on-the-fly.
-            import pymedia
-            import pymedia.video.vcodec as vcodec
-
-            self.dumpFile = open(filename, 'wb')
-            frameRate = int(self.dumpFrameRate * 100 + 0.5)
-            self.dumpFrameRate = float(frameRate) / 100.0
-            
-            params= { \
-              'type': 0,
-              'gop_size': 12,
-              'frame_rate_base': 125,
-              'max_b_frames': 0,
-              'height': manager.options.size_y,
-              'width': manager.options.size_x,
-              'frame_rate': frameRate,
-              'deinterlace': 0,
-              'bitrate': 9800000,
-              'id': vcodec.getCodecID('mpeg2video')
-            }
-            self.dumpEncoder = vcodec.Encoder( params )
-            return
-            
-        # Don't dump a video file; dump a sequence of frames instead.
-        self.dumpPPM = (ext_lower == '.ppm' or ext_lower == '.pnm')
-        self.dumpAppend = False
-        
-        # Convert the filename to a pattern.
-        if '#' in filename:
-            hash = filename.index('#')
-            end = hash
-            while end < len(filename) and filename[end] == '#':
-                end += 1
-            count = end - hash
-            filename = filename[:hash] + '%0' + str(count) + 'd' + filename[end:]
-        else:
-            # There's no hash in the filename.
-            if self.dumpPPM:
-                # We can dump a series of frames all to the same file,
-                # if we're dumping ppm frames.  Mjpegtools likes this.
-                self.dumpAppend = True
-                try:
-                    os.remove(filename)
-                except OSError:
-                    pass
-            else:
-                # Implicitly append a frame number.
-                filename = base + '%04d' + ext
-            
-        self.dumpFilename = filename
+        assert manager.options.dump_fps
+        sink = pykdump.makeFrameSink(manager.options.dump,
+                                     manager.surface.get_size(),
+                                     manager.options.dump_fps)
+        self.dumpFrameRate = sink.frameRate
+        self.dumper = pykdump.FrameDumper(sink)
 
     def doFrameDump(self):
-        if self.dumpEncoder:
-            import pymedia.video.vcodec as vcodec
-
-            ss = pygame.image.tostring(manager.surface, "RGB")
-            bmpFrame = vcodec.VFrame(
-                vcodec.formats.PIX_FMT_RGB24,
-                manager.surface.get_size(), (ss,None,None))
-            yuvFrame = bmpFrame.convert(vcodec.formats.PIX_FMT_YUV420P)
-            d = self.dumpEncoder.encode(yuvFrame)
-            self.dumpFile.write(d.data)
-            return
-
-        if self.dumpAppend:
-            filename = self.dumpFilename
+        # The frame is written out in another thread, so all we do
+        # here is take a copy of it, if it has changed.
+        if self.frameDirty == False:
+            self.dumper.repeat()
         else:
-            filename = self.dumpFilename % self.PlayFrame
-            print filename
-
-        if self.dumpPPM:
-            # Dump a PPM file.  We do PPM by hand since pygame
-            # doesn't support it directly, but it's so easy and
-            # useful.
-            
-            w, h = manager.surface.get_size()
-            if self.dumpAppend:
-                f = open(filename, 'ab')
-            else:
-                f = open(filename, 'wb')
-            f.write('P6\n%s %s 255\n' % (w, h))
-            f.write(pygame.image.tostring(manager.surface, 'RGB'))
-
-        else:
-            # Ask pygame to dump the file.  We trust that pygame knows
-            # how to store an image in the requested format.
-            pygame.image.save(manager.surface, filename)
-            
+            self.dumper.put(manager.surface.copy())
+            if self.frameDirty:
+                self.frameDirty = False
+
+    def finishDump(self):
+        # Wait for the last frames to be written.
+        if self.dumper:
+            dumper, self.dumper = self.dumper, None
+            dumper.close()
+            print "Dumped %s frames, %s of them repeated." % (
+                dumper.numFrames, dumper.numRepeats)
 
     def doValidate(self):
         return True
@@ -334,9 +279,24 @@ class pykPlayer:
 
             # Set the frame time for the next frame.
             self.PlayTime = 1000.0 * self.PlayFrame / self.dumpFrameRate
-            
+
         self.PlayFrame += 1
-        
+
+    def getWaitTime(self):
+        # Override this in a derived class to return the number of
+        # milliseconds that may pass before doStuff() next needs to be
+        # called, or None if there is nothing to do until an event
+        # arrives.  pykmanager sleeps until then (or until the next
+        # input event), rather than calling doStuff() continuously.
+        if self.State == STATE_CLOSING or self.State == STATE_CLOSED or \
+           self.State == STATE_CAPTURING:
+            return 0
+        elif self.State == STATE_PLAYING:
+            # We don't know when the derived class next has something
+            # to do, so give it every chance.
+            return 1
+        return None
+
 
     def doResize(self, newSize):
         # This will be called internally whenever the window is
@@ -421,6 +381,8 @@ class pykPlayer:
         # This will be called by the pykManager to shut down the thing
         # immediately.
 
+        self.finishDump()
+
         # If the caller gave us a callback, let them know we're finished
         if self.State != STATE_CLOSED:
             self.State = STATE_CLOSED
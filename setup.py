@@ -92,9 +92,9 @@ setupArgs = {
   'url' : 'http://www.kibosh.org/pykaraoke',
   'license' : 'LGPL',
   'long_description' : 'PyKaraoke - CD+G/MPEG/KAR Karaoke Player',
-  'py_modules' : [ "pycdgAux", "pycdg", "pykaraoke_mini",
+  'py_modules' : [ "pycdgAux", "pycdgAuxNumpy", "pycdg", "pykaraoke_mini",
                    "pykaraoke", "pykar", "pykconstants",
-                   "pykdb", "pykenv", "pykmanager",
+                   "pykdb", "pykdump", "pykenv", "pykmanager",
                    "pykplayer", "pykversion", "pympg", "performer_prompt" ],
   'ext_modules' : [Extension("_pycdgAux", ["_pycdgAux.c"],
                              libraries = ['SDL'])],